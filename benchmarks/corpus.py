@@ -0,0 +1,346 @@
+"""Synthetic dumps for benchmarks, in the formats doc_generator reads: Mediawiki XML export, Mediawiki SQL dump,
+Wordpress SQL dump and Joomla SQL dump. Pages have headings, formatting, lists, tables, images, external and namespaced
+links. Some are redirects, some differ from another title only in case, and a few are pathologically long. The CMS
+dumps also have the rows that aren't documents, e.g. revisions, attachments and unpublished articles.
+
+    python -m benchmarks.corpus mw-xml 10000 corpus.xml
+
+Dumps can be compressed by adding .gz, .bz2 or .xz to the path. An XML dump named like *-multistream.xml.bz2 is
+written as a bz2 multistream dump with its index next to it, like Wikimedia's.
+
+Pages are generated from a seed, so the same arguments always give the same dump. Dumps are written as they are
+generated, so memory use doesn't grow with the number of pages.
+"""
+import argparse
+import bz2
+import random
+import re
+from typing import BinaryIO, Dict, Iterator, List, TextIO
+from xml.sax.saxutils import escape, unescape
+
+from db2md.compression import multistream_pattern, openers, split_compression
+
+formats = {"mw-xml": ".xml", "mw-sql": ".sql", "wp-sql": ".sql", "jl-sql": ".sql"}
+
+words = (
+    "lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor incididunt ut labore et dolore "
+    "magna aliqua enim ad minim veniam quis nostrud exercitation ullamco laboris nisi aliquip ex ea commodo "
+    "consequat duis aute irure in reprehenderit voluptate velit esse cillum fugiat nulla pariatur excepteur sint "
+    "occaecat cupidatat non proident sunt culpa qui officia deserunt mollit anim id est laborum över ändå Ϡ"
+).split()
+users = ["Ymir", "Kalle", "Anna Svensson", "Bot", "Åsa"]
+namespaces = ["Category", "Kategori", "Mall", "Template", "User", "Användare", "Help"]
+
+
+class Corpus:
+    """Generates pages for a synthetic dump.
+
+    Args:
+        pages (int): number of pages
+        seed (int, optional): random seed. Defaults to 1.
+    """
+
+    def __init__(self, pages: int, seed: int = 1):
+        self.pages = pages
+        self.seed = seed
+
+    def title(self, i: int) -> str:
+        # Unique per page, except every 500th that only differs in case from the one before
+        if i % 500 == 499:
+            return self.title(i - 1).upper()
+        return f"{random.Random(self.seed * 1000003 + i).choice(words).capitalize()} {i}"
+
+    def link_title(self, rnd: random.Random) -> str:
+        return self.title(rnd.randrange(self.pages))
+
+    def text(self, rnd: random.Random, n: int) -> str:
+        return " ".join(rnd.choice(words) for _ in range(n))
+
+    def documents(self) -> Iterator[Dict]:
+        """Yields the pages, with text in both Mediawiki and HTML markup, to write in either type of dump."""
+        for i in range(self.pages):
+            rnd = random.Random(self.seed * 7919 + i)
+            title = self.title(i)
+            if rnd.random() < 0.1:
+                target = self.link_title(rnd)
+                wiki, html = f"#REDIRECT [[{target}]]", f'<p>Moved to <a href="/{target}">{target}</a></p>'
+            else:
+                # About 1 in 1000 pages is very long
+                sections = rnd.randint(1, 6) if rnd.random() > 0.001 else rnd.randint(300, 600)
+                wiki, html = zip(*(self.section(rnd, s) for s in range(sections)))
+                wiki, html = "\n\n".join(wiki), "\n".join(html)
+            yield {
+                "id": i + 1,
+                "title": title,
+                "timestamp": f"20{10 + i % 12:02}-{1 + i % 12:02}-{1 + i % 28:02}T{i % 24:02}:{i % 60:02}:00Z",
+                "user_id": i % len(users) + 1,
+                "wiki": wiki,
+                "html": html,
+            }
+
+    def section(self, rnd: random.Random, n: int):
+        # One heading and a few blocks, as a pair of Mediawiki and HTML text
+        heading = self.text(rnd, rnd.randint(1, 4)).capitalize()
+        level = rnd.choice((2, 2, 3, 4))
+        wiki = [f"{'=' * level} {heading} {'=' * level}"]
+        html = [f"<h{level}>{heading}</h{level}>"]
+        for _ in range(rnd.randint(1, 5)):
+            kind = rnd.random()
+            if kind < 0.5:
+                w, h = self.paragraph(rnd)
+            elif kind < 0.65:
+                items = [self.paragraph(rnd, 8) for _ in range(rnd.randint(2, 6))]
+                w = "\n".join(f"{rnd.choice(('*', '#'))} {w}" for w, _ in items)
+                h = "<ul>" + "".join(f"<li>{h}</li>" for _, h in items) + "</ul>"
+            elif kind < 0.75:
+                w, h = self.table(rnd)
+            elif kind < 0.85:
+                image, caption = f"{rnd.choice(words)}_{rnd.randrange(100)}.jpg", self.text(rnd, 3)
+                w = f"[[{rnd.choice(('File', 'Image', 'Fil', 'Bild'))}:{image}|thumb|{caption}]]"
+                h = f'<p><img src="/uploads/{image}" title="{caption}" class="alignright size-full" /></p>'
+            elif kind < 0.9:
+                w = h = f"<pre>{self.text(rnd, 12)}</pre>"
+            else:
+                w, h = self.paragraph(rnd)
+                w, h = f"'''{w}'''<br>", f"<p><strong>{h}</strong><br /></p>"
+            wiki.append(w)
+            html.append(h)
+        return "\n\n".join(wiki), "\n".join(html)
+
+    def paragraph(self, rnd: random.Random, n: int = 60):
+        wiki, html = [], []
+        for _ in range(rnd.randint(n // 4, n)):
+            word = rnd.choice(words)
+            kind = rnd.random()
+            if kind < 0.85:
+                wiki.append(word)
+                html.append(word)
+            elif kind < 0.89:
+                wiki.append(f"''{word}''")
+                html.append(f"<em>{word}</em>")
+            elif kind < 0.92:
+                wiki.append(f"'''{word}'''")
+                html.append(f"<strong>{word}</strong>")
+            elif kind < 0.96:
+                target = self.link_title(rnd)
+                wiki.append(f"[[{target}|{word}]]" if rnd.random() < 0.5 else f"[[{target}]]")
+                html.append(f'<a href="/{target}">{word}</a>')
+            elif kind < 0.98:
+                ns = rnd.choice(namespaces)
+                wiki.append(f"[[{ns}:{word.capitalize()}]]")
+                html.append(f'<a href="/{ns}:{word}">{word}</a>')
+            else:
+                url = f"https://example.com/{word}?page={rnd.randrange(100)}"
+                wiki.append(f"[{url} {word}]")
+                html.append(f'<a href="{url}">{word}</a>')
+        return " ".join(wiki), "<p>" + " ".join(html) + "</p>"
+
+    def table(self, rnd: random.Random):
+        columns = rnd.randint(2, 5)
+        rows = [[self.text(rnd, rnd.randint(1, 3)) for _ in range(columns)] for _ in range(rnd.randint(2, 8))]
+        wiki = '{| class="wikitable"\n! ' + " !! ".join(rows[0])
+        wiki += "".join("\n|-\n| " + " || ".join(row) for row in rows[1:]) + "\n|}"
+        html = "<table><tr>" + "".join(f"<th>{c}</th>" for c in rows[0]) + "</tr>"
+        html += "".join("<tr>" + "".join(f"<td>{c}</td>" for c in row) + "</tr>" for row in rows[1:]) + "</table>"
+        return wiki, html
+
+
+def sql_string(s: str) -> str:
+    # Escaped as by mysqldump
+    s = s.replace("\\", "\\\\").replace("'", "\\'").replace("\n", "\\n").replace("\r", "\\r")
+    return f"'{s}'"
+
+
+def write_inserts(f: TextIO, table: str, rows: Iterator[tuple], per_statement: int = 100):
+    # Extended inserts with many rows per statement, like mysqldump
+    batch = []
+    for row in rows:
+        batch.append("(" + ",".join(str(v) if isinstance(v, int) else sql_string(v) for v in row) + ")")
+        if len(batch) == per_statement:
+            f.write(f"INSERT INTO `{table}` VALUES {','.join(batch)};\n")
+            batch = []
+    if batch:
+        f.write(f"INSERT INTO `{table}` VALUES {','.join(batch)};\n")
+
+
+def write_mediawiki_xml(corpus: Corpus, f: TextIO):
+    f.write('<mediawiki xmlns="http://www.mediawiki.org/xml/export-0.10/" version="0.10" xml:lang="sv">\n')
+    for doc in corpus.documents():
+        f.write(
+            f"  <page>\n    <title>{escape(doc['title'])}</title>\n    <ns>0</ns>\n    <id>{doc['id']}</id>\n"
+            f"    <revision>\n      <id>{doc['id']}</id>\n      <timestamp>{doc['timestamp']}</timestamp>\n"
+            f"      <contributor>\n        <username>{escape(users[doc['user_id'] - 1])}</username>\n"
+            f"        <id>{doc['user_id']}</id>\n      </contributor>\n"
+            f"      <text xml:space=\"preserve\">{escape(doc['wiki'])}</text>\n    </revision>\n  </page>\n"
+        )
+    f.write("</mediawiki>\n")
+
+
+def write_mediawiki_sql(corpus: Corpus, f: TextIO):
+    # The tables and columns of https://www.mediawiki.org/wiki/Manual:Database_layout that doc_generator reads
+    f.write(
+        "CREATE TABLE `user` (\n  `user_id` int(10) unsigned NOT NULL AUTO_INCREMENT,\n"
+        "  `user_name` varbinary(255) NOT NULL DEFAULT '',\n  PRIMARY KEY (`user_id`)\n"
+        ") ENGINE=InnoDB DEFAULT CHARSET=binary;\n"
+        "CREATE TABLE `page` (\n  `page_id` int(10) unsigned NOT NULL AUTO_INCREMENT,\n"
+        "  `page_namespace` int(11) NOT NULL,\n  `page_title` varbinary(255) NOT NULL,\n"
+        "  `page_latest` int(10) unsigned NOT NULL,\n  PRIMARY KEY (`page_id`)\n"
+        ") ENGINE=InnoDB DEFAULT CHARSET=binary;\n"
+        "CREATE TABLE `revision` (\n  `rev_id` int(10) unsigned NOT NULL AUTO_INCREMENT,\n"
+        "  `rev_page` int(10) unsigned NOT NULL,\n  `rev_text_id` int(10) unsigned NOT NULL,\n"
+        "  `rev_user` int(10) unsigned NOT NULL DEFAULT '0',\n  `rev_timestamp` binary(14) NOT NULL DEFAULT '',\n"
+        "  PRIMARY KEY (`rev_id`)\n) ENGINE=InnoDB DEFAULT CHARSET=binary;\n"
+        "CREATE TABLE `text` (\n  `old_id` int(10) unsigned NOT NULL AUTO_INCREMENT,\n"
+        "  `old_text` mediumblob NOT NULL,\n  PRIMARY KEY (`old_id`)\n) ENGINE=InnoDB DEFAULT CHARSET=binary;\n"
+    )
+    write_inserts(f, "user", ((i + 1, name) for i, name in enumerate(users)))
+    write_inserts(
+        f, "page", ((d["id"], 0, d["title"].replace(" ", "_"), d["id"]) for d in corpus.documents())
+    )
+    write_inserts(
+        f,
+        "revision",
+        ((d["id"], d["id"], d["id"], d["user_id"], d["timestamp"].translate(str.maketrans("", "", "-T:Z")))
+         for d in corpus.documents()),
+    )
+    write_inserts(f, "text", ((d["id"], d["wiki"]) for d in corpus.documents()), per_statement=20)
+
+
+def write_wordpress_sql(corpus: Corpus, f: TextIO):
+    f.write(
+        "CREATE TABLE `wp_users` (\n  `ID` bigint(20) unsigned NOT NULL AUTO_INCREMENT,\n"
+        "  `user_login` varchar(60) NOT NULL DEFAULT '',\n  `display_name` varchar(250) NOT NULL DEFAULT '',\n"
+        "  PRIMARY KEY (`ID`)\n) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;\n"
+        "CREATE TABLE `wp_posts` (\n  `ID` bigint(20) unsigned NOT NULL AUTO_INCREMENT,\n"
+        "  `post_author` bigint(20) unsigned NOT NULL DEFAULT '0',\n"
+        "  `post_date_gmt` datetime NOT NULL DEFAULT '0000-00-00 00:00:00',\n  `post_content` longtext NOT NULL,\n"
+        "  `post_title` text NOT NULL,\n  `post_status` varchar(20) NOT NULL DEFAULT 'publish',\n"
+        "  `post_modified_gmt` datetime NOT NULL DEFAULT '0000-00-00 00:00:00',\n"
+        "  `post_type` varchar(20) NOT NULL DEFAULT 'post',\n"
+        "  `post_parent` bigint(20) unsigned NOT NULL DEFAULT '0',\n  PRIMARY KEY (`ID`)\n"
+        ") ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;\n"
+    )
+    write_inserts(f, "wp_users", ((i + 1, name.lower(), name) for i, name in enumerate(users)))
+
+    def posts():
+        # Each post has a revision, every 10th an attachment and every 25th a draft, with IDs after the posts
+        n = corpus.pages
+        for d in corpus.documents():
+            id, date, html = d["id"], d["timestamp"].replace("T", " ").rstrip("Z"), d["html"]
+            yield id, d["user_id"], date, html, d["title"], "publish", date, "page" if id % 5 else "post", 0
+            yield n + id, d["user_id"], date, html[: len(html) // 2], d["title"], "inherit", date, "revision", id
+            if id % 10 == 0:
+                yield 2 * n + id, d["user_id"], date, "", f"image-{id}", "inherit", date, "attachment", id
+            if id % 25 == 0:
+                yield 3 * n + id, d["user_id"], date, html, f"Draft {d['title']}", "draft", date, "post", 0
+
+    write_inserts(f, "wp_posts", posts(), per_statement=20)
+
+
+def write_joomla_sql(corpus: Corpus, f: TextIO):
+    f.write(
+        "CREATE TABLE `jos_users` (\n  `id` int(11) NOT NULL AUTO_INCREMENT,\n"
+        "  `name` varchar(255) NOT NULL DEFAULT '',\n  `username` varchar(150) NOT NULL DEFAULT '',\n"
+        "  PRIMARY KEY (`id`)\n) ENGINE=MyISAM DEFAULT CHARSET=utf8;\n"
+        "CREATE TABLE `jos_content` (\n  `id` int(11) unsigned NOT NULL AUTO_INCREMENT,\n"
+        "  `title` varchar(255) NOT NULL DEFAULT '',\n  `introtext` mediumtext NOT NULL,\n"
+        "  `fulltext` mediumtext NOT NULL,\n  `state` tinyint(3) NOT NULL DEFAULT '0',\n"
+        "  `created` datetime NOT NULL DEFAULT '0000-00-00 00:00:00',\n"
+        "  `created_by` int(11) unsigned NOT NULL DEFAULT '0',\n"
+        "  `modified` datetime NOT NULL DEFAULT '0000-00-00 00:00:00',\n  PRIMARY KEY (`id`)\n"
+        ") ENGINE=MyISAM DEFAULT CHARSET=utf8;\n"
+    )
+    # The last user is deleted, leaving their articles without an author
+    write_inserts(f, "jos_users", ((i + 1, name, name.lower()) for i, name in enumerate(users[:-1])))
+
+    def articles():
+        # Every 3rd article is never modified, every 7th archived, and every 10th has an unpublished or trashed copy
+        n = corpus.pages
+        for d in corpus.documents():
+            id, date, html = d["id"], d["timestamp"].replace("T", " ").rstrip("Z"), d["html"]
+            cut = html.find("\n") if "\n" in html else len(html)
+            intro, rest = html[:cut], html[cut:]
+            modified = "0000-00-00 00:00:00" if id % 3 == 0 else date
+            yield id, d["title"], intro, rest, -1 if id % 7 == 0 else 1, date, d["user_id"], modified
+            if id % 10 == 0:
+                yield n + id, f"Copy of {d['title']}", intro, rest, -2 if id % 20 else 0, date, d["user_id"], date
+
+    write_inserts(f, "jos_content", articles(), per_statement=20)
+
+
+writers = {
+    "mw-xml": write_mediawiki_xml,
+    "mw-sql": write_mediawiki_sql,
+    "wp-sql": write_wordpress_sql,
+    "jl-sql": write_joomla_sql,
+}
+
+
+class MultistreamWriter:
+    """Takes the writes of write_mediawiki_xml, one per page, and writes them as a bz2 multistream dump, with a
+    stream for the header, every pages_per_stream pages and the footer. Each page gets an "offset:id:title" line in
+    the index, where offset is that of its stream.
+    """
+
+    page_pattern = re.compile(r"  <page>\n    <title>(?P<title>.*)</title>\n.*?<id>(?P<id>\d+)</id>", flags=re.DOTALL)
+
+    def __init__(self, f: BinaryIO, index: TextIO, pages_per_stream: int = 100):
+        self.f = f
+        self.index = index
+        self.pages_per_stream = pages_per_stream
+        self.pages: List[str] = []
+
+    def write(self, s: str):
+        if self.page_pattern.match(s):
+            self.pages.append(s)
+            if len(self.pages) >= self.pages_per_stream:
+                self.flush()
+        else:
+            self.flush()
+            self.f.write(bz2.compress(s.encode("utf-8")))
+
+    def flush(self):
+        if self.pages:
+            offset = self.f.tell()
+            for page in self.pages:
+                match = self.page_pattern.match(page)
+                self.index.write(f"{offset}:{match.group('id')}:{unescape(match.group('title'))}\n")
+            self.f.write(bz2.compress("".join(self.pages).encode("utf-8")))
+            self.pages = []
+
+
+def write_dump(format: str, pages: int, path: str, seed: int = 1):
+    """Writes a synthetic dump.
+
+    Args:
+        format (str): one of formats, e.g. "mw-xml"
+        pages (int): number of pages
+        path (str): file to write, with the extension that doc_generator expects for the format, optionally followed
+            by a compression suffix
+        seed (int, optional): random seed. Defaults to 1.
+    """
+    assert format in writers, f"Unknown format {format}, should be one of {', '.join(writers)}"
+    base, compression = split_compression(path)
+    assert base.endswith(formats[format]), f"A {format} dump has to end with {formats[format]}"
+    if format == "mw-xml" and (match := multistream_pattern.match(path)):
+        with open(path, "wb") as f, bz2.open(match.group("base") + "-index.txt.bz2", "wt", encoding="utf-8") as index:
+            multistream = MultistreamWriter(f, index)
+            writers[format](Corpus(pages, seed), multistream)  # type: ignore
+            multistream.flush()
+    else:
+        with openers.get(compression or "", open)(path, "wt", encoding="utf-8") as f:  # type: ignore
+            writers[format](Corpus(pages, seed), f)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("format", choices=list(writers))
+    parser.add_argument("pages", type=int)
+    parser.add_argument("path")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    write_dump(args.format, args.pages, args.path, args.seed)
+
+
+if __name__ == "__main__":
+    main()
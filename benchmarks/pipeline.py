@@ -0,0 +1,183 @@
+"""Benchmark of the conversion pipeline on synthetic dumps, timing each stage separately.
+
+    python -m benchmarks.pipeline --pages 1000 10000 --formats mw-xml wp-sql --output results.json
+
+Each case is converted by job_doc_to_markdown in a ConversionBatch, as convert does, and the stages are those timed
+in the jobs (see db2md/profiling.py): the regex fixes before and after Pandoc, the Pandoc read (in chunks, as
+prefetch_pandoc does) and write, the filters and writing the files, after reading the dump. Reports docs/sec and
+MB/sec per stage, where MB is the size of the page texts (the dump file for read_dump), and the peak
+RSS of each case, which runs in its own process. Dumps are generated once into the corpus dir (see
+benchmarks/corpus.py) and reused.
+
+Results are written as JSON with --output, and can be compared with results from an earlier release with --compare.
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import tempfile
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterable, Iterator, List
+
+from db2md import profiling
+from db2md.batch import JobSuccess
+from db2md.main import ConversionBatch, doc_generator, job_doc_to_markdown, prefetch_pandoc
+from db2md.pandoc_driver import PandocDriver
+from db2md.profiling import job_times
+
+from .corpus import formats, write_dump
+
+# Reading the dump, then the stages of job_doc_to_markdown
+stages = ("read_dump", *profiling.stages)
+
+
+def peak_rss_mb(who: int) -> float:
+    return resource.getrusage(who).ru_maxrss / 1024  # In kB on Linux
+
+
+def corpus_path(corpus_dir: str, format: str, pages: int, seed: int) -> str:
+    path = os.path.join(corpus_dir, f"{format}-{pages}-{seed}{formats[format]}")
+    if not os.path.exists(path):
+        os.makedirs(corpus_dir, exist_ok=True)
+        write_dump(format, pages, path + ".tmp" + formats[format], seed)
+        os.replace(path + ".tmp" + formats[format], path)
+    return path
+
+
+def run_case(format: str, pages: int, path: str, chunk_size: int) -> Dict:
+    """Converts a dump with job_doc_to_markdown, as convert does in one process, and sums up the time of each stage
+    from the stage times of the jobs.
+
+    Args:
+        format (str): dump format, e.g. "mw-xml"
+        pages (int): number of pages in the dump
+        path (str): the dump file
+        chunk_size (int): documents per Pandoc read
+
+    Returns:
+        Dict: result of the case, with seconds, docs/sec and MB/sec per stage
+    """
+    pandoc = PandocDriver(chunk_size=chunk_size)
+    pandoc.version, pandoc.api_version  # Not part of any stage
+    out_folder = tempfile.mkdtemp(prefix="db2md-benchmark-")
+    # Without a writer in the context the files are written by the jobs, so that write_file is timed in full
+    batch = ConversionBatch("Benchmark", all_pages={}, pandoc=pandoc, out_folder=out_folder, log_level="ERROR")
+    text_bytes = 0
+
+    def count_text(generator: Iterable) -> Iterator:
+        nonlocal text_bytes
+        for data in generator:
+            text_bytes += len((data.get("text/x-wiki", "") or data.get("text/html", "")).encode("utf-8"))
+            yield data
+
+    start = time.perf_counter()
+    try:
+        batch.process(prefetch_pandoc(count_text(batch.read(doc_generator(path))), pandoc), job_doc_to_markdown)
+    finally:
+        shutil.rmtree(out_folder, ignore_errors=True)
+    seconds = time.perf_counter() - start
+    stage_seconds = Counter(batch.seconds)
+    for job in batch.jobs:
+        stage_seconds.update(job_times(job).seconds)
+    docs = sum(job.success != JobSuccess.SKIP for job in batch.jobs)
+    failed = sum(job.success == JobSuccess.FAIL for job in batch.jobs)
+
+    dump_mb = os.path.getsize(path) / 1024 / 1024
+    result = {
+        "format": format,
+        "pages": pages,
+        "docs": docs,
+        "failed": failed,
+        "dump_mb": round(dump_mb, 2),
+        "text_mb": round(text_bytes / 1024 / 1024, 2),
+        "seconds": round(seconds, 3),
+        "docs_per_sec": round(docs / seconds, 1),
+        "peak_rss_mb": round(peak_rss_mb(resource.RUSAGE_SELF), 1),
+        "pandoc_peak_rss_mb": round(peak_rss_mb(resource.RUSAGE_CHILDREN), 1),
+        "stages": {},
+    }
+    for stage in stages:
+        s = max(stage_seconds[stage], 1e-9)
+        mb = dump_mb if stage == "read_dump" else text_bytes / 1024 / 1024
+        result["stages"][stage] = {
+            "seconds": round(s, 3),
+            "docs_per_sec": round(docs / s, 1),
+            "mb_per_sec": round(mb / s, 2),
+        }
+    return result
+
+
+def git_revision() -> str:
+    try:
+        cwd = os.path.dirname(os.path.abspath(__file__))
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"], cwd=cwd, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def format_result(result: Dict, baseline: Dict = None) -> str:
+    lines = [
+        f"{result['format']} {result['pages']} pages ({result['dump_mb']} MB dump): {result['docs']} docs in "
+        f"{result['seconds']} s, {result['docs_per_sec']} docs/sec, peak RSS {result['peak_rss_mb']} MB "
+        f"(pandoc {result['pandoc_peak_rss_mb']} MB)"
+    ]
+    for stage, r in result["stages"].items():
+        line = f"  {stage:14} {r['seconds']:9.3f} s {r['docs_per_sec']:11.1f} docs/sec {r['mb_per_sec']:9.2f} MB/sec"
+        if baseline and stage in baseline["stages"]:
+            line += f"  {r['docs_per_sec'] / max(baseline['stages'][stage]['docs_per_sec'], 1e-9):5.2f}x baseline"
+        lines.append(line)
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pages", type=int, nargs="+", default=[1000], help="dump sizes, e.g. 1000 10000 1000000")
+    parser.add_argument("--formats", nargs="+", default=list(formats), choices=list(formats))
+    parser.add_argument("--corpus-dir", default=os.path.join(tempfile.gettempdir(), "db2md-corpus"))
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--chunk-size", type=int, default=100, help="documents per Pandoc read")
+    parser.add_argument("--output", help="JSON file to write results to")
+    parser.add_argument("--compare", help="JSON file with earlier results to compare with")
+    args = parser.parse_args()
+
+    baselines = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baselines = {(r["format"], r["pages"]): r for r in json.load(f)["results"]}
+    results: List[Dict] = []
+    for pages in args.pages:
+        for format in args.formats:
+            path = corpus_path(args.corpus_dir, format, pages, args.seed)
+            # A new process per case, so the peak RSS is of that case only
+            with ProcessPoolExecutor(1) as pool:
+                result = pool.submit(run_case, format, pages, path, args.chunk_size).result()
+            print(format_result(result, baselines.get((format, pages), None)), flush=True)
+            results.append(result)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(
+                {
+                    "db2md": git_revision(),
+                    "pandoc": PandocDriver().version,
+                    "python": platform.python_version(),
+                    "platform": platform.platform(),
+                    "cpus": os.cpu_count(),
+                    "created_at": datetime.datetime.now().isoformat(timespec="seconds"),
+                    "results": results,
+                },
+                f,
+                indent=2,
+            )
+
+
+if __name__ == "__main__":
+    main()
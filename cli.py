@@ -1,8 +1,31 @@
 import typer
 import os
 import json
-from db2md.batch import Batch, Column
-from db2md.main import doc_generator, job_doc_to_markdown
+import sys
+from contextlib import nullcontext
+from typing import List, Optional
+from db2md.batch import Column
+from db2md.cache import ConversionCache
+from db2md.main import (
+    ConversionBatch,
+    DocFilter,
+    doc_generator,
+    fail_unwritten,
+    job_doc_to_markdown,
+    job_doc_to_plain_markdown,
+    prefetch_pandoc,
+    utc_datetime,
+)
+from db2md.limits import JobLimits
+from db2md.pandoc_driver import PandocDriver
+from db2md.parallel import ParallelProcess
+from db2md.manifest import Manifest
+from db2md.profiling import JobProfiler
+from db2md.registry import open_registry
+from db2md.shards import Shards, job_merge_page, parse_shard, save_shard
+from db2md.titles import AliasFolder, TitleIndex
+from db2md.history import FastImportWriter, job_history_to_fast_import
+from db2md.writer import ArchiveWriter, BackgroundWriter, archive_mode
 
 app = typer.Typer()
 
@@ -14,27 +37,245 @@ def convert(
     log_level: str = "WARN", 
     extra_metadata: str = "", 
     dry_run: bool = False, 
-    no_metadata: bool = False):
+    no_metadata: bool = False,
+    pandoc_chunk_size: int = 100,
+    workers: int = 1,
+    manifest: bool = True,
+    cache: str = "",
+    cache_size_mb: int = 1024,
+    slowest: int = 10,
+    profile_over: float = 0,
+    profile_folder: str = "db2md-profiles",
+    check_links: bool = False,
+    background_writer: bool = True,
+    multistream_index: str = "",
+    history: bool = False,
+    sql_staging: bool = False,
+    native_sql: bool = False,
+    title_regex: str = "",
+    namespace: Optional[int] = None,
+    author: str = "",
+    created_since: str = "",
+    created_before: str = "",
+    updated_since: str = "",
+    updated_before: str = "",
+    max_size: Optional[int] = None,
+    fold_redirects: bool = False,
+    page_registry: str = "",
+    resume: bool = False,
+    doc_timeout: float = 0,
+    doc_memory_mb: int = 0,
+    plain_text_fallback: bool = False,
+    shard: str = "",
+    native_writer: bool = True,
+    native_check_every: int = 100):
+
+    # Documents not selected are skipped by the reader, before their text is decoded
+    selection = DocFilter(
+        filter,
+        title_regex,
+        namespace,
+        author,
+        *(utc_datetime(d) if d else None for d in (created_since, created_before, updated_since, updated_before)),
+        max_size,
+        # Only the pages whose ID hashes to shard i of n, e.g. to convert a source on n machines and then merge
+        shard=parse_shard(shard) if shard else None,
+    )
+
+    def read_source(selected=True):
+        # A bz2 multistream dump is decompressed in parallel with its index, given or found next to it. A SQL dump
+        # can be loaded once into an indexed SQLite file next to it, reused by later runs on the same dump, or read
+        # without SQLite by the native reader.
+        return doc_generator(
+            file,
+            index=multistream_index or None,
+            revisions=history,
+            staging=sql_staging,
+            native=native_sql,
+            selection=selection if selected else None,
+        )
+
+    # The pages written by ID, to tell documents with the same ID apart. Kept in a file if given, SQLite for a
+    # .sqlite file so that it's not held in memory, and continued from there if resuming an interrupted run.
+    all_pages = open_registry(page_registry, resume=resume)
 
     # No need, let user pick their exact folder instead
-    out_folder = os.path.abspath(out_folder)
+    out_folder = os.path.abspath(out_folder) if out_folder != "-" else out_folder
+    assert not (shard and (history or archive_mode(out_folder))), "Shards are only written to folders, to be merged"
 
     columns = [Column(header="Title", import_key="title"), Column(header="Path", result_key="path")]
     extra_metadata = json.loads(extra_metadata) if extra_metadata else {}
-    b = Batch(
-        f"Database to Markdown: {file}",
+    # An optional cache file of Pandoc conversions, that can be shared between runs
+    conversion_cache = ConversionCache(cache, max_bytes=cache_size_mb * 1024 * 1024) if cache else None
+    # Every pandoc process is killed if it goes over the memory limit, or the time limit per document it reads
+    # The native Markdown writer is checked against pandoc on every native_check_every-th document, and turned off
+    # for the rest of the run if they differ
+    pandoc = PandocDriver(
+        chunk_size=pandoc_chunk_size,
+        native_writer=native_writer,
+        check_every=native_check_every,
+        cache=conversion_cache,
+        timeout=doc_timeout or None,
+        max_memory_mb=doc_memory_mb or None,
+    )
+    if history:
+        # Every revision is converted into a git fast-import stream, written to out_folder or - for stdout
+        assert workers == 1, "History is converted in one process"
+        with open(out_folder, "wb") if out_folder != "-" else nullcontext(sys.stdout.buffer) as out:
+            fast_import = FastImportWriter(out)
+            b = ConversionBatch(
+                f"Database to git history: {file}",
+                table_columns=columns,
+                all_pages=all_pages,
+                pandoc=pandoc,
+                slowest=slowest,
+                log_level=log_level,
+                no_metadata=no_metadata,
+                extra_metadata=extra_metadata,
+                filter=filter,
+                out_folder=out_folder,
+                namespace=namespace,
+                history=fast_import,
+            )
+            try:
+                b.process(b.read(read_source()), job_history_to_fast_import)
+            finally:
+                all_pages.save()
+            fast_import.close()
+        print(b.summary_str(), file=sys.stderr)
+        return
+    # out_folder can also be a zip or tar archive to write into
+    is_archive = archive_mode(out_folder) is not None
+    writer = None
+    if is_archive:
+        writer = ArchiveWriter(out_folder)
+    elif background_writer:
+        # Files are written in a thread, while the next documents are converted
+        writer = BackgroundWriter()
+    # Redirects can be added as aliases to the pages they redirect to, instead of being written as their own files
+    assert not (fold_redirects and is_archive), "Redirects can't be folded into pages written to an archive"
+    alias_folder = AliasFolder() if fold_redirects and not dry_run else None
+    # Pages unchanged since the last run are skipped, unless the manifest is turned off. Archives are written anew.
+    page_manifest = None
+    if manifest and not dry_run and not is_archive:
+        page_manifest = Manifest(
+            out_folder, {"no_metadata": no_metadata, "extra_metadata": extra_metadata, "pandoc": pandoc.version}
+        )
+    settings = dict(
         log_level=log_level,
         dry_run=dry_run,
-        table_columns=columns,
         no_metadata=no_metadata,
         extra_metadata=extra_metadata,
         filter=filter,
-        all_pages={},
         out_folder=out_folder,
+        manifest=page_manifest,
+        # With an index of all titles, links to pages not in the source are logged, at the cost of reading it twice
+        titles=TitleIndex(read_source(selected=False)) if check_links else None,
+        writer=writer,
+        fold_redirects=fold_redirects,
+        # Pages in a namespace are only converted if it's selected
+        namespace=namespace,
+    )
+    b = ConversionBatch(
+        f"Database to Markdown: {file}",
+        table_columns=columns,
+        all_pages=all_pages,
+        pandoc=pandoc,
+        slowest=slowest,
+        **settings,
     )
-    b.process(doc_generator(file), job_doc_to_markdown)
-    print(b.summary_str())    
+    # Jobs slower than profile_over seconds get their cProfile and document saved, to look into on their own
+    job_fn = job_doc_to_markdown
+    if profile_over:
+        job_fn = JobProfiler(os.path.abspath(profile_folder), profile_over).track(job_fn)
+    # A document over the limits fails, or is written as plain text, without holding up the batch
+    if doc_timeout or doc_memory_mb:
+        degraded_fn = job_doc_to_plain_markdown if plain_text_fallback else None
+        job_fn = JobLimits(doc_timeout or None, degraded_fn).track(job_fn)
+    if workers > 1:
+        parallel = ParallelProcess(b, workers, pandoc, **settings)
+        generator, job_fn = parallel.run(b.read(read_source()), job_fn), parallel.replay_job
+    else:
+        generator = prefetch_pandoc(
+            b.read(read_source()), pandoc, filter=filter, manifest=page_manifest, namespace=namespace
+        )
+    if alias_folder:
+        job_fn = alias_folder.track(job_fn)
+    try:
+        b.process(generator, page_manifest.track(job_fn) if page_manifest else job_fn)
+    finally:
+        # Also if interrupted, so that the run can be resumed from the pages claimed so far
+        all_pages.save()
+    unwritten = []
+    if writer:
+        writer.close()
+        for path, error in writer.errors:
+            print(f"Could not write {path}: {error}")
+        # Pages whose files couldn't be written fail, and are left out of the manifest to be converted again
+        unwritten = fail_unwritten(b.jobs, writer.errors)
+        for job in unwritten if page_manifest else []:
+            page_manifest.remove(job.id)
+    if shard and not dry_run:
+        # Redirects are folded when merged, as the pages they redirect to can be in other shards
+        save_shard(out_folder, file, selection.shard, b, all_pages, alias_folder)
+    elif alias_folder:
+        if missing := alias_folder.fold(all_pages, out_folder):
+            print(f"{len(missing)} redirects to pages that were not written are left out: {', '.join(missing)}")
+    print(b.summary_str())
+    if page_manifest:
+        removed = page_manifest.finish(complete=not selection.active)
+        page_manifest.save()
+        if removed:
+            print(f"{len(removed)} pages no longer in the source since the last run: {', '.join(removed)}")
+    if unwritten:
+        raise typer.Exit(code=1)
+
+
+@app.command()
+def merge(
+    out_folder: str,
+    shard_folders: List[str],
+    log_level: str = "WARN",
+    dry_run: bool = False,
+    manifest: bool = True,
+    page_registry: str = ""):
+    """Merges the out_folders of convert --shard into one, applying the same rules as convert to pages with the same
+    ID in different shards, e.g. of different sources, and folding the redirects of all shards.
+    """
+    shards = Shards(shard_folders)
+    out_folder = os.path.abspath(out_folder)
+    all_pages = open_registry(page_registry)
+    # The hashes of the pages in the manifests of the shards are kept, so that later runs into out_folder skip them
+    page_manifest = Manifest(out_folder, {}) if manifest and not dry_run else None
+    b = ConversionBatch(
+        f"Merge shards into: {out_folder}",
+        table_columns=[Column(header="Title", import_key="title"), Column(header="Path", result_key="path")],
+        all_pages=all_pages,
+        log_level=log_level,
+        dry_run=dry_run,
+        out_folder=out_folder,
+    )
+    b.process(shards.pages(), page_manifest.track(job_merge_page) if page_manifest else job_merge_page)
+    all_pages.save()
+    if not dry_run:
+        if missing := shards.aliases().fold(all_pages, out_folder):
+            print(f"{len(missing)} redirects to pages that were not written are left out: {', '.join(missing)}")
+    print(shards.summary_str())
+    print(b.summary_str())
+    if page_manifest:
+        removed = page_manifest.finish()
+        page_manifest.save()
+        if removed:
+            print(f"{len(removed)} pages no longer in the shards since the last merge: {', '.join(removed)}")
+
+
+def main():
+    # convert is the default command, so that `cli.py FILE OUT_FOLDER` works as it did before merge was added
+    if len(sys.argv) > 1 and sys.argv[1] not in typer.main.get_command(app).commands:
+        if sys.argv[1] not in ("--help", "--install-completion", "--show-completion"):
+            sys.argv.insert(1, "convert")
+    app()
 
 
 if __name__ == "__main__":
-    app()
\ No newline at end of file
+    main()
\ No newline at end of file
@@ -0,0 +1,88 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+import zlib
+from collections import Counter
+from typing import Optional
+
+
+class ConversionCache:
+    """A persistent cache of Pandoc conversions in an SQLite file, that can be shared by worker processes and
+    between runs, e.g. when converting overlapping dumps. Entries are compressed, and the least recently used are
+    evicted when the total size goes above the byte budget.
+    """
+
+    def __init__(self, path: str, max_bytes: int = 1024 * 1024 * 1024):
+        self.path = os.path.abspath(path)
+        self.max_bytes = max_bytes
+        self.stats: Counter = Counter()  # Hits and misses, of this process
+        self._con: Optional[sqlite3.Connection] = None
+        self._size: Optional[int] = None  # Total size, as last known by this process
+
+    def __getstate__(self):
+        # Worker processes open their own connection
+        return {"path": self.path, "max_bytes": self.max_bytes}
+
+    def __setstate__(self, state):
+        self.__init__(state["path"], state["max_bytes"])
+
+    @property
+    def con(self) -> sqlite3.Connection:
+        if self._con is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._con = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            self._con.execute("PRAGMA journal_mode=WAL")
+            self._con.execute(
+                "CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value BLOB, size INTEGER, used REAL)"
+            )
+            self._con.execute("CREATE INDEX IF NOT EXISTS entries_used ON entries (used)")
+        return self._con
+
+    @staticmethod
+    def key(*parts) -> str:
+        return hashlib.sha1(json.dumps(parts, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        row = self.con.execute("SELECT value FROM entries WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.stats["misses"] += 1
+            return None
+        self.stats["hits"] += 1
+        self.con.execute("UPDATE entries SET used = ? WHERE key = ?", (time.time(), key))
+        return zlib.decompress(row[0]).decode("utf-8")
+
+    def put(self, key: str, value: str):
+        blob = zlib.compress(value.encode("utf-8"))
+        if len(blob) > self.max_bytes:
+            return
+        self.con.execute(
+            "INSERT OR REPLACE INTO entries (key, value, size, used) VALUES (?, ?, ?, ?)",
+            (key, blob, len(blob), time.time()),
+        )
+        if self._size is None:
+            self._size = self.con.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        else:
+            self._size += len(blob)
+        if self._size > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        # Other processes may have added entries too, so recount before removing the least recently used
+        self._size = self.con.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        target = self.max_bytes * 0.9  # Leave some room so we don't evict on every put
+        if self._size <= self.max_bytes:
+            return
+        removed = 0
+        for key, size in self.con.execute("SELECT key, size FROM entries ORDER BY used").fetchall():
+            if self._size - removed <= target:
+                break
+            self.con.execute("DELETE FROM entries WHERE key = ?", (key,))
+            removed += size
+        self._size -= removed
+
+    def summary_str(self) -> str:
+        hits, misses = self.stats["hits"], self.stats["misses"]
+        rate = f" ({hits / (hits + misses):.0%} hit rate)" if hits + misses else ""
+        return f"Conversion cache: {hits} hits, {misses} misses{rate}"
@@ -0,0 +1,561 @@
+"""A native writer for the subset of the Pandoc AST that our filters produce, giving the same text as
+`pandoc -t commonmark_x-implicit_figures-raw_attribute-smart --wrap=none --reference-links --standalone`
+after it has passed through panflute.convert_text. It follows the Pandoc Markdown writer (as used for commonmark_x)
+and anything it's not sure to render exactly the same raises Unsupported, so that the caller can fall back to Pandoc.
+
+The rules were worked out against Pandoc 2.19, and other Pandoc versions render some of these differently, which
+is why PandocDriver compares the first documents it writes with Pandoc's output before trusting it.
+"""
+
+import re
+import unicodedata
+from typing import Dict, List, Optional, Set, Tuple
+
+import panflute as pf
+from panflute.elements import Doc
+
+# The Pandoc output format and arguments that the native writer produces output for
+output_format = "commonmark_x-implicit_figures-raw_attribute-smart"
+extra_args = ("--wrap=none", "--reference-links")
+
+# Characters that Pandoc always backslash escapes in text for commonmark_x
+always_escaped = set("*[]`|^~$<>")
+# A word starting a paragraph that Pandoc escapes as it would otherwise start an ordered list
+list_marker_pattern = re.compile(r"(?P<open>\()?(?P<num>[0-9]+|[A-Za-z]+)(?P<delim>[.)])")
+roman_pattern = re.compile(r"m{0,4}(cm|cd|d?c{0,3})(xc|xl|l?x{0,3})(ix|iv|v?i{0,3})")
+html_formats = {"html", "html4", "html5"}
+markdown_formats = {"markdown", "commonmark", "commonmark_x", "gfm", "markdown_strict", "markdown_mmd", "markdown_phpextra"}
+# YAML scalars Pandoc quotes for other reasons than their characters, we leave them to Pandoc
+yaml_keywords = {"y", "n", "yes", "no", "true", "false", "on", "off", "null"}
+yaml_quote_first = set(",?!&%@{}:'-")
+ascii_punctuation = set("!\"#$%&'()*+,-./:;<=>?@[\\]^_`{|}~")
+# A header identifier we can write as {#id} without further escaping
+plain_identifier = re.compile(r"[\w.:-]+")
+autolink_pattern = re.compile(r"((https?|ftp)://|mailto:)[A-Za-z0-9\-._~:/?#\[\]@!$&'()*+,;=%]+")
+# A word that Pandoc keeps on the line of the word before, with the space kept as is, as it could start a list
+bad_wrap_pattern = re.compile(r"[-+]|[0-9]+[.)]")
+
+
+class Unsupported(Exception):
+    """Raised when the document has something the native writer can't render exactly like Pandoc."""
+
+
+def escape_text(s: str) -> str:
+    out = []
+    i = 0
+    n = len(s)
+    while i < n:
+        c = s[i]
+        if c in always_escaped:
+            out.append("\\" + c)
+        elif c == "\\":
+            # Only escaped when it could escape what follows
+            out.append("\\\\" if i + 1 == n or s[i + 1] in ascii_punctuation else c)
+        elif c == "#":
+            out.append("\\#" if i == 0 else c)
+        elif c == "_":
+            out.append("\\_")
+        elif unicodedata.category(c) in ("Cc", "Cf", "Zl", "Zp"):
+            raise Unsupported(f"Control character {c!r} in text")
+        elif i + 2 < n and s[i + 1] == "_" and c.isalnum() and s[i + 2].isalnum():
+            # Intraword underscore is kept, and Pandoc moves on after the character following it
+            out.append(s[i : i + 3])
+            i += 2
+        else:
+            out.append(c)
+        i += 1
+    return "".join(out)
+
+
+def escape_list_marker(s: str) -> Optional[str]:
+    """Returns the escaped version of a word that Pandoc would take as an ordered list marker at the start of a
+    paragraph, or None if it's not a marker.
+    """
+    match = list_marker_pattern.fullmatch(s)
+    if not match:
+        return None
+    num, delim = match.group("num"), match.group("delim")
+    if match.group("open") and delim == ".":
+        raise Unsupported(f"Ambiguous list marker {s}")
+    if num.isdigit():
+        if len(num) > 9:
+            return None
+    elif len(num) == 1:
+        if num.isupper() and delim == "." and not match.group("open"):
+            return None  # Upper case letter with period needs two spaces to be a list marker
+    elif not (num.islower() and roman_pattern.fullmatch(num)) and not (
+        num.isupper() and delim == ")" and roman_pattern.fullmatch(num.lower())
+    ):
+        raise Unsupported(f"Ambiguous list marker {s}")
+    return re.sub(r"([.()])", r"\\\1", s)
+
+
+def text_width(s: str) -> int:
+    for c in s:
+        if unicodedata.east_asian_width(c) in ("W", "F") or unicodedata.combining(c):
+            raise Unsupported(f"Character of unusual width {c!r} in table")
+    return len(s)
+
+
+def indent(text: str, first: str, rest: str) -> str:
+    lines = text.split("\n")
+    return "\n".join([first + lines[0]] + [rest + line if line else rest.rstrip() for line in lines[1:]])
+
+
+def stringify(elems) -> str:
+    # Same as Pandoc's stringify, used for header identifiers
+    out = []
+
+    def action(elem, doc):
+        if isinstance(elem, (pf.Str, pf.Code)):
+            out.append(elem.text)
+        elif isinstance(elem, (pf.Space, pf.SoftBreak, pf.LineBreak)):
+            out.append(" ")
+        elif isinstance(elem, pf.RawInline) and elem.format == "html" and elem.text.startswith("<br"):
+            out.append(" ")
+
+    for elem in elems:
+        elem.walk(action)
+    return "".join(out)
+
+
+def auto_identifier(elems, used: Set[str]) -> str:
+    # Pandoc uses the GFM style of identifiers when writing commonmark_x
+    s = stringify(elems).lower()
+    s = "".join(
+        "-" if c.isspace() else c
+        for c in s
+        if c.isspace() or c.isalnum() or c == "-" or unicodedata.category(c) in ("Mn", "Mc", "Me", "Pc")
+    )
+    base = s or "section"
+    if base not in used:
+        return base
+    i = 1
+    while f"{base}-{i}" in used:
+        i += 1
+    return f"{base}-{i}"
+
+
+def link_key(label: str) -> str:
+    if label.startswith("[") and label.endswith("]"):
+        label = label[1:-1]
+    return " ".join(label.split()).lower()
+
+
+# Space between words, which like in Pandoc is dropped at the start and end of lines, and collapsed when repeated
+SPACE = "\x00"
+space_run = re.compile(f"{SPACE}+")
+edge_spaces = re.compile(f"^{SPACE}+|{SPACE}+$", flags=re.MULTILINE)
+
+
+def finish(text: str) -> str:
+    return space_run.sub(" ", edge_spaces.sub("", text))
+
+
+# A rendered block and what must separate it from the next: a blank line, a line break, or nothing (raw content
+# that already ends with its own newline)
+Rendered = Tuple[str, str]
+BLANK, CR, RAW = "blank", "cr", "raw"
+
+
+def join_blocks(rendered: List[Rendered]) -> Rendered:
+    text = ""
+    end = RAW
+    for t, e in rendered:
+        if not t:
+            continue  # Empty blocks leave no trace, not even their blank line
+        if text:
+            text = ensure_newlines(text, {BLANK: 2, CR: 1, RAW: 0}[end])
+        text += t
+        end = e
+    return text, end
+
+
+def ensure_newlines(text: str, count: int) -> str:
+    # Like Pandoc's layout engine, a break is only added where the text doesn't already end with one
+    trailing = len(text) - len(text.rstrip("\n"))
+    return text + "\n" * max(0, count - trailing)
+
+
+class CommonmarkWriter:
+    def __init__(self):
+        self.refs: List[Tuple[str, Tuple[str, str]]] = []  # Label and target, in order of appearance
+        self.keys: Dict[str, Dict[Tuple[str, str], int]] = {}
+        self.last_idx = 0
+        self.ids: Set[str] = set()
+
+    def write(self, doc: Doc) -> str:
+        body, _ = self.blocks(doc.content, in_list=False)
+        body = body.rstrip("\n")
+        if self.refs:
+            refs = "\n".join(
+                f"  [{label}]: {src}".rstrip() + (f' "{title}"' if title else "") for label, (src, title) in self.refs
+            )
+            body = f"{body}\n\n{refs}" if body else refs
+        meta = self.metadata(doc.metadata)
+        if meta:
+            # Only a document without any blocks keeps the blank line after the metadata block
+            text = f"{meta}\n\n{body}\n" if body else f"{meta}\n" if doc.content else f"{meta}\n\n"
+        else:
+            text = body + "\n"
+        # Do what panflute.convert_text does with Pandoc's output
+        return "\n".join(text.splitlines())
+
+    # METADATA
+
+    def metadata(self, metadata: pf.MetaMap) -> str:
+        lines = []
+        for key in sorted(metadata.content.keys()):
+            value = metadata.content[key]
+            if isinstance(value, pf.MetaList):
+                items = [self.meta_string(v) for v in value.content]
+                items = [v for v in items if v]
+                if items:
+                    lines.append(f"{key}:")
+                    lines += [f"- {v}" for v in items]
+            elif v := self.meta_string(value):
+                lines.append(f"{key}: {v}")
+        return "---\n" + "\n".join(lines) + "\n---" if lines else ""
+
+    def meta_string(self, value) -> str:
+        if isinstance(value, pf.MetaBool):
+            return "true" if value.boolean else "false"
+        if not isinstance(value, pf.MetaString):
+            raise Unsupported(f"Metadata of type {type(value).__name__}")
+        s = value.text
+        if not s:
+            return ""
+        if (
+            s != s.strip(" ")
+            or re.search(r"\s\s|[^\S ]", s)
+            or escape_text(s) != s
+            or s.lower() in yaml_keywords
+            or s.startswith('"')
+            or escape_list_marker(s.split(" ")[0]) is not None
+            or s in ("+", "-")
+            or "\\" in s
+        ):
+            raise Unsupported(f"Metadata value {s!r}")
+        if s[0] in yaml_quote_first or ":" in s or "#" in s:
+            return f'"{s}"'
+        return s
+
+    # BLOCKS
+
+    def blocks(self, blocks, in_list: bool) -> Rendered:
+        blocks = list(blocks)
+        fixed = []
+        for i, b in enumerate(blocks):
+            nxt = blocks[i + 1] if i + 1 < len(blocks) else None
+            if isinstance(b, pf.Plain) and not in_list and not isinstance(nxt, pf.RawBlock):
+                b = pf.Para(*b.content)
+            fixed.append(b)
+            if nxt is not None and (
+                (isinstance(nxt, pf.CodeBlock) and self.is_list(b))
+                or (type(b) == type(nxt) and self.is_list(b))
+            ):
+                fixed.append(pf.RawBlock("<!-- -->\n", format="html"))
+        rendered = []
+        for i, b in enumerate(fixed):
+            if isinstance(b, pf.RawBlock):
+                nxt = fixed[i + 1] if i + 1 < len(fixed) else None
+                text = b.text
+                if text and not text.endswith("\n") and nxt and not isinstance(nxt, (pf.Plain, pf.RawBlock)):
+                    text += "\n"
+                rendered.append(self.raw_block(b, text))
+            elif not isinstance(b, pf.Null):
+                rendered.append(self.block(b, in_list))
+        return join_blocks(rendered)
+
+    @staticmethod
+    def is_list(b) -> bool:
+        return isinstance(b, (pf.BulletList, pf.OrderedList, pf.DefinitionList))
+
+    def raw_block(self, b: pf.RawBlock, text: str) -> Rendered:
+        if b.format not in html_formats:
+            raise Unsupported(f"RawBlock in {b.format}")
+        return text + "\n", RAW
+
+    def block(self, b, in_list: bool) -> Rendered:
+        if isinstance(b, pf.Plain):
+            return self.plain(b.content), CR
+        elif isinstance(b, pf.Para):
+            return self.plain(b.content), BLANK
+        elif isinstance(b, pf.Header):
+            return self.header(b), BLANK
+        elif isinstance(b, pf.BulletList):
+            return self.bullet_list(b), BLANK
+        elif isinstance(b, pf.OrderedList):
+            return self.ordered_list(b), BLANK
+        elif isinstance(b, pf.DefinitionList):
+            return self.definition_list(b), BLANK
+        elif isinstance(b, pf.BlockQuote):
+            text, _ = self.blocks(b.content, in_list=False)
+            text = text.rstrip("\n")
+            if not text and b.content:
+                raise Unsupported("BlockQuote with empty content")
+            return indent(text, "> ", "> ") if text else "", BLANK
+        elif isinstance(b, pf.CodeBlock):
+            if b.identifier or b.classes or b.attributes:
+                raise Unsupported("CodeBlock with attributes")
+            return indent(b.text, "    ", "    ") if b.text else "", BLANK
+        elif isinstance(b, pf.HorizontalRule):
+            return "-" * 72, BLANK
+        elif isinstance(b, pf.Table):
+            return self.table(b), BLANK
+        raise Unsupported(f"Block {type(b).__name__}")
+
+    def plain(self, inlines) -> str:
+        return finish(self.plain_spaced(inlines))
+
+    def plain_spaced(self, inlines) -> str:
+        # The text of a paragraph before its spaces are collapsed and dropped at the ends of lines
+        inlines = list(inlines)
+        prefix = ""
+        if inlines and isinstance(inlines[0], pf.Str):
+            first = inlines[0].text
+            rest = inlines[1:]
+            if not rest or isinstance(rest[0], (pf.Space, pf.SoftBreak)):
+                if (escaped := escape_list_marker(first)) is not None:
+                    return escaped + self.inlines(rest)
+            if first in ("+", "-"):
+                prefix = "\\"
+        return prefix + self.inlines(inlines)
+
+    def header(self, b: pf.Header) -> str:
+        if b.classes or b.attributes:
+            raise Unsupported("Header with attributes")
+        auto_id = auto_identifier(b.content, self.ids)
+        self.ids.add(auto_id)
+        attr = ""
+        if b.identifier and b.identifier != auto_id:
+            if not plain_identifier.fullmatch(b.identifier):
+                raise Unsupported(f"Header identifier {b.identifier}")
+            attr = f" {{#{b.identifier}}}"
+        if any(isinstance(e, pf.LineBreak) for e in self.descendants(b)):
+            raise Unsupported("Header with line break")
+        # Unlike in paragraphs, Pandoc keeps all spaces in headings
+        return "#" * b.level + " " + self.inlines(b.content).replace(SPACE, " ") + attr
+
+    @staticmethod
+    def check_leading_space(inlines):
+        # Pandoc keeps a space at the start of text that is nested in list items, definitions and table cells
+        if inlines and isinstance(inlines[0], (pf.Space, pf.SoftBreak)):
+            raise Unsupported("Nested text starting with a space")
+
+    def list_items(self, items, starts: List[str], widths: List[int]) -> str:
+        tight = all(not item.content or isinstance(item.content[0], pf.Plain) for item in items)
+        rendered = []
+        for item, start, width in zip(items, starts, widths):
+            first = item.content[0] if item.content else None
+            if isinstance(first, pf.Plain) and first.content and isinstance(first.content[0], pf.Str):
+                if first.content[0].text[:1] in ("☐", "☒"):
+                    raise Unsupported("Task list item")
+            if isinstance(first, (pf.Plain, pf.Para)):
+                self.check_leading_space(first.content)
+            text, _ = self.blocks(item.content, in_list=True)
+            rendered.append(indent(text, start, " " * width))
+        return join_blocks([(text, CR if tight else BLANK) for text in rendered])[0]
+
+    def bullet_list(self, b: pf.BulletList) -> str:
+        return self.list_items(b.content, ["- "] * len(b.content), [2] * len(b.content))
+
+    def ordered_list(self, b: pf.OrderedList) -> str:
+        if b.style not in ("DefaultStyle", "Decimal") or b.delimiter not in ("DefaultDelim", "Period"):
+            raise Unsupported(f"OrderedList with {b.style} {b.delimiter}")
+        markers = [f"{b.start + i}." for i in range(len(b.content))]
+        starts = [m + " " * (4 - len(m) if len(m) < 4 else 1) for m in markers]
+        return self.list_items(b.content, starts, [max(4, len(m) + 1) for m in markers])
+
+    def definition_list(self, b: pf.DefinitionList) -> str:
+        items = []
+        for item in b.content:
+            if not all(len(d.content) == 1 and isinstance(d.content[0], pf.Plain) for d in item.definitions):
+                raise Unsupported("DefinitionList with block content")
+            for inlines in [item.term] + [d.content[0].content for d in item.definitions]:
+                self.check_leading_space(inlines)
+            defs = [indent(self.plain(d.content[0].content), ":   ", "    ") for d in item.definitions]
+            term = self.plain(item.term)
+            items.append("\n".join(([term] if term else []) + defs))
+        return "\n\n".join(items)
+
+    def table(self, b: pf.Table) -> str:
+        numcols = len(b.colspec)
+        rows, row_widths = [], []
+        body_rows = [section for body in b.content for section in (body.head, body.content)]
+        for section in [b.head.content] + body_rows + [b.foot.content]:
+            for row in section:
+                if len(row.content) != numcols:
+                    raise Unsupported("Table row with missing cells")
+                cells, widths = [], []
+                for cell in row.content:
+                    if cell.rowspan != 1 or cell.colspan != 1:
+                        raise Unsupported("Table cell spanning multiple rows or columns")
+                    if len(cell.content) > 1 or (
+                        cell.content and not isinstance(cell.content[0], (pf.Plain, pf.Para))
+                    ):
+                        raise Unsupported("Table cell with block content")
+                    if cell.content and any(isinstance(e, pf.LineBreak) for e in self.descendants(cell.content[0])):
+                        raise Unsupported("Table cell with line break")
+                    if cell.content:
+                        self.check_leading_space(cell.content[0].content)
+                    text = self.plain_spaced(cell.content[0].content) if cell.content else ""
+                    cells.append(finish(text))
+                    # Pandoc sizes the columns before the spaces are collapsed or dropped at the ends
+                    widths.append(text_width(text.replace(SPACE, " ")))
+                rows.append(cells)
+                row_widths.append(widths)
+        headless = not b.head.content
+        header = [""] * numcols if headless else rows.pop(0)
+        widths = [max([3] + [r[i] for r in row_widths]) for i in range(numcols)]
+        aligns = [a for a, _ in b.colspec]
+
+        def cell(text, align, width):
+            pad = width + 2
+            if align == "AlignRight":
+                return (text + " ").rjust(pad)
+            elif align == "AlignCenter":
+                raise Unsupported("Centered table column")
+            return (" " + text).ljust(pad)
+
+        def border(align, width):
+            return {
+                "AlignLeft": ":" + "-" * (width + 1),
+                "AlignRight": "-" * (width + 1) + ":",
+            }.get(align, "-" * (width + 2))
+
+        lines = ["|" + "|".join(cell(t, a, w) for t, a, w in zip(r, aligns, widths)) + "|" for r in [header] + rows]
+        lines.insert(1, "|" + "|".join(border(a, w) for a, w in zip(aligns, widths)) + "|")
+        text = "\n".join(lines)
+        if b.caption.content:
+            caption = b.caption.content
+            if len(caption) != 1 or not isinstance(caption[0], (pf.Plain, pf.Para)):
+                raise Unsupported("Table caption with block content")
+            text += "\n\n" + finish(self.inlines(caption[0].content))
+        return text
+
+    @staticmethod
+    def descendants(elem) -> List:
+        found = []
+        elem.walk(lambda e, doc: found.append(e))
+        return found
+
+    # INLINES
+
+    def inlines(self, inlines) -> str:
+        inlines = list(inlines)
+        out = []
+        for i, elem in enumerate(inlines):
+            nxt = inlines[i + 1 : i + 3]
+            if (
+                isinstance(elem, (pf.Space, pf.SoftBreak))
+                and isinstance(nxt[0] if nxt else None, pf.Str)
+                and bad_wrap_pattern.fullmatch(nxt[0].text)
+                and len(nxt) == 2
+                and isinstance(nxt[1], (pf.Space, pf.SoftBreak))
+            ):
+                out.append(" ")  # Not collapsed with other spaces, or dropped at the start of a line
+            else:
+                out.append(self.inline(elem))
+        return "".join(out)
+
+    def inline(self, i) -> str:
+        if isinstance(i, pf.Str):
+            return escape_text(i.text)
+        elif isinstance(i, (pf.Space, pf.SoftBreak)):
+            return SPACE
+        elif isinstance(i, pf.LineBreak):
+            return "  \n"
+        elif isinstance(i, (pf.Emph, pf.Strong, pf.Strikeout)) and not i.content:
+            return ""
+        elif isinstance(i, pf.Emph):
+            return "*" + self.inlines(i.content) + "*"
+        elif isinstance(i, pf.Strong):
+            return "**" + self.inlines(i.content) + "**"
+        elif isinstance(i, pf.Strikeout):
+            return "~~" + self.inlines(i.content) + "~~"
+        elif isinstance(i, pf.Code):
+            if i.identifier or i.classes or i.attributes:
+                raise Unsupported("Code with attributes")
+            if SPACE in i.text:
+                raise Unsupported("Code with null character")
+            longest = max([len(m) for m in re.findall(r"`+", i.text)] + [0])
+            marker = "`" * (longest + 1)
+            spacer = " " if longest else ""
+            return marker + spacer + i.text + spacer + marker
+        elif isinstance(i, pf.RawInline):
+            if i.format in markdown_formats:
+                raise Unsupported(f"RawInline in {i.format}")
+            elif i.format not in html_formats:
+                return ""  # Raw content in other formats is dropped
+            if SPACE in i.text:
+                raise Unsupported("RawInline with null character")
+            return i.text
+        elif isinstance(i, pf.Link):
+            if i.identifier or i.classes or i.attributes:
+                raise Unsupported("Link with attributes")
+            return self.link(list(i.content), i.url, i.title)
+        elif isinstance(i, pf.Image):
+            if i.identifier or i.classes or i.attributes:
+                raise Unsupported("Image with attributes")
+            content = list(i.content)
+            if not content or (len(content) == 1 and isinstance(content[0], pf.Str) and content[0].text == i.url):
+                content = [pf.Str("")]
+            return "!" + self.link(content, i.url, i.title)
+        raise Unsupported(f"Inline {type(i).__name__}")
+
+    def link(self, content, url: str, title: str) -> str:
+        if len(content) == 1 and isinstance(content[0], pf.Str) and content[0].text == url:
+            if autolink_pattern.fullmatch(url) and not url.startswith("mailto:"):
+                return f"<{url}>"
+            elif ":" in url:
+                raise Unsupported(f"Link that may be an autolink {url}")
+        if len(content) == 1 and isinstance(content[0], pf.Str) and "mailto:" + content[0].text == url:
+            if autolink_pattern.fullmatch(url):
+                return f"<{content[0].text}>"  # An email address
+            raise Unsupported(f"Link that may be an email autolink {url}")
+        if "\n" in url or "\n" in title or '"' in title:
+            raise Unsupported("Link target with newline or quote")
+        text = self.inlines(content)
+        label = finish(text)
+        ref = self.reference(label, (url, title))
+        return f"[{text}][]" if link_key(label) == link_key(ref) else f"[{text}][{ref}]"
+
+    def reference(self, label: str, target: Tuple[str, str]) -> str:
+        for ref_label, ref_target in self.refs:
+            if ref_target == target:
+                return ref_label
+        key = link_key(label)
+        if key in self.keys:
+            ref_label = self.next_index()
+            self.keys[key][target] = self.last_idx
+        else:
+            if not label or "[" in label or "]" in label:
+                ref_label = self.next_index()
+            else:
+                ref_label = label
+            self.keys[key] = {target: 0}
+        self.refs.append((ref_label, target))
+        return ref_label
+
+    def next_index(self) -> str:
+        # Numbered labels skip numbers that are already keys of labelled references
+        self.last_idx += 1
+        while str(self.last_idx) in self.keys:
+            self.last_idx += 1
+        return str(self.last_idx)
+
+
+def write_commonmark_x(doc: Doc) -> str:
+    """Writes a panflute Doc as commonmark_x the same way Pandoc would with output_format and extra_args.
+
+    Args:
+        doc (Doc): the document
+
+    Raises:
+        Unsupported: if the document has elements that need to be written by Pandoc
+
+    Returns:
+        str: the Markdown text
+    """
+    return CommonmarkWriter().write(doc)
@@ -0,0 +1,126 @@
+import bz2
+import gzip
+import io
+import lzma
+import os
+import re
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import IO, Callable, Deque, Dict, List, Optional, Tuple
+
+# Compressed dumps are read as streams, dispatching on the suffix before this one, e.g. .xml.bz2 as XML
+openers: Dict[str, Callable[..., IO[bytes]]] = {".gz": gzip.open, ".bz2": bz2.open, ".xz": lzma.open}
+
+# Companion index of a Wikimedia multistream dump, e.g. enwiki-20230101-pages-articles-multistream-index.txt.bz2
+# next to enwiki-20230101-pages-articles-multistream.xml.bz2
+multistream_pattern = re.compile(r"(?P<base>.*-multistream)\.xml\.bz2$")
+
+
+def split_compression(path: str) -> Tuple[str, Optional[str]]:
+    """Splits off the compression suffix of a dump path.
+
+    Args:
+        path (str): dump path, e.g. "dump.xml.bz2"
+
+    Returns:
+        Tuple[str, Optional[str]]: the path without the suffix, and the suffix, or None if not compressed
+    """
+    base, suffix = os.path.splitext(path)
+    return (base, suffix) if suffix in openers else (path, None)
+
+
+def multistream_index(path: str) -> Optional[str]:
+    # The companion index of a multistream dump, if it is next to it
+    if (match := multistream_pattern.match(path)) and os.path.exists(index := match.group("base") + "-index.txt.bz2"):
+        return index
+    return None
+
+
+def read_stream_offsets(index: str) -> List[int]:
+    """Reads the byte offsets of the bz2 streams in a multistream dump from its index, where each line is
+    "offset:page_id:title" and there's a line for every page in the stream.
+
+    Args:
+        index (str): path of the index, compressed or not
+
+    Returns:
+        List[int]: sorted unique offsets
+    """
+    offsets = set()
+    opener = openers.get(split_compression(index)[1] or "", open)
+    with opener(index, "rt", encoding="utf-8") as f:  # type: ignore
+        for line in f:
+            if offset := line.split(":", 1)[0].strip():
+                offsets.add(int(offset))
+    return sorted(offsets)
+
+
+class MultistreamReader(io.RawIOBase):
+    """Reads a bz2 multistream dump, decompressing the streams in threads while earlier ones are being parsed. The
+    bz2 module releases the GIL while decompressing, so this uses all cores where bz2.open would use one.
+
+    The dump is split at the stream offsets in the index, and the header before the first page stream and footer
+    after the last are their own streams.
+    """
+
+    def __init__(self, path: str, offsets: List[int], workers: Optional[int] = None):
+        super().__init__()
+        self.path = path
+        size = os.path.getsize(path)
+        bounds = sorted({0, size, *(o for o in offsets if 0 < o < size)})
+        self.blocks = list(zip(bounds, bounds[1:]))
+        self.workers = workers or os.cpu_count() or 1
+        self._file = open(path, "rb")
+        self._pool = ThreadPoolExecutor(self.workers, thread_name_prefix="db2md-bz2")
+        self._pending: Deque[Future] = deque()
+        self._next_block = 0
+        self._buffer = memoryview(b"")
+
+    def readable(self) -> bool:
+        return True
+
+    def _fill(self):
+        # Keeps a couple of streams per thread decompressing ahead
+        while len(self._pending) < self.workers * 2 and self._next_block < len(self.blocks):
+            start, end = self.blocks[self._next_block]
+            self._file.seek(start)
+            self._pending.append(self._pool.submit(bz2.decompress, self._file.read(end - start)))
+            self._next_block += 1
+
+    def readinto(self, b) -> int:
+        while not self._buffer:
+            self._fill()
+            if not self._pending:
+                return 0
+            self._buffer = memoryview(self._pending.popleft().result())
+        n = min(len(b), len(self._buffer))
+        b[:n] = self._buffer[:n]
+        self._buffer = self._buffer[n:]
+        return n
+
+    def close(self):
+        if not self.closed:
+            for future in self._pending:
+                future.cancel()
+            self._pool.shutdown()
+            self._file.close()
+        super().close()
+
+
+def open_dump(path: str, index: Optional[str] = None) -> IO[bytes]:
+    """Opens a dump for reading as bytes, decompressing gzip, bz2 and xz on the fly. A bz2 multistream dump with an
+    index (given, or found next to it) is decompressed in parallel.
+
+    Args:
+        path (str): dump path
+        index (str, optional): multistream index. Defaults to the companion index if there.
+
+    Returns:
+        IO[bytes]: binary file object
+    """
+    suffix = split_compression(path)[1]
+    if suffix == ".bz2" and (index := index or multistream_index(path)):
+        return io.BufferedReader(MultistreamReader(path, read_stream_offsets(index)), buffer_size=1024 * 1024)
+    elif suffix:
+        return openers[suffix](path, "rb")
+    return open(path, "rb")
@@ -0,0 +1,117 @@
+import hashlib
+from collections.abc import Mapping
+from typing import Callable, Dict, Iterator, List, Optional, Union
+
+# Fields of a document that are given as keys when set, besides the text under its type
+fields = ("title", "created_at", "updated_at", "author", "revisions")
+
+
+class Document(Mapping):
+    """A document from a source, read like the dict with "title", "created_at", "text/x-wiki" etc that it replaces.
+    The text is kept as in the source, e.g. still escaped and UTF-8 encoded from a SQL dump, and only decoded when
+    first read. Documents that are skipped, filtered out or unchanged since the last run never decode their text,
+    and keep it in the compact source form.
+    """
+
+    __slots__ = ("title", "created_at", "updated_at", "author", "revisions", "text_type", "_text", "_decode", "_digest")
+
+    def __init__(
+        self,
+        title: str,
+        text_type: str,
+        text: Union[str, bytes],
+        decode: Optional[Callable[[str], str]] = None,
+        created_at: Optional[str] = None,
+        updated_at: Optional[str] = None,
+        author: Optional[str] = None,
+        revisions: Optional[List[Dict]] = None,
+    ):
+        """
+        Args:
+            title (str): title of the document
+            text_type (str): key of the text, "text/x-wiki" or "text/html"
+            text (Union[str, bytes]): text as in the source, bytes are UTF-8
+            decode (Callable[[str], str], optional): unescapes the text, e.g. mysql_unescape. Has to be a module level
+                function for documents to be sent to worker processes.
+            created_at (str, optional): creation time
+            updated_at (str, optional): update time
+            author (str, optional): author name
+            revisions (List[Dict], optional): revisions of the page
+        """
+        self.title = title
+        self.text_type = text_type
+        self._text = text
+        self._decode = decode
+        self._digest: Optional[str] = None
+        self.created_at = created_at
+        self.updated_at = updated_at
+        self.author = author
+        self.revisions = revisions
+
+    @property
+    def text(self) -> str:
+        if self._decode is not None or isinstance(self._text, bytes):
+            self._digest = self.source_digest  # Kept, as the source form is dropped
+            text = self._text.decode("utf-8") if isinstance(self._text, bytes) else self._text
+            self._text = self._decode(text) if self._decode is not None else text
+            self._decode = None
+        return self._text  # type: ignore
+
+    @property
+    def has_text(self) -> bool:
+        # An escape is never decoded to nothing, so a text is empty only if it's empty in the source
+        return len(self._text) > 0
+
+    def head(self, chars: int) -> str:
+        """The start of the text, without decoding all of it.
+
+        Args:
+            chars (int): number of characters
+
+        Returns:
+            str: the first chars characters of the text, or all of it if shorter
+        """
+        if self._decode is None and isinstance(self._text, str):
+            return self._text[:chars]
+        # A character is at most 4 bytes in UTF-8 and usually 2 characters escaped, so the characters before a cut
+        # escape or UTF-8 sequence at the end are enough. If not, e.g. with long escapes, all of it is decoded.
+        raw = self._text[: 8 * chars + 8]
+        text = raw.decode("utf-8", errors="ignore") if isinstance(raw, bytes) else raw
+        try:
+            head = (self._decode(text) if self._decode is not None else text)[:chars]
+            if len(head) == chars or len(raw) == len(self._text):
+                return head
+        except ValueError:
+            pass  # A cut escape that can't be decoded
+        return self.text[:chars]
+
+    @property
+    def source_digest(self) -> Optional[str]:
+        """A hash of the text as in the source, for telling if it changed without decoding it. None if the text
+        isn't escaped, and so is the same as in the source.
+        """
+        if self._digest is None and self._decode is not None:
+            raw = self._text.encode("utf-8") if isinstance(self._text, str) else self._text
+            self._digest = hashlib.sha1(raw).hexdigest()
+        return self._digest
+
+    def __getitem__(self, key: str):
+        if key == self.text_type:
+            return self.text
+        if key in fields and (value := getattr(self, key)) is not None:
+            return value
+        raise KeyError(key)
+
+    def __contains__(self, key) -> bool:
+        # Without decoding the text
+        return key == self.text_type or (key in fields and getattr(self, key) is not None)
+
+    def __iter__(self) -> Iterator[str]:
+        yield from (key for key in fields if getattr(self, key) is not None)
+        yield self.text_type
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+    def __repr__(self) -> str:
+        return f"Document({dict(self)!r})"
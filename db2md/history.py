@@ -0,0 +1,138 @@
+import hashlib
+from typing import BinaryIO, Dict, List, NamedTuple, Optional
+
+from .batch import Job
+from .main import (
+    claim_page,
+    convert_document,
+    default_driver,
+    page_id,
+    page_slug,
+    page_text,
+    pandoc_source,
+    parse_datetime,
+    source_text,
+)
+from .pandoc_driver import PandocDriver
+from .profiling import job_times
+
+
+class Revision(NamedTuple):
+    timestamp: float
+    order: int  # Order added, to keep revisions with the same timestamp in order
+    author: str
+    message: str
+    path: str
+    blob: Optional[int]  # Mark of the file content, or None if the page was emptied
+
+
+def quote_path(path: str) -> str:
+    # Paths are C-style quoted if they could be misread by git fast-import
+    if path.startswith('"') or any(c in path for c in '\n\\"'):
+        return '"' + path.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"'
+    return path
+
+
+def clean_name(name: str) -> str:
+    # Author names can't have <, > or newlines in git
+    return " ".join(name.replace("<", "").replace(">", "").split()) or "Unknown"
+
+
+class FastImportWriter:
+    """Writes converted page revisions as a `git fast-import` stream, with a commit per revision, so that a repository
+    with the whole history can be created in one go:
+
+        python cli.py dump.xml - --history | git fast-import
+
+    File contents are written as blobs when added, and each distinct content only once. Commits are written when
+    closed, ordered by time across all pages, so only a small record per revision is kept in memory.
+    """
+
+    def __init__(self, out: BinaryIO, branch: str = "refs/heads/main"):
+        self.out = out
+        self.branch = branch
+        self.marks = 0
+        self.blobs: Dict[bytes, int] = {}  # Mark by content hash
+        self.revisions: List[Revision] = []
+
+    def mark(self) -> int:
+        self.marks += 1
+        return self.marks
+
+    def data(self, data: bytes):
+        self.out.write(b"data %d\n" % len(data))
+        self.out.write(data)
+        self.out.write(b"\n")
+
+    def blob(self, content: str) -> int:
+        data = content.encode("utf-8")
+        if (mark := self.blobs.get(key := hashlib.sha1(data).digest(), None)) is None:
+            mark = self.blobs[key] = self.mark()
+            self.out.write(b"blob\nmark :%d\n" % mark)
+            self.data(data)
+        return mark
+
+    def add(self, timestamp: str, author: str, message: str, path: str, blob: Optional[int]):
+        """Adds a revision of a file, to be committed when closed.
+
+        Args:
+            timestamp (str): time of the revision, e.g. "2011-03-13T18:42:38Z"
+            author (str): name of the author
+            message (str): commit message
+            path (str): path of the file in the repository
+            blob (Optional[int]): mark from blob(), or None to delete the file
+        """
+        seconds = parse_datetime(timestamp).timestamp() if timestamp else 0.0
+        self.revisions.append(Revision(seconds, len(self.revisions), clean_name(author), message, path, blob))
+
+    def close(self):
+        for rev in sorted(self.revisions):
+            self.out.write(b"commit %s\nmark :%d\n" % (self.branch.encode("utf-8"), self.mark()))
+            who = f"{rev.author} <> {int(rev.timestamp)} +0000\n".encode("utf-8")
+            self.out.write(b"author " + who + b"committer " + who)
+            self.data(rev.message.encode("utf-8"))
+            if rev.blob is None:
+                self.out.write(f"D {quote_path(rev.path)}\n".encode("utf-8"))
+            else:
+                self.out.write(f"M 100644 :{rev.blob} {quote_path(rev.path)}\n".encode("utf-8"))
+            self.out.write(b"\n")
+        self.revisions = []
+        self.out.flush()
+
+
+def job_history_to_fast_import(job: Job, data):
+    """Converts every revision of a page, from doc_generator with revisions=True, and adds them to the
+    FastImportWriter in the context as "history". Revisions with the same text as an earlier one of the page are not
+    converted again. The frontmatter is that of the page, so it's the same in every revision. If any revision fails,
+    none of the page's are added.
+    """
+    assert "title" in data and "revisions" in data
+    title = data["title"]
+    assert len(title) > 0, "Title cannot be empty"
+    job_times(job).title = title
+    history: FastImportWriter = job.context["history"]
+    pandoc: PandocDriver = job.context.get("pandoc", None) or default_driver
+
+    id = page_id(title)
+    assert id, "ID is empty"
+    job.id = id
+    is_redirect = source_text(data)[2] if data.get("text/x-wiki", "") else 0
+    if (skipped := claim_page(job, title, id, is_redirect)) is not None:
+        return skipped
+
+    # Read all distinct texts of the page with one Pandoc call
+    texts: Dict[str, Optional[str]] = {rev["text/x-wiki"]: None for rev in data["revisions"] if rev["text/x-wiki"]}
+    pandoc.prefetch([pandoc_source(*source_text({"text/x-wiki": text})[:2]) for text in texts])
+    # Every text is converted before any is added, so that a revision that fails fails the whole page, instead of
+    # leaving part of its history in the stream
+    for source in texts:
+        text, text_type, rev_is_redirect = source_text({"text/x-wiki": source})
+        converted = convert_document(job, data, id, title, text, text_type, rev_is_redirect, pandoc)
+        texts[source] = page_text(converted.metadata, converted.text)
+    blobs: Dict[str, Optional[int]] = {"": None}  # Blob by source text, an empty text deletes the file
+    blobs.update((source, history.blob(content)) for source, content in texts.items())
+    path = page_slug(title) + ".md"
+    for rev in data["revisions"]:
+        message = rev["comment"] or f"Edit {title}"
+        history.add(rev["timestamp"], rev["author"], message, path, blobs[rev["text/x-wiki"]])
+    return job.complete(result={"path": path, "revisions": len(data["revisions"]), "converted": len(texts)})
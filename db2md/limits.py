@@ -0,0 +1,116 @@
+import signal
+import threading
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional
+
+from .batch import Job, JobSuccess
+
+
+class LimitExceeded(Exception):
+    """A document took longer or used more memory to convert than allowed."""
+
+
+@contextmanager
+def time_limit(seconds: Optional[float]):
+    """Raises LimitExceeded in the block when it has run for longer than seconds. Pandoc processes started with
+    subprocess.run in the block are killed when it's raised. Only works in the main thread, where jobs run, and on
+    platforms with SIGALRM, elsewhere only Pandoc is limited by the PandocDriver.
+
+    Args:
+        seconds (Optional[float]): time limit, or None or 0 for none
+    """
+    if not seconds or not hasattr(signal, "SIGALRM") or threading.current_thread() is not threading.main_thread():
+        yield
+        return
+
+    def alarm(signum, frame):
+        raise LimitExceeded(f"Took over {seconds:g} s")
+
+    previous = signal.signal(signal.SIGALRM, alarm)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+
+
+def job_time_limit(job: Job):
+    """Runs the block within the time limit that a LimitedJob gave the job, if any. Job functions arm it only around
+    the conversion, so that a job isn't stopped while claiming its page or writing its file.
+
+    Args:
+        job (Job): the job
+    """
+    return time_limit(getattr(job, "time_limit", None))
+
+
+def text_size(data) -> int:
+    # Characters of the text of a document, of any type
+    return max(len(data.get(key, "") or "") for key in ("text/x-wiki", "text/html"))
+
+
+class JobLimits(NamedTuple):
+    """Limits the time of converting each document, so that a pathological page, e.g. with huge nested tables, fails
+    on its own instead of holding up the batch. The job function arms the limit with job_time_limit. Memory is limited
+    by the PandocDriver, as that's where it balloons. A job over the limits is failed with the reason, or if given, done
+    again by a degraded job function without Pandoc.
+    """
+
+    timeout: Optional[float]  # Seconds
+    degraded_fn: Optional[Callable] = None  # Called with the job, data and reason, e.g. job_doc_to_plain_markdown
+
+    def track(self, job_fn: Callable) -> "LimitedJob":
+        """Wraps a job function so it's run within the limits. Can be sent to worker processes if job_fn can.
+
+        Args:
+            job_fn (Callable): job function, e.g. job_doc_to_markdown
+
+        Returns:
+            LimitedJob: job function to give to Batch.process
+        """
+        return LimitedJob(self, job_fn)
+
+
+class LimitedJob(NamedTuple):
+    limits: JobLimits
+    job_fn: Callable
+
+    def __call__(self, job: Job, data):
+        job.time_limit = self.limits.timeout
+        try:
+            return self.job_fn(job, data)
+        except LimitExceeded as e:
+            reason = str(e)
+        degraded = self.limits.degraded_fn is not None
+        exceeded = {"title": data.get("title", ""), "size": text_size(data), "exceeded": reason, "degraded": degraded}
+        if self.limits.degraded_fn is not None:
+            self.limits.degraded_fn(job, data, reason)
+            job.result = {**(job.result or {}), **exceeded}
+            return job
+        return job.error(f"Stopped as it went over the limits: {reason}").complete(JobSuccess.FAIL, result=exceeded)
+
+
+def exceeded_results(jobs: Iterable[Job]) -> List[Dict]:
+    # The results of the jobs that went over the limits, with title, size and reason
+    return [r for job in jobs if isinstance(r := job.result, dict) and "exceeded" in r]
+
+
+def limit_summary(jobs: Iterable[Job], results: Optional[List[Dict]] = None) -> str:
+    """Lists the documents that went over the limits, largest first.
+
+    Args:
+        jobs (Iterable[Job]): processed jobs
+        results (List[Dict], optional): results of exceeded_results to list instead, e.g. saved by shards
+
+    Returns:
+        str: the list, or empty if none went over
+    """
+    results = exceeded_results(jobs) if results is None else results
+    if not results:
+        return ""
+    lines = [f"Over the limits: {len(results)} documents"]
+    for r in sorted(results, key=lambda r: r["size"], reverse=True):
+        outcome = "converted as plain text" if r["degraded"] else "failed"
+        lines.append(f"  {r['size']:11,} chars  {r['title']}: {r['exceeded']} ({outcome})")
+    return "\n".join(lines)
@@ -3,11 +3,11 @@ import json
 import os
 import re
 import sqlite3
-import time
+import sys
 import datetime
-from codecs import decode, encode
-from pathlib import Path
-from typing import Dict, Mapping, NamedTuple, Optional, Pattern, Union
+import zlib
+from functools import lru_cache
+from typing import Callable, Dict, FrozenSet, List, Mapping, NamedTuple, Optional, Pattern, Sequence, Set, Tuple, Union
 from xml.etree import ElementTree as ET
 
 from dateutil.parser import parse
@@ -15,8 +15,26 @@ import panflute as pf
 import yaml
 from panflute.elements import Doc
 
-from .batch import Job, JobSuccess, LogLevel
+# The regex parser is internal to CPython and can change, without it every fix scans the whole text
+try:
+    from re import _parser as sre_parse  # Python 3.11+
+except ImportError:
+    try:
+        import sre_parse
+    except ImportError:
+        sre_parse = None
+
+from . import commonmark
+from .batch import Batch, Job, JobSuccess, LogLevel
+from .compression import open_dump, split_compression
+from .document import Document
+from .limits import job_time_limit, limit_summary
+from .pandoc_driver import PandocDriver, Source, default_driver
+from .profiling import job_times, stage_summary, timed, timed_iter
+from .registry import page_registry
+from .sql_dump import index_join_keys, load_sql_dump, native_sql_generator, sql_generator, stage_sql_dump
 from .unicode_slugify import SLUG_ID, slugify
+from .writer import OutputFile, set_mtime, write_file
 
 """
 Still TODO
@@ -81,6 +99,12 @@ Add Joomla parsing
 
 category_pattern = re.compile(r"category|kategori", flags=re.IGNORECASE)
 wiki_redirect_pattern = re.compile(r"^#(REDIRECT|OMDIRIGERING) ", flags=re.IGNORECASE)
+# A redirect that is only a link, as given to Pandoc after source_text and the fixes, e.g.
+# "Alias for [[Some page#Section|label]]". Anything else, e.g. markup in the label or categories after the link, has to
+# be read by Pandoc.
+redirect_link_pattern = re.compile(
+    r"Alias for \[\[(?P<target>[^\[\]{}|<>&'\n:]+)(\|(?P<label>[^\[\]{}|<>&'\n:]+))?\]\]\s*"
+)
 # link_text_invalid_chars = re.compile(r'[#<>[\]\|{}`\\]+')
 # link_text_invalid_chars = re.compile("[^%!\"$&'()*,\\-.\\/0-9:;=?@A-Z\\\\^_`a-z~\\x80-\\xFF+]")
 
@@ -100,6 +124,8 @@ all_ns_pattern = re.compile(
     flags=re.DOTALL | re.IGNORECASE,
 )
 ignore_ns_pattern = re.compile(f"[: ]?({ignore_ns})", flags=re.DOTALL | re.IGNORECASE)
+# Root element of a Mediawiki XML export, e.g. {http://www.mediawiki.org/xml/export-0.10/}mediawiki
+mediawiki_ns_pattern = re.compile(r"(?P<ns>\{http://www\.mediawiki\.org/xml/export-0\.\d+/\})?mediawiki$")
 
 
 class RegexFix(NamedTuple):
@@ -238,128 +264,394 @@ def simple_truncate(s, n=10):
     return s[:10] + (s[10:] and "…")
 
 
-def apply_regex_fixes(s: str, fixes: Mapping[str, RegexFix], job: Job = None):
-    for k, v in fixes.items():
-        if v.repl is not None:
-            s, count = v.pattern.subn(v.repl, s)
-            if job and count > 0 and v.log_level is not None:
-                job.log_any(f"Replaced {k} {count} times", v.log_level)
-        elif job and v.log_level is not None:
-            # Truncate to 10 chars plus ellipsis
-            # TODO maybe print each find in special background color on terminal to easily see start and end?
-            matches = ", ".join([f"{simple_truncate(m[0])}" for m in v.pattern.finditer(s)])
-            if matches:
-                job.log_any(f"{v.comment}, at {matches}", v.log_level)
-    return s
-
-
-def make_sqlite_safe(script: str) -> str:
-    """A quick and dirty way to convert from e.g. MySQL to SQLite.
-    artly based on https://gist.github.com/grfiv/b79ace3656113bcfbd9b7c7da8e9ae8d ,
-    and https://stackoverflow.com/questions/41026122/creating-sql-thats-compatible-with-both-sqlite-and-mysql-with-auto-increment
+class MatchTrigger(NamedTuple):
+    # Any match of a pattern contains one of the chars, at most offset chars into the match
+    chars: FrozenSet[str]
+    offset: int
+
+
+@lru_cache(maxsize=None)
+def whitespace_chars() -> FrozenSet[str]:
+    # What \s matches in a str pattern
+    return frozenset(c for c in map(chr, range(sys.maxunicode + 1)) if c.isspace())
+
+
+def charset_chars(items) -> Optional[Set[str]]:
+    # The chars of a parsed character set like [abc] or [^\S\n], or None if too many or not known
+    chars, negate, categories = set(), False, []
+    for op, av in items:
+        if op is sre_parse.NEGATE:
+            negate = True
+        elif op is sre_parse.LITERAL:
+            chars.add(chr(av))
+        elif op is sre_parse.RANGE and av[1] - av[0] <= 256:
+            chars.update(map(chr, range(av[0], av[1] + 1)))
+        elif op is sre_parse.CATEGORY:
+            categories.append(av)
+        else:
+            return None
+    if not negate:
+        return None if categories else chars
+    if categories == [sre_parse.CATEGORY_NOT_SPACE]:
+        return whitespace_chars() - chars  # E.g. whitespace except line breaks
+    return None
+
+
+def sequence_trigger(items, offset: int = 0) -> Optional[MatchTrigger]:
+    # Finds the first single char item in a parsed pattern that every match has to go through
+    for op, av in items:
+        if op is sre_parse.LITERAL:
+            return MatchTrigger(frozenset(chr(av)), offset)
+        elif op is sre_parse.IN:
+            chars = charset_chars(av)
+            return MatchTrigger(frozenset(chars), offset) if chars else None
+        elif op is sre_parse.SUBPATTERN:
+            group, add_flags, del_flags, sub = av
+            return None if add_flags & re.IGNORECASE else sequence_trigger(sub, offset)
+        elif op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT):
+            min_count, max_count, sub = av
+            if min_count > 0:
+                return sequence_trigger(sub, offset)
+            width = sub.getwidth()[1]
+            if max_count == sre_parse.MAXREPEAT or width >= sre_parse.MAXREPEAT:
+                return None
+            offset += max_count * width
+        elif op in (sre_parse.ANY, sre_parse.NOT_LITERAL):
+            offset += 1
+        elif op not in (sre_parse.AT, sre_parse.ASSERT, sre_parse.ASSERT_NOT):  # Those don't take any chars
+            return None
+    return None
+
+
+def match_trigger(pattern: Pattern) -> Optional[MatchTrigger]:
+    """Finds characters that any match of a pattern has to contain, so that texts without them can be skipped and
+    scanning can start close to the first of them.
+
     Args:
-        script (str): [description]
+        pattern (Pattern): compiled pattern
 
     Returns:
-        str: [description]
+        Optional[MatchTrigger]: chars and how far into a match they can be, or None if not known
+    """
+    if sre_parse is None:
+        return None
+    try:
+        parsed = sre_parse.parse(pattern.pattern, pattern.flags)
+        if parsed.state.flags & re.IGNORECASE:
+            return None
+        return sequence_trigger(parsed)
+    except Exception:
+        return None  # A parser of another Python version, with other opcodes or parse trees
+
+
+class FixTable:
+    """A table of RegexFix compiled for applying in one go. Fixes are applied in order as by looping over the table,
+    but each detection-only fix is only scanned for from the first char that a match has to contain. The positions of
+    those chars are found once for each run of detection-only fixes, as they have the same text, and fixes that log
+    below the log level of the batch are not scanned for at all. Rewrites are skipped if their chars are not in the
+    text.
+
+    A single regex of all detection patterns would be simpler, but is slower than separate scans with the re module,
+    as it can't use its fast search for a literal prefix with alternatives.
     """
-    script = re.sub(r"(int\(\d+\)) unsigned", "\\1", script, flags=re.MULTILINE)
-    script = re.sub(r"ENGINE=.*;$", ";", script, flags=re.MULTILINE)
-    script = re.sub(r" ?AUTO_INCREMENT ?", "", script, flags=re.MULTILINE)
-    script = re.sub(r"^CREATE DATABASE.*;$", "", script, flags=re.MULTILINE)
-    script = re.sub(r"^USE .*;$", "", script, flags=re.MULTILINE)
-    script = re.sub(r",?\s*(FULLTEXT|PRIMARY|UNIQUE)?\s*KEY .*$", "", script, flags=re.MULTILINE)
-    script = re.sub(r"^(UN)?LOCK.*$", "", script, flags=re.MULTILINE)
-    script = re.sub(r"ON UPDATE.*(,)?$", "\\1", script, flags=re.MULTILINE)
-    script = re.sub(r"enum\(.*,$", "blob,", script, flags=re.MULTILINE)
-    script = re.sub(r"\\'", "''", script, flags=re.MULTILINE)  # Sqlite escapes ' as '', not \'
-    return script
-
-
-def clean_escaping(s):
-    return decode(encode(s, "latin-1", "backslashreplace"), "unicode-escape")
-
-
-def doc_generator(db_file):
-    if db_file.endswith(".xml"):
-        tree = ET.parse(db_file)
-        root = tree.getroot()
-        ns = "{http://www.mediawiki.org/xml/export-0.3/}"
-        for page in root.findall(f".//{ns}page"):
-            yield {
-                "title": page.findtext(f"{ns}title", ""),
-                "created_at": page.findtext(f".//{ns}timestamp", ""),
-                "author": page.findtext(f".//{ns}username", ""),
-                "text/x-wiki": page.findtext(f".//{ns}text", ""),
-            }
-    elif db_file.endswith(".sql"):
-        con = sqlite3.connect(":memory:")
-        con.row_factory = sqlite3.Row
-        script = Path(db_file).read_text(encoding="utf-8", errors="ignore")
-        script = make_sqlite_safe(script)
-        cur = con.cursor()
-        cur.executescript(script)
-        if "CREATE TABLE `page`" and "CREATE TABLE `revision`" in script:
-            # https://www.mediawiki.org/wiki/Manual:Database_layout
-            for row in cur.execute(
-                """
-                SELECT page_title,page_namespace,rev_timestamp,user_name,old_text FROM
-                    page
-                        INNER JOIN revision ON page.page_latest = revision.rev_id
-                            INNER JOIN user ON revision.rev_user = user.user_id
-                                INNER JOIN text ON revision.rev_text_id = text.old_id
-                """
-            ):
-
-                if row["page_namespace"] != 0:
-                    # Skip non-main pages, e.g. talk, user, file, etc https://gerrit.wikimedia.org/g/mediawiki/core/+/HEAD/includes/Defines.php
+
+    def __init__(self, fixes: Mapping[str, RegexFix]):
+        self.fixes = fixes
+        # Each step is a rewrite, or a list of detection-only fixes that all scan the same text
+        self.steps: List[Union[Tuple, List[Tuple]]] = []
+        for k, v in fixes.items():
+            if v.repl is not None:
+                self.steps.append((k, v, match_trigger(v.pattern)))
+            elif v.log_level is not None:  # Otherwise never logged, so no need to look for it
+                if not self.steps or not isinstance(self.steps[-1], list):
+                    self.steps.append([])
+                self.steps[-1].append((k, v, match_trigger(v.pattern)))
+
+    def apply(self, s: str, job: Job = None) -> str:
+        """Applies the fixes to a text, logging replacements and findings to the job, if any.
+
+        Args:
+            s (str): text to fix
+            job (Job, optional): job to log to. Defaults to None.
+
+        Returns:
+            str: fixed text
+        """
+        level = job.batch.log_level if job and job.batch else LogLevel.DEBUG
+        for step in self.steps:
+            if isinstance(step, tuple):
+                k, v, trigger = step
+                if trigger and not any(c in s for c in trigger.chars):
                     continue
-                data = {
-                    "title": clean_escaping(row["page_title"].replace("_", " ")),
-                    "created_at": str(row["rev_timestamp"]),
-                    # Strings are escaped in text fields in SQL, check
-                    # https://stackoverflow.com/questions/1885181/how-to-un-escape-a-backslash-escaped-string
-                    "text/x-wiki": clean_escaping(row["old_text"]),
-                    "author": row["user_name"],  # Also get email
-                }
-                yield data
+                s, count = v.pattern.subn(v.repl, s)
+                if job and count > 0 and v.log_level is not None:
+                    job.log_any(f"Replaced {k} {count} times", v.log_level)
+                continue
+            if not job:
+                continue
+            found: Dict[str, int] = {}  # First position of each trigger char in the text
+            for k, v, trigger in step:
+                if v.log_level < level:
+                    continue
+                start = 0
+                if trigger:
+                    for c in trigger.chars - found.keys():
+                        found[c] = s.find(c)
+                    if not (positions := [found[c] for c in trigger.chars if found[c] >= 0]):
+                        continue
+                    start = max(min(positions) - trigger.offset, 0)
+                # Truncate to 10 chars plus ellipsis
+                # TODO maybe print each find in special background color on terminal to easily see start and end?
+                matches = ", ".join([f"{simple_truncate(m[0])}" for m in v.pattern.finditer(s, start)])
+                if matches:
+                    job.log_any(f"{v.comment}, at {matches}", v.log_level)
+        return s
 
-        elif "CREATE TABLE `wp_posts`" in script and "CREATE TABLE `wp_users`" in script:
-            for row in cur.execute(
-                """
-                SELECT * FROM
-                    wp_posts
-                        INNER JOIN wp_users ON wp_posts.post_author = wp_users.ID
-                """
-            ):
-                data = {
-                    "title": clean_escaping(row["post_title"]),
-                    "created_at": str(row["post_date_gmt"]),
-                    "updated_at": str(row["post_modified_gmt"]),
-                    # Strings are escaped in text fields in SQL, check
-                    # https://stackoverflow.com/questions/1885181/how-to-un-escape-a-backslash-escaped-string
-                    "text/html": clean_escaping(row["post_content"]),
-                    "author": row["display_name"],  # Also get email
-                }
+
+def apply_regex_fixes(s: str, fixes: Union[Mapping[str, RegexFix], FixTable], job: Job = None) -> str:
+    table = fixes if isinstance(fixes, FixTable) else FixTable(fixes)
+    return table.apply(s, job)
+
+
+html_fix_table = FixTable(html_fixes)
+mediawiki_fix_table = FixTable(mediawiki_fixes)
+markdown_fix_table = FixTable(markdown_fixes)
+
+
+def utc_datetime(dt_string: str) -> Optional[datetime.datetime]:
+    # Dates in dumps without a timezone are in UTC, e.g. 20100101000000 in Mediawiki SQL
+    if (dt := parse_datetime(dt_string)) is not None and dt.tzinfo is None:
+        dt = dt.replace(tzinfo=datetime.timezone.utc)
+    return dt
+
+
+def in_range(dt: Optional[datetime.datetime], since: Optional[datetime.datetime], before: Optional[datetime.datetime]):
+    if since is None and before is None:
+        return True
+    return dt is not None and (since is None or dt >= since) and (before is None or dt < before)
+
+
+class DocFilter(NamedTuple):
+    """Selects the documents to read from a source, with the predicates that are given all having to match. The
+    readers check them as early as they can, so that documents that aren't selected are skipped before their text is
+    decoded, and in SQL dumps aren't even read from the database.
+    """
+
+    text: str = ""  # In the page ID, like --filter
+    title_regex: str = ""  # Searched for in the title
+    namespace: Optional[int] = None  # Mediawiki namespace number, main pages are 0
+    author: str = ""
+    created_since: Optional[datetime.datetime] = None
+    created_before: Optional[datetime.datetime] = None
+    updated_since: Optional[datetime.datetime] = None  # Documents without updated_at were updated when created
+    updated_before: Optional[datetime.datetime] = None
+    max_size: Optional[int] = None  # Characters of source text
+    shard: Optional[Tuple[int, int]] = None  # (i, n) to only select the pages in shard i of n, counted from 1
+
+    @property
+    def active(self) -> bool:
+        return any(v is not None and v != "" for v in self)
+
+    def matches_title(self, title: str, namespace: Optional[int] = None) -> bool:
+        """Checks the predicates on the title, which can be done before the rest of the document is read.
+
+        Args:
+            title (str): page title
+            namespace (int, optional): namespace number if known, otherwise 0 if the title has no namespace
+
+        Returns:
+            bool: True if selected
+        """
+        if self.text and self.text.lower() not in page_id(title):
+            return False
+        if self.shard and page_shard(page_id(title), self.shard[1]) != self.shard[0]:
+            return False
+        if self.title_regex and not re.search(self.title_regex, title):
+            return False
+        if self.namespace is not None:
+            if namespace is None and not all_ns_pattern.match(title).group("ns"):
+                namespace = 0
+            return namespace == self.namespace
+        return True
+
+    def matches(self, data: Dict, namespace: Optional[int] = None) -> bool:
+        """Checks all predicates on a document from a reader.
+
+        Args:
+            data (Dict): document data
+            namespace (int, optional): namespace number if known
+
+        Returns:
+            bool: True if selected
+        """
+        if not self.matches_title(data.get("title", ""), namespace):
+            return False
+        if self.author and data.get("author", "") != self.author:
+            return False
+        if self.max_size is not None and len(data.get("text/x-wiki", "") or data.get("text/html", "")) > self.max_size:
+            return False
+        created = utc_datetime(data.get("created_at", "")) if self.created_since or self.created_before else None
+        if not in_range(created, self.created_since, self.created_before):
+            return False
+        if self.updated_since or self.updated_before:
+            updated = utc_datetime(data.get("updated_at", "") or data.get("created_at", ""))
+            return in_range(updated, self.updated_since, self.updated_before)
+        return True
+
+
+def mediawiki_xml_generator(source, revisions=False, selection: Optional[DocFilter] = None):
+    """Streams pages from a Mediawiki XML export, yielding each page as soon as it's closed and then freeing it,
+    so memory stays flat regardless of dump size. The export schema namespace (e.g. export-0.3 to export-0.11) is
+    detected from the root element.
+
+    Args:
+        source (str or file): path or binary file object of the XML export
+        revisions (bool, optional): also give all revisions of the page, oldest first, under "revisions". The text
+            of the page is then that of the latest revision. Defaults to False.
+        selection (DocFilter, optional): only give the selected pages, checking title and namespace first
+
+    Yields:
+        Document: each page
+    """
+    context = ET.iterparse(source, events=("start", "end"))
+    _, root = next(context)
+    match = mediawiki_ns_pattern.match(root.tag)
+    assert match, f"Root element {root.tag} is not a Mediawiki export"
+    ns = match.group("ns") or ""
+    page_tag = f"{ns}page"
+    for event, elem in context:
+        if event == "end" and elem.tag == page_tag:
+            page_ns = int(ns_text) if (ns_text := elem.findtext(f"{ns}ns", "").strip()).isdigit() else None
+            if selection and not selection.matches_title(elem.findtext(f"{ns}title", ""), page_ns):
+                elem.clear()
+                root.clear()
+                continue
+            created_at = elem.findtext(f".//{ns}timestamp", "")
+            text = elem.findtext(f".//{ns}text", "")
+            page_revisions = None
+            if revisions:
+                page_revisions = [
+                    {
+                        "id": rev.findtext(f"{ns}id", ""),
+                        "timestamp": rev.findtext(f"{ns}timestamp", ""),
+                        # Anonymous edits have an IP instead of a username
+                        "author": rev.findtext(f"{ns}contributor/{ns}username", "")
+                        or rev.findtext(f"{ns}contributor/{ns}ip", ""),
+                        "comment": rev.findtext(f"{ns}comment", ""),
+                        "text/x-wiki": rev.findtext(f"{ns}text", ""),
+                    }
+                    for rev in elem.iter(f"{ns}revision")
+                ]
+                page_revisions.sort(key=lambda rev: rev["timestamp"])  # ISO 8601 in UTC, so sortable as text
+                if page_revisions:
+                    created_at = page_revisions[0]["timestamp"]
+                    text = page_revisions[-1]["text/x-wiki"]
+            data = Document(
+                elem.findtext(f"{ns}title", ""),
+                "text/x-wiki",
+                text,
+                created_at=created_at,
+                author=elem.findtext(f".//{ns}username", ""),
+                revisions=page_revisions,
+            )
+            if not selection or selection.matches(data, page_ns):
                 yield data
-        elif "CREATE TABLE `mos_content`" in script:
-            for row in cur.execute(
-                """
-                SELECT * FROM
-                    mos_content
-                        INNER JOIN wp_users ON wp_posts.post_author = wp_users.ID
-                """
-            ):
-                data = {
-                    "title": clean_escaping(row["title"]),
-                    "created_at": str(row["created"]),
-                    "updated_at": str(row["modified"]),
-                    "text/html": clean_escaping(row["fulltext"]),
-                }
+            # Drop the page and anything parsed before it, so the tree never grows
+            elem.clear()
+            root.clear()
+
+
+def doc_generator(db_file, index=None, revisions=False, staging=False, native=False, selection=None):
+    # Compressed dumps are read as streams, e.g. dump.xml.bz2 as XML. Only documents in the selection are given.
+    path = split_compression(db_file)[0]
+    selection = selection if selection and selection.active else None
+    if path.endswith(".xml"):
+        with open_dump(db_file, index) as f:
+            yield from mediawiki_xml_generator(f, revisions=revisions, selection=selection)
+    elif path.endswith(".sql"):
+        assert not revisions, "Revisions can only be read from Mediawiki XML exports"
+        if native:
+            assert not staging, "A staging database is only used when reading with SQLite"
+            with open_dump(db_file) as f, io.TextIOWrapper(f, encoding="utf-8", errors="ignore") as text:
+                yield from native_sql_generator(text, selection)
+            return
+        if staging:
+            con, tables = stage_sql_dump(db_file)
+        else:
+            con = sqlite3.connect(":memory:")
+            with open_dump(db_file) as f, io.TextIOWrapper(f, encoding="utf-8", errors="ignore") as text:
+                tables = load_sql_dump(con, text)
+            index_join_keys(con, tables)
+        try:
+            yield from sql_generator(con, tables, selection)
+        finally:
+            con.close()
+
+
+class FilterDispatcher:
+    """Runs Panflute filter actions in one walk of the document, instead of one walk per action as with
+    pf.run_filters. Actions are registered for the element types they act on, so each element is only given to the
+    actions for its type, in the order they were added. Replacing and removing elements works as with pf.run_filters,
+    but containers are only rebuilt if something changed. An element that an action replaces or removes is not given
+    to the actions after it.
+    """
+
+    def __init__(self):
+        self.actions: List[Tuple[Tuple[type, ...], Callable]] = []
+        self.dispatch: Dict[type, List[Callable]] = {}  # Actions for each element class seen
+
+    def add(self, action: Callable, *types: type) -> "FilterDispatcher":
+        """Adds an action to run on elements of the types.
+
+        Args:
+            action (Callable): filter action taking elem, doc, job and context
+            *types (type): Panflute element classes the action acts on, including subclasses
+
+        Returns:
+            FilterDispatcher: self, to chain adds
+        """
+        self.actions.append((types, action))
+        self.dispatch.clear()
+        return self
+
+    def run(self, doc: Doc, job: Job, context: Dict) -> Doc:
+        return self.walk(doc, doc, job, context)
+
+    def walk(self, elem, doc: Doc, job: Job, context: Dict):
+        # Children first, like Element.walk
+        for child in elem._children:
+            obj = getattr(elem, child)
+            if isinstance(obj, pf.Element):
+                if (ans := self.walk(obj, doc, job, context)) is not obj:
+                    setattr(elem, child, ans)
+            elif isinstance(obj, pf.ListContainer):
+                items, changed = [], False
+                for item in obj:
+                    ans = self.walk(item, doc, job, context)
+                    if ans is item:
+                        items.append(item)
+                    else:
+                        changed = True
+                        items.extend(ans if type(ans) == list else (ans,))
+                if changed:
+                    setattr(elem, child, items)
+            elif isinstance(obj, pf.DictContainer):
+                items = [(k, v, self.walk(v, doc, job, context)) for k, v in obj.items()]
+                if any(ans is not v for k, v, ans in items):
+                    setattr(elem, child, [(k, ans) for k, v, ans in items if ans != []])
+            elif obj is not None:
+                raise TypeError(type(obj))
+
+        if (actions := self.dispatch.get(type(elem), None)) is None:
+            actions = self.dispatch[type(elem)] = [a for types, a in self.actions if isinstance(elem, types)]
+        for action in actions:
+            if (altered := action(elem, doc, job, context)) is not None and altered is not elem:
+                return altered
+        return elem
 
 
 def action_scan_headings(elem, doc, job, context):
-    """Will just scan all headings and note their level in a dict, for later use.
+    """Will just scan all headings and note their level in a dict, and keep them in a list, for later use.
 
     Args:
         elem (Element): current element in the Panflute syntax tree
@@ -368,6 +660,7 @@ def action_scan_headings(elem, doc, job, context):
     """
     if isinstance(elem, pf.Header):
         context["headings"][elem.level] = 0
+        context.setdefault("headers", []).append(elem)
 
 
 def action_balance_headings(elem, doc, job, context):
@@ -441,9 +734,7 @@ def action_extract_namespace(elem, doc, job, context):
         assert elem.url
         ns = url_match.group("ns")
         if context["is_redirect"]:
-            context["raw_metadata"].setdefault("alias_for", set()).add(
-                slugify(elem.url.replace("_", " "), lower=False, spaces=True)
-            )
+            context["raw_metadata"].setdefault("alias_for", set()).add(link_slug(elem.url.replace("_", " ")))
             return elem
             # return []  # Remove the link
         elif isinstance(elem, pf.Image):
@@ -460,7 +751,22 @@ def action_extract_namespace(elem, doc, job, context):
                 job.warn(f"Forcing unknown namespace {ns} from {url_match.group(0)} to be a mention")
         if not elem.url.startswith("http"):  # Don't count regular URLs as mentions
             # context["raw_metadata"].setdefault("mention", set()).add(elem.url.replace("_", " "))  # Skip mentions as reference links come at end anyway
-            elem.url = slugify(elem.url, lower=False, spaces=True)
+            if (titles := job.context.get("titles", None)) is not None and not titles.exists(elem.url):
+                job.info(f"Link to a page not in the source: {elem.url}")
+            elem.url = link_slug(elem.url)
+
+
+html_filters = (
+    FilterDispatcher()
+    .add(action_scan_headings, pf.Header)
+    .add(action_clean_link, pf.Link, pf.Image, pf.LineBreak)
+)
+wiki_filters = (
+    FilterDispatcher()
+    .add(action_scan_headings, pf.Header)
+    .add(action_clean_link, pf.Link, pf.Image, pf.LineBreak)
+    .add(action_extract_namespace, pf.Link, pf.Image)
+)
 
 
 def prepare_balanced_headings(h):
@@ -493,10 +799,48 @@ def clean_metadata(metadata: Dict):
     return metadata
 
 
-def job_doc_to_markdown(job: Job, data):
-    assert "title" in data
-    title = data["title"]
-    assert len(title) > 0, "Title cannot be empty"
+class ConversionBatch(Batch):
+    """A Batch that also summarizes how the conversions were done, e.g. use of the conversion cache and the time
+    spent in each stage of the jobs.
+    """
+
+    def __init__(self, *args, slowest: int = 10, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.slowest = slowest  # Number of slowest documents to list in the summary
+        self.seconds: Dict[str, float] = {}  # Time of stages not done per job
+
+    def read(self, generator):
+        """Passes through documents from a generator, timing how long it takes to read them.
+
+        Args:
+            generator (Iterable): document data, e.g. from doc_generator
+
+        Yields:
+            dict: document data, unchanged
+        """
+        return timed_iter(generator, self.seconds, "read_dump")
+
+    def summary_str(self) -> str:
+        lines = [super().summary_str()]
+        pandoc = self.context.get("pandoc", None)
+        if pandoc and pandoc.cache:
+            lines.append(pandoc.cache.summary_str())
+        if stages := stage_summary(self.jobs, self.slowest, self.seconds):
+            lines.append(stages)
+        if exceeded := limit_summary(self.jobs):
+            lines.append(exceeded)
+        return "\n".join(lines)
+
+
+def source_text(data: Dict) -> Tuple[str, str, int]:
+    """Picks the text to convert from the document data.
+
+    Args:
+        data (Dict): document data from doc_generator
+
+    Returns:
+        Tuple[str, str, int]: text, its mimetype and if it's a redirect (text then rewritten to "Alias for ...")
+    """
     text: str = ""
     text_type: str = ""
     if text := data.get("text/x-wiki", ""):
@@ -506,88 +850,238 @@ def job_doc_to_markdown(job: Job, data):
     assert text
     assert text_type in ["text/x-wiki", "text/html"]
 
-    file_birthtime = None
-    assert job.context.get("out_folder", ""), "out_folder path not in context"
-    if not isinstance(job.context.get("all_pages", None), dict):
-        job.context["all_pages"] = {}
-    written_docs = job.context["all_pages"]
+    new_text, is_redirect = wiki_redirect_pattern.subn("Alias for ", text) if text_type == "text/x-wiki" else ("", 0)
+    if is_redirect:
+        text = new_text
+    return text, text_type, is_redirect
 
-    # id is lowercased so we can check case insensitively
-    id = slugify(title, ok=SLUG_ID, spaces=True)
-    assert id, "ID is empty"
-    job.id = id
 
-    # File path retains mixed case vs ID, as it looks better and fits Github Pages/Wiki if uploaded
-    file_path = os.path.join(job.context["out_folder"], slugify(title, ok=SLUG_ID, lower=False, spaces=True) + ".md")
+def source_kind(data: Dict) -> Tuple[str, int]:
+    """Like source_text, but only reads the start of the text of a Document, so that it's decided if a page is
+    converted before its text is decoded.
 
-    if (filter := job.context.get("filter", "")) and filter.lower() not in id:
-        # print(f"filter={job.context['filter']}, id={id}, in it={job.context['filter'] in id}")
-        return job.complete(JobSuccess.SKIP)
+    Args:
+        data (Dict): document data from doc_generator
 
-    match = all_ns_pattern.match(title)
-    if match and match.group("ns"):
-        return job.warn("Skipping doc as title includes a Mediawiki namespace").complete(JobSuccess.SKIP)
+    Returns:
+        Tuple[str, int]: mimetype of the text and if it's a redirect
+    """
+    if not isinstance(data, Document):
+        return source_text(data)[1:]
+    assert data.has_text
+    if data.text_type != "text/x-wiki":
+        return data.text_type, 0
+    return data.text_type, int(bool(wiki_redirect_pattern.match(data.head(len("#OMDIRIGERING ")))))
 
-    new_text, is_redirect = wiki_redirect_pattern.subn("Alias for ", text) if text_type == "text/x-wiki" else ("", 0)
-    if is_redirect:
-        text = new_text
 
-    # If there is a doc with same id already we need to decide if we overwrite the old or fail the new
-    # We deem it safe to overwrite an existing doc if it's just a redirect, as they have the same ID (but would lose variations on the title)
-    # Note that we always overwrite _existing files_, this just checks if we already created the file earlier in the same batch
-    # Logic table
-    # old_redir	new_redir	action
-    # 1	        0	        overwrite old doc
-    # 1	        1	        overwrite old doc
-    # 0	        0	        fail new doc
-    # 0	        1	        fail new doc
-    # TODO another logic here could be to add unique suffix to id to save both new and old, but then it would break links pointing to new
-    # TODO if new is redir but not old, we could also add that manually as a variant name to the old YAML, if we allow ourselves to manyally correct the file
-    if written_docs.get(id, (0, 1))[1] == 0:  # Old doc is not redirect
-        return job.error(
-            f"Forced to skip this doc '{title}' as it might overwrite already processed doc with '{os.path.join(job.context['out_folder'], written_docs[id][0])}.md'"
-        ).complete(JobSuccess.FAIL)
-    elif id in written_docs:
-        job.warn("Overwrote older redirect doc with same id")
+def redirect_doc(text: str, api_version: Sequence[int]) -> Optional[Doc]:
+    """Builds the Doc that Pandoc reads from a redirect that is only a link, so that it's converted without Pandoc.
 
-    written_docs[id] = (title, is_redirect)
+    Args:
+        text (str): text from pandoc_source, e.g. "Alias for [[Some page]]"
+        api_version (Sequence[int]): Pandoc API version of the Doc
 
-    # Apply fixes on Mediawiki input
-    doc = Doc()
-    if text_type == "text/x-wiki":
-        text = apply_regex_fixes(text, mediawiki_fixes)
-        doc: Doc = pf.convert_text(text, input_format="mediawiki", output_format="panflute", standalone=True)  # type: ignore
+    Returns:
+        Optional[Doc]: the Doc, or None if the text has to be read by Pandoc
+    """
+    if not (match := redirect_link_pattern.fullmatch(text)):
+        return None
+    # Like Pandoc, runs of whitespace and underscores are one underscore in the URL, but not at the end, and the label
+    # defaults to the target
+    words = match.group("target").split()
+    url = re.sub("_+", "_", "_".join(words)).rstrip("_")
+    label = match.group("label") or " ".join(words)
+    content = [pf.Space() if s.isspace() else pf.Str(s) for s in re.split("([ \t]+)", label) if s]
+    link = pf.Link(*content, url=url, title="wikilink")
+    return Doc(pf.Para(pf.Str("Alias"), pf.Space(), pf.Str("for"), pf.Space(), link), api_version=tuple(api_version))
 
-    elif text_type == "text/html":
-        text = apply_regex_fixes(text, html_fixes)
-        doc: Doc = pf.convert_text(text, input_format="html", output_format="panflute", standalone=True)  # type: ignore
 
-    context = {"raw_metadata": {}, "headings": {}, "is_redirect": is_redirect}
-    pf.run_filters([action_scan_headings], doc=doc, job=job, context=context)
-    prepare_balanced_headings(context["headings"])
-    actions = [action_balance_headings, action_clean_link]
+def redirect_target(text: str) -> Optional[str]:
+    """The title of the page a redirect that is only a link redirects to, read without Pandoc.
+
+    Args:
+        text (str): text from pandoc_source, e.g. "Alias for [[Some page#Section]]"
+
+    Returns:
+        Optional[str]: the title, e.g. "Some page", or None if the text has to be read by Pandoc
+    """
+    if not (match := redirect_link_pattern.fullmatch(text)):
+        return None
+    return " ".join(match.group("target").split("#", 1)[0].replace("_", " ").split()) or None
+
+
+# Titles and link targets repeat a lot, e.g. a popular page can be linked from thousands of others
+slug_cache_size = 65536
+
+
+@lru_cache(maxsize=slug_cache_size)
+def page_id(title: str) -> str:
+    """Returns the ID of a page with this title. It's lowercased, so that two titles differing only in case can't
+    overwrite each other's files on case insensitive file systems.
+
+    Args:
+        title (str): page title
+
+    Returns:
+        str: the page ID
+    """
+    return slugify(title, ok=SLUG_ID, spaces=True)
+
+
+def page_shard(id: str, shards: int) -> int:
+    """The shard a page is converted in when a source is split in shards, e.g. to convert it on several machines. It
+    only depends on the page ID, so that it's the same in every run and pages with the same ID are in the same shard.
+
+    Args:
+        id (str): page ID
+        shards (int): number of shards
+
+    Returns:
+        int: the shard, from 1 to shards
+    """
+    return zlib.crc32(id.encode("utf-8")) % shards + 1
+
+
+@lru_cache(maxsize=slug_cache_size)
+def page_slug(title: str) -> str:
+    # File name retains mixed case vs ID, as it looks better and fits Github Pages/Wiki if uploaded
+    return slugify(title, ok=SLUG_ID, lower=False, spaces=True)
+
+
+def page_path(title: str, out_folder: str) -> str:
+    return os.path.join(out_folder, page_slug(title) + ".md")
+
+
+@lru_cache(maxsize=slug_cache_size)
+def link_slug(url: str) -> str:
+    return slugify(url, lower=False, spaces=True)
+
+
+def pandoc_source(text: str, text_type: str) -> Source:
+    """Applies the fixes for the text type before it's read by Pandoc.
+
+    Args:
+        text (str): source text
+        text_type (str): mimetype of the text
+
+    Returns:
+        Source: fixed text and the Pandoc input format to read it with
+    """
     if text_type == "text/x-wiki":
-        actions += [action_extract_namespace]
-    elif text_type == "text/html":
-        pass
+        return apply_regex_fixes(text, mediawiki_fix_table), "mediawiki"
+    else:
+        return apply_regex_fixes(text, html_fix_table), "html"
+
+
+def prefetch_pandoc(generator, pandoc: PandocDriver, filter: str = "", manifest=None, namespace: Optional[int] = None):
+    """Passes through documents from a generator, but first reads them ahead in chunks with a single Pandoc call per
+    chunk, so that job_doc_to_markdown doesn't need to start Pandoc to read each document.
+
+    Args:
+        generator (Iterable): document data, e.g. from doc_generator
+        pandoc (PandocDriver): the driver that job_doc_to_markdown will get from the batch context
+        filter (str, optional): same filter as in the batch context, to not read documents that will be skipped
+        manifest (Manifest, optional): same manifest as in the batch context, to not read unchanged documents
+        namespace (int, optional): same namespace as in the batch context, if selected, to read titles in it
+
+    Yields:
+        dict: document data, unchanged
+    """
+    for chunk in pandoc.chunked(generator):
+        sources = []
+        for data in chunk:
+            title = data.get("title", "")
+            if not title or (namespace is None and all_ns_pattern.match(title).group("ns")):
+                continue
+            if filter and filter.lower() not in page_id(title):
+                continue
+            if manifest:
+                file_path = page_path(title, manifest.out_folder)
+                if manifest.is_unchanged(page_id(title), manifest.page_hash(data, file_path), file_path):
+                    continue
+            if data.get("text/x-wiki", "") or data.get("text/html", ""):
+                text, text_type, is_redirect = source_text(data)
+                source = pandoc_source(text, text_type)
+                if not (is_redirect and redirect_link_pattern.fullmatch(source[0])):
+                    sources.append(source)  # Redirects that are only a link are converted without Pandoc
+        pandoc.prefetch(sources)
+        yield from chunk
+
+
+def add_page_metadata(metadata: Dict, job: Job, data: Dict, id: str, title: str) -> Optional[datetime.datetime]:
+    """Adds the metadata of a document that goes into the frontmatter of its page, besides what filters found.
+
+    Args:
+        metadata (Dict): metadata to add to
+        job (Job): the job, for the extra metadata of the batch
+        data (Dict): document data
+        id (str): page ID
+        title (str): page title
 
-    pf.run_filters(actions, doc=doc, job=job, context=context)
+    Returns:
+        Optional[datetime.datetime]: the creation time, if there
+    """
+    birthtime = None
+    metadata["id"] = id
+    metadata["title"] = title
+    if data.get("created_at", False):
+        birthtime = parse_datetime(data["created_at"])
+        metadata["created_at"] = birthtime.isoformat()
+    if data.get("updated_at", False):
+        metadata["updated_at"] = parse_datetime(data["updated_at"]).isoformat()
+    if data.get("author", False):
+        metadata["author"] = data["author"]
+    if job.context.get("extra_metadata", None):
+        # Override with provided metadata
+        metadata.update(job.context.get("extra_metadata", None))
+    return birthtime
+
+
+class Converted(NamedTuple):
+    metadata: Dict  # For the frontmatter
+    text: str  # Markdown, without the frontmatter
+    doc: Doc
+    birthtime: Optional[datetime.datetime]  # From created_at, if there
+
+
+def convert_document(
+    job: Job, data: Dict, id: str, title: str, text: str, text_type: str, is_redirect: int, pandoc: PandocDriver
+) -> Converted:
+    """Converts the text of a document to Markdown, with fixes and filters, and collects its metadata.
+
+    Args:
+        job (Job): the job, for logging and settings
+        data (Dict): document data, for its metadata
+        id (str): page ID
+        title (str): page title
+        text (str): text to convert, from source_text
+        text_type (str): mimetype of the text
+        is_redirect (int): if the text is a redirect
+        pandoc (PandocDriver): driver to read and write with
+
+    Returns:
+        Converted: the Markdown and metadata
+    """
+    file_birthtime = None
+    # Apply fixes on input and read it with Pandoc, unless already read ahead by prefetch_pandoc
+    with timed(job, "regex_fixes"):
+        text, input_format = pandoc_source(text, text_type)
+    # A redirect that is only a link is not read with Pandoc, as it's known what Pandoc would read
+    if (doc := redirect_doc(text, pandoc.api_version) if is_redirect else None) is None:
+        with timed(job, "pandoc_read"):
+            doc = pandoc.read(text, input_format)
+        job_times(job).add("pandoc_read", pandoc.read_ahead_seconds(text, input_format))
+
+    # Headings can only be balanced when all have been scanned, so that is done after on just the headers
+    context = {"raw_metadata": {}, "headings": {}, "headers": [], "is_redirect": is_redirect}
+    with timed(job, "filters"):
+        (wiki_filters if text_type == "text/x-wiki" else html_filters).run(doc, job, context)
+        prepare_balanced_headings(context["headings"])
+        for header in context["headers"]:
+            action_balance_headings(header, doc, job, context)
 
     if not job.batch.no_metadata:
-        context["raw_metadata"]["id"] = id
-        context["raw_metadata"]["title"] = title
-        if data.get("created_at", False):
-            dt = parse_datetime(data["created_at"])
-            context["raw_metadata"]["created_at"] = dt.isoformat()
-            file_birthtime = dt
-        if data.get("updated_at", False):
-            dt = parse_datetime(data["updated_at"])
-            context["raw_metadata"]["updated_at"] = dt.isoformat()
-        if data.get("author", False):
-            context["raw_metadata"]["author"] = data["author"]
-        if job.context.get("extra_metadata", None):
-            # Override with provided metadata
-            context["raw_metadata"].update(job.context.get("extra_metadata", None))
+        file_birthtime = add_page_metadata(context["raw_metadata"], job, data, id, title)
         # Sort all metadata and wrap every item in RawInline to avoid markdown escaping. See issue https://github.com/jgm/pandoc/issues/2139
         doc.metadata = clean_metadata(context["raw_metadata"])
 
@@ -645,10 +1139,149 @@ def job_doc_to_markdown(job: Job, data):
     # extra_args += ["--columns=100"]
     extra_args += ["--reference-links"]
 
-    mdtext: str = pf.convert_text(
-        doc, input_format="panflute", output_format=output_format, standalone=True, extra_args=extra_args
-    )  # type: ignore
-    mdtext = apply_regex_fixes(mdtext, markdown_fixes, job=job)
+    with timed(job, "pandoc_write"):
+        mdtext: str = pandoc.write(doc, output_format, extra_args)
+    with timed(job, "regex_fixes"):
+        mdtext = apply_regex_fixes(mdtext, markdown_fix_table, job=job)
+
+    return Converted(context["raw_metadata"], mdtext, doc, file_birthtime)
+
+
+def page_text(metadata: Dict, mdtext: str) -> str:
+    with io.StringIO() as f:
+        # Manually write YAML header as not supported yet for Commonmark https://github.com/jgm/pandoc/issues/6629
+        f.write("---\n")
+        yaml.dump(metadata, f, allow_unicode=True)
+        f.write("---\n")
+        f.write(mdtext)
+        return f.getvalue()
+
+
+def skip_page(job: Job, title: str, id: str) -> Optional[Job]:
+    # The completed job if the page is filtered out or in a namespace, otherwise None. Titles in a namespace are only
+    # converted if a namespace was selected, with the namespace of the batch.
+    if (filter := job.context.get("filter", "")) and filter.lower() not in id:
+        # print(f"filter={job.context['filter']}, id={id}, in it={job.context['filter'] in id}")
+        return job.complete(JobSuccess.SKIP)
+
+    match = all_ns_pattern.match(title)
+    if match and match.group("ns") and job.context.get("namespace", None) is None:
+        return job.warn("Skipping doc as title includes a Mediawiki namespace").complete(JobSuccess.SKIP)
+    return None
+
+
+def claim_page(job: Job, title: str, id: str, is_redirect: int) -> Optional[Job]:
+    """Checks if a page should be converted, and if so claims its ID in the page registry, all_pages.
+
+    Args:
+        job (Job): the job
+        title (str): page title
+        id (str): page ID
+        is_redirect (int): if the page is a redirect
+
+    Returns:
+        Optional[Job]: the completed job if the page is skipped or failed, otherwise None
+    """
+    if (skipped := skip_page(job, title, id)) is not None:
+        return skipped
+
+    # If there is a doc with same id already we need to decide if we overwrite the old or fail the new
+    # We deem it safe to overwrite an existing doc if it's just a redirect, as they have the same ID (but would lose variations on the title)
+    # Note that we always overwrite _existing files_, this just checks if we already created the file earlier in the same batch
+    # Logic table
+    # old_redir	new_redir	action
+    # 1	        0	        overwrite old doc
+    # 1	        1	        overwrite old doc
+    # 0	        0	        fail new doc
+    # 0	        1	        fail new doc
+    # TODO another logic here could be to add unique suffix to id to save both new and old, but then it would break links pointing to new
+    # TODO if new is redir but not old, we could also add that manually as a variant name to the old YAML, if we allow ourselves to manyally correct the file
+    # The registry applies it, so that concurrent writers to a shared registry agree
+    if (old := page_registry(job.context).claim(id, title, is_redirect)) is not None and not old.is_redirect:
+        return job.error(
+            f"Forced to skip this doc '{title}' as it might overwrite already processed doc with '{os.path.join(job.context['out_folder'], old.title)}.md'"
+        ).complete(JobSuccess.FAIL)
+    elif old is not None:
+        job.warn("Overwrote older redirect doc with same id")
+    job.claimed = True  # E.g. for a fallback after the job went over the limits
+    return None
+
+
+def write_output(job: Job, files: List[OutputFile]):
+    # With a background writer in the context, files are written while the next documents are converted
+    for output_file in files:
+        if writer := job.context.get("writer", None):
+            writer.write(output_file)
+        else:
+            write_file(output_file)
+            set_mtime(output_file)
+
+
+def fail_unwritten(jobs: List[Job], errors: List[Tuple[str, str]]) -> List[Job]:
+    """Fails the jobs whose files a writer couldn't write, e.g. a BackgroundWriter that wrote them after the jobs
+    completed.
+
+    Args:
+        jobs (List[Job]): processed jobs
+        errors (List[Tuple[str, str]]): paths the writer failed to write, with the error
+
+    Returns:
+        List[Job]: the jobs that failed
+    """
+    errors_by_path = dict(errors)
+    failed = []
+    for job in jobs if errors_by_path else []:
+        if not isinstance(job.result, dict) or not (path := job.result.get("path", "")):
+            continue
+        if error := errors_by_path.get(path, "") or errors_by_path.get(path + ".debug.json", ""):
+            job.error(f"Could not write the page: {error}").complete(JobSuccess.FAIL, result={"path": path})
+            failed.append(job)
+    return failed
+
+
+def job_doc_to_markdown(job: Job, data):
+    assert "title" in data
+    title = data["title"]
+    assert len(title) > 0, "Title cannot be empty"
+    job_times(job).title = title
+    is_redirect = source_kind(data)[1]  # The text is only decoded if the page is converted
+    pandoc: PandocDriver = job.context.get("pandoc", None) or default_driver
+
+    assert job.context.get("out_folder", ""), "out_folder path not in context"
+
+    id = page_id(title)
+    assert id, "ID is empty"
+    job.id = id
+
+    file_path = page_path(title, job.context["out_folder"])
+
+    # With fold_redirects, a redirect that is only a link is not written, but added as an alias to the page it
+    # redirects to by an AliasFolder, once all pages are written
+    if is_redirect and job.context.get("fold_redirects", False):
+        if (skipped := skip_page(job, title, id)) is not None:
+            return skipped
+        if target := redirect_target(pandoc_source(*source_text(data)[:2])[0]):
+            return job.complete(result={"alias_for": page_id(target), "title": title})
+
+    # A page that replaces one written earlier in the run is always converted, but not the same page read again when
+    # resuming the run
+    registry = page_registry(job.context)
+    overwrites = (old := registry.get(id, None)) is not None and not registry.resumes(old, title, is_redirect)
+    if (skipped := claim_page(job, title, id, is_redirect)) is not None:
+        return skipped
+
+    # Skip pages that are the same as when converted in an earlier run, according to the manifest in out_folder
+    content_hash = None
+    if manifest := job.context.get("manifest", None):
+        content_hash = manifest.page_hash(data, file_path)
+        if not overwrites and manifest.is_unchanged(id, content_hash, file_path):
+            result = {"path": file_path, "hash": content_hash}
+            return job.debug("Unchanged since last run").complete(JobSuccess.SKIP, result=result)
+
+    text, text_type, is_redirect = source_text(data)
+    with job_time_limit(job):
+        converted = convert_document(job, data, id, title, text, text_type, is_redirect, pandoc)
+    mdtext, doc = converted.text, converted.doc
 
     json_str = ""
     if job.is_debug:
@@ -659,22 +1292,50 @@ def job_doc_to_markdown(job: Job, data):
     if job.is_dry_run:
         if job.is_bugreport:
             print("BUGREPORT:\n------------")
-            print(f"pandoc -f mediawiki -t {output_format} {' '.join(extra_args)} <<EOF\n{text}\nEOF")
+            args = f"-f mediawiki -t {commonmark.output_format} {' '.join(commonmark.extra_args)}"
+            print(f"pandoc {args} <<EOF\n{pandoc_source(text, text_type)[0]}\nEOF")
             print(json_str)
             print("------------")
         return job.complete(result={"text": mdtext, "debug": json_str, "path": file_path})
     else:
-        os.makedirs(os.path.dirname(file_path), exist_ok=True)  # Ensure dir exists
-        with open(file_path, "w") as f:
-            # Manually write YAML header as not supported yet for Commonmark https://github.com/jgm/pandoc/issues/6629
-            f.write("---\n")
-            yaml.dump(context["raw_metadata"], f, allow_unicode=True)
-            f.write("---\n")
-            f.write(mdtext)
-        if json_str:
-            with open(file_path + ".debug.json", "w") as f:
-                f.write(json_str)
-        if file_birthtime:
-            # Says it would set just access, modified time but also sets birthtime on MacOS!
-            os.utime(file_path, (time.time(), file_birthtime.timestamp()))
-        return job.complete(result={"path": file_path})
+        with timed(job, "write_file"):
+            mtime = converted.birthtime.timestamp() if converted.birthtime else None
+            files = [OutputFile(file_path, page_text(converted.metadata, mdtext), mtime, replaceable=bool(is_redirect))]
+            if json_str:
+                files.append(OutputFile(file_path + ".debug.json", json_str, replaceable=bool(is_redirect)))
+            write_output(job, files)
+        return job.complete(result={"path": file_path, "hash": content_hash} if content_hash else {"path": file_path})
+
+
+def job_doc_to_plain_markdown(job: Job, data, reason: str):
+    """Writes the page of a document that couldn't be converted within the JobLimits, with its text as in the source
+    in a code block. Neither Pandoc nor the filters are run. The reason is kept in the frontmatter as "unconverted",
+    so that the page can be found and fixed by hand.
+
+    Args:
+        job (Job): the job that went over the limits
+        data (Dict): document data
+        reason (str): why it went over the limits
+    """
+    title = data["title"]
+    id = job.id = page_id(title)
+    file_path = page_path(title, job.context["out_folder"])
+    text_type, is_redirect = source_kind(data)
+    # The page is claimed by the job, unless it went over the limits before that
+    if not getattr(job, "claimed", False) and (skipped := claim_page(job, title, id, is_redirect)) is not None:
+        return skipped
+    text = data[text_type]
+    metadata: Dict = {}
+    birthtime = None
+    if not job.batch.no_metadata:
+        birthtime = add_page_metadata(metadata, job, data, id, title)
+        metadata["unconverted"] = reason
+        clean_metadata(metadata)
+    fence = "`" * max([3, *(len(ticks) + 1 for ticks in re.findall("`{3,}", text))])
+    mdtext = f"{fence}{'mediawiki' if text_type == 'text/x-wiki' else 'html'}\n{text}\n{fence}\n"
+    job.warn(f"Converted as plain text, as it went over the limits: {reason}")
+    if job.is_dry_run:
+        return job.complete(result={"text": mdtext, "path": file_path})
+    mtime = birthtime.timestamp() if birthtime else None
+    write_output(job, [OutputFile(file_path, page_text(metadata, mdtext), mtime, replaceable=bool(is_redirect))])
+    return job.complete(result={"path": file_path})
@@ -0,0 +1,116 @@
+import hashlib
+import json
+import os
+from typing import Any, Callable, Dict, List, Set
+
+from .batch import Job, JobSuccess
+from .document import Document
+from .main import html_fixes, markdown_fixes, mediawiki_fixes
+
+# Kept in the out_folder, hidden as it's not a page
+manifest_name = ".db2md-manifest.json"
+
+
+class Manifest:
+    """Remembers a hash per page ID of everything that went into its Markdown file in the last run, so that pages
+    with an unchanged hash can be skipped without calling Pandoc, and pages no longer in the source can be found.
+    """
+
+    def __init__(self, out_folder: str, settings: Dict[str, Any]):
+        """Loads the manifest from the out_folder, if there.
+
+        Args:
+            out_folder (str): output folder of the batch
+            settings (Dict[str, Any]): anything else that changes the output of all pages, e.g. extra metadata and
+                the Pandoc version
+        """
+        self.out_folder = out_folder
+        self.path = os.path.join(out_folder, manifest_name)
+        self.pages: Dict[str, str] = {}
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                self.pages = json.load(f)["pages"]
+        self.updated: Dict[str, str] = {}
+        self.seen: Set[str] = set()
+        fix_sets = (mediawiki_fixes, html_fixes, markdown_fixes)
+        fixes = [(k, f.pattern.pattern, f.pattern.flags, f.repl) for fs in fix_sets for k, f in fs.items()]
+        self.salt = json.dumps({"fixes": fixes, "settings": settings}, sort_keys=True, default=str)
+
+    def page_hash(self, data: Dict, file_path: str) -> str:
+        """Hashes everything that goes into the Markdown file of a page.
+
+        Args:
+            data (Dict): document data
+            file_path (str): path the page is written to
+
+        Returns:
+            str: hex digest
+        """
+        keys = ("title", "text/x-wiki", "text/html", "created_at", "updated_at", "author")
+        if isinstance(data, Document) and (digest := data.source_digest):
+            # An escaped text is hashed as in the source, so that unchanged pages are skipped without decoding it
+            values = {k: data.get(k, "") if k != data.text_type else "sha1:" + digest for k in keys}
+        else:
+            values = {k: data.get(k, "") for k in keys}
+        content = {"data": values, "path": os.path.basename(file_path)}
+        h = hashlib.sha1(self.salt.encode("utf-8"))
+        h.update(json.dumps(content, sort_keys=True, default=str).encode("utf-8"))
+        return h.hexdigest()
+
+    def is_unchanged(self, id: str, page_hash: str, file_path: str) -> bool:
+        return bool(page_hash) and self.pages.get(id, None) == page_hash and os.path.exists(file_path)
+
+    def track(self, job_fn: Callable) -> Callable:
+        """Wraps a job function so that the manifest is updated with every processed job.
+
+        Args:
+            job_fn (Callable): job function, e.g. job_doc_to_markdown
+
+        Returns:
+            Callable: job function to give to Batch.process
+        """
+
+        def tracked_job_fn(job: Job, data):
+            try:
+                return job_fn(job, data)
+            finally:
+                self.add(job)
+
+        return tracked_job_fn
+
+    def add(self, job: Job):
+        # Converted or unchanged pages have a hash in the result, other processed pages are only seen
+        self.seen.add(job.id)
+        if isinstance(job.result, dict) and "hash" in job.result:
+            # If more than one doc was written to the page, they are always converted again as the last one has to
+            # overwrite the others
+            self.updated[job.id] = "" if job.id in self.updated else job.result["hash"]
+        elif job.success is JobSuccess.SKIP and job.id in self.pages:
+            self.updated[job.id] = self.pages[job.id]  # E.g. filtered out, but converted in an earlier run
+
+    def remove(self, id: str):
+        # A page that was converted but not written, so that it's converted again by the next run
+        self.updated.pop(id, None)
+
+    def finish(self, complete: bool = True) -> List[str]:
+        """Replaces the pages with those added since the manifest was loaded.
+
+        Args:
+            complete (bool, optional): if all pages in the source were processed, e.g. not if filtered.
+                Defaults to True.
+
+        Returns:
+            List[str]: IDs of pages in the manifest that were not in the source, if complete
+        """
+        unseen = sorted(id for id in self.pages if id not in self.seen)
+        if complete:
+            self.pages = self.updated
+            return unseen
+        self.pages = {**{id: self.pages[id] for id in unseen}, **self.updated}
+        return []
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path + ".tmp", "w") as f:
+            json.dump({"pages": self.pages}, f, indent=0, sort_keys=True)
+        os.replace(self.path + ".tmp", self.path)
@@ -0,0 +1,323 @@
+import json
+import time
+from itertools import islice
+from pathlib import Path
+from subprocess import PIPE, Popen, TimeoutExpired
+from shutil import which
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+import panflute as pf
+from panflute.elements import Doc, from_json
+
+from . import commonmark
+from .cache import ConversionCache
+from .limits import LimitExceeded
+
+# A source is the text and the Pandoc input format to read it with, e.g. ("== Heading ==", "mediawiki")
+Source = Tuple[str, str]
+
+read_batch_filter = Path(__file__).with_name("read_batch.lua")
+
+# Exit code of a Haskell program that ran out of the heap allowed with +RTS -M
+heap_exhausted = 251
+# How often a pandoc process with limits is checked
+limit_poll_seconds = 0.1
+
+
+def process_memory_mb(pid: int) -> float:
+    # Resident memory of a process, where /proc has it, otherwise 0
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            return next((int(line.split()[1]) / 1024 for line in f if line.startswith("VmRSS:")), 0.0)
+    except OSError:
+        return 0.0
+
+
+def cli_input(text: str) -> str:
+    """Prepares text the same way the pandoc CLI does with its input before handing it to a reader, as that step is
+    skipped when a Lua filter calls pandoc.read()
+
+    Args:
+        text (str): text to read
+
+    Returns:
+        str: text without BOM and carriage returns, tabs expanded to tab stop 4 and ending with a newline
+    """
+    text = (text[1:] if text.startswith("\ufeff") else text).replace("\r", "").expandtabs(4)
+    return text if text.endswith("\n") else text + "\n"
+
+
+def from_json_tree(value):
+    # Same as using from_json as object_hook in json.loads, but for JSON that is already loaded
+    if isinstance(value, dict):
+        return from_json({k: from_json_tree(v) for k, v in value.items()})
+    elif isinstance(value, list):
+        return [from_json_tree(v) for v in value]
+    return value
+
+
+class PandocDriver:
+    """Converts documents with as few pandoc processes as possible. Sources are read in chunks, each chunk with a
+    single pandoc call where a Lua filter reads every document separately, and the resulting Docs are kept until a
+    job asks for them with read().
+
+    Writing commonmark_x is done by the native writer in commonmark.py where it can, falling back to pandoc for
+    documents it doesn't support. The first `calibrate` natively written documents are also written by pandoc, and after
+    that every `check_every`th, and if any of them differ (e.g. with another pandoc version or a construct the native
+    writer gets wrong) the native writer is turned off.
+
+    With a cache, documents read and written by pandoc are kept on disk and reused in later runs.
+
+    Every pandoc process can be given a time limit per document it reads and a memory limit, and is killed with
+    LimitExceeded when it goes over. A chunk that goes over is read again one document at a time, so only the documents
+    over the limits are left out.
+    """
+
+    def __init__(
+        self,
+        chunk_size: int = 100,
+        native_writer: bool = True,
+        calibrate: int = 20,
+        check_every: int = 100,
+        cache: Optional[ConversionCache] = None,
+        timeout: Optional[float] = None,
+        max_memory_mb: Optional[int] = None,
+    ):
+        self.chunk_size = chunk_size
+        self.timeout = timeout  # Seconds per document, so a chunk gets as many times that as it has documents
+        self.max_memory_mb = max_memory_mb  # Heap per pandoc process
+        self.exceeded: Dict[Source, str] = {}  # Sources that went over the limits when prefetched, with the reason
+        self.failed: Dict[Source, str] = {}  # Sources that pandoc couldn't read when prefetched, with the error
+        self.cache = cache
+        self.prefetched: Dict[Source, List[Doc]] = {}
+        self.prefetch_seconds: Dict[Source, float] = {}  # Share of the chunk's read time, by text length
+        self.calls = 0  # Number of pandoc processes started, for diagnostics
+        self.native_writer = native_writer
+        self.calibrate = calibrate
+        self.check_every = check_every  # 0 to only check the first calibrate documents
+        self.native_renders = 0  # Number of documents the native writer could write, checked or not
+        self.native_writes = 0  # Number of documents written without pandoc, for diagnostics
+
+    def chunked(self, iterable: Iterable) -> Iterator[List]:
+        it = iter(iterable)
+        while chunk := list(islice(it, max(self.chunk_size, 1))):
+            yield chunk
+
+    def read(self, text: str, input_format: str) -> Doc:
+        """Returns a Doc for the text, from the prefetched chunk if there, otherwise converted on its own.
+
+        Args:
+            text (str): text to read
+            input_format (str): pandoc input format, e.g. mediawiki or html
+
+        Returns:
+            Doc: the panflute document
+        """
+        if docs := self.prefetched.get((text, input_format), None):
+            return docs.pop()
+        if (reason := self.exceeded.pop((text, input_format), None)) is not None:
+            raise LimitExceeded(reason)  # Not tried again
+        if (error := self.failed.pop((text, input_format), None)) is not None:
+            raise IOError(error)
+        if self.cache and (doc := self.cached_read(text, input_format)) is not None:
+            return doc
+        doc = self.pandoc_read(text, input_format)
+        if self.cache:
+            self.cache.put(self.read_key(text, input_format), json.dumps(doc.to_json()))
+        return doc
+
+    def run_pandoc(self, args: List[str], text: str, docs: int = 1) -> str:
+        """Runs pandoc within the limits. The heap of pandoc is limited by its runtime, but not what Lua filters use,
+        so the memory of the process is also checked while it runs, where the platform tells it.
+
+        Args:
+            args (List[str]): pandoc arguments
+            text (str): input
+            docs (int): number of documents in the input, the time limit is for each
+
+        Returns:
+            str: output
+        """
+        pandoc_path = which("pandoc")
+        if pandoc_path is None:
+            raise OSError("Path to pandoc executable does not exists")
+        if self.max_memory_mb:
+            args = [*args, "+RTS", f"-M{self.max_memory_mb}m", "-RTS"]
+        self.calls += 1
+        start = time.perf_counter()
+        timeout = self.timeout * docs if self.timeout else None
+        poll = None  # Without limits, waits until done
+        if timeout or self.max_memory_mb:
+            poll = min(limit_poll_seconds, timeout or limit_poll_seconds)
+        with Popen([pandoc_path, *args], stdin=PIPE, stdout=PIPE, stderr=PIPE) as proc:
+            try:
+                input: Optional[bytes] = text.encode("utf-8")
+                while True:
+                    try:
+                        out, err = proc.communicate(input, timeout=poll)
+                        break
+                    except TimeoutExpired:
+                        input = None  # Already sent
+                    if timeout and time.perf_counter() - start > timeout:
+                        raise LimitExceeded(f"Pandoc took over {timeout:g} s")
+                    if self.max_memory_mb and process_memory_mb(proc.pid) > self.max_memory_mb:
+                        raise LimitExceeded(f"Pandoc used over {self.max_memory_mb} MB")
+            except BaseException:
+                proc.kill()  # Also when stopped by a JobLimits time limit
+                raise
+        if proc.returncode == heap_exhausted and self.max_memory_mb:
+            raise LimitExceeded(f"Pandoc used over {self.max_memory_mb} MB")
+        elif proc.returncode != 0:
+            raise IOError(f"Pandoc failed: {err.decode('utf-8', errors='replace').strip()}")
+        return out.decode("utf-8")
+
+    def pandoc_read(self, text: str, input_format: str) -> Doc:
+        args = [f"--from={input_format}", "--to=json", "--standalone"]
+        return from_json_tree(json.loads(self.run_pandoc(args, text)))
+
+    def read_alone(self, source: Source) -> Optional[Doc]:
+        # Reads a source that was in a chunk on its own, or None if it goes over the limits or pandoc can't read it,
+        # to fail in its job
+        try:
+            return self.pandoc_read(*source)
+        except LimitExceeded as e:
+            self.exceeded[source] = str(e)
+        except IOError as e:
+            self.failed[source] = str(e)
+        return None
+
+    def read_key(self, text: str, input_format: str) -> str:
+        return ConversionCache.key("read", text, input_format, self.version)
+
+    def cached_read(self, text: str, input_format: str) -> Optional[Doc]:
+        assert self.cache
+        if (value := self.cache.get(self.read_key(text, input_format))) is not None:
+            return from_json_tree(json.loads(value))
+        return None
+
+    def read_many(self, sources: Sequence[Source]) -> List[Optional[Doc]]:
+        """Reads all sources with a single pandoc call. If that fails, e.g. due to one broken document, we fall back
+        to reading them one by one.
+
+        Args:
+            sources (Sequence[Source]): texts and their input formats
+
+        Returns:
+            List[Optional[Doc]]: a panflute document per source, in the same order, or None if it went over the limits
+                or couldn't be read
+        """
+        if len(sources) < 2:
+            return [self.read_alone(s) for s in sources]
+        batch = {
+            "pandoc-api-version": self.api_version,
+            "meta": {},
+            "blocks": [{"t": "CodeBlock", "c": [["", [], [["format", f]]], cli_input(t)]} for t, f in sources],
+        }
+        try:
+            args = ["--from=json", "--to=json", f"--lua-filter={read_batch_filter}"]
+            out = json.loads(self.run_pandoc(args, json.dumps(batch), docs=len(sources)))
+        except (IOError, LimitExceeded):
+            return [self.read_alone(s) for s in sources]
+        docs = []
+        for i, div in enumerate(out["blocks"]):
+            (id, _, _), blocks = div["c"]
+            assert id == f"db2md-{i}", f"Unexpected block {id} in pandoc batch output"
+            meta = out["meta"].get(id, {"c": {}})["c"]
+            doc = {"pandoc-api-version": out["pandoc-api-version"], "meta": meta, "blocks": blocks}
+            docs.append(from_json_tree(doc))
+        assert len(docs) == len(sources), f"Expected {len(sources)} docs from pandoc but got {len(docs)}"
+        return docs
+
+    def prefetch(self, sources: Sequence[Source]):
+        """Reads the sources in one go so later calls to read() with the same text and format won't start pandoc.
+        Anything left over from the previous prefetch is dropped.
+
+        Args:
+            sources (Sequence[Source]): texts and their input formats
+        """
+        self.prefetched = {}
+        self.prefetch_seconds = {}
+        self.exceeded = {}
+        self.failed = {}
+        if self.cache:
+            uncached = []
+            for source in sources:
+                if (doc := self.cached_read(*source)) is not None:
+                    self.prefetched.setdefault(source, []).append(doc)
+                else:
+                    uncached.append(source)
+            sources = uncached
+        start = time.perf_counter()
+        docs = self.read_many(sources)
+        seconds_per_char = (time.perf_counter() - start) / max(sum(len(text) for text, _ in sources), 1)
+        for source, doc in zip(sources, docs):
+            if doc is None:
+                continue
+            self.prefetched.setdefault(source, []).append(doc)
+            self.prefetch_seconds[source] = len(source[0]) * seconds_per_char
+            if self.cache:
+                self.cache.put(self.read_key(*source), json.dumps(doc.to_json()))
+
+    def read_ahead_seconds(self, text: str, input_format: str) -> float:
+        # Time spent reading the text in prefetch, to count it for the job that gets the Doc
+        return self.prefetch_seconds.get((text, input_format), 0.0)
+
+    def write(self, doc: Doc, output_format: str, extra_args: Sequence[str] = ()) -> str:
+        """Writes the Doc in the output format, natively if possible and otherwise with pandoc.
+
+        Args:
+            doc (Doc): the panflute document
+            output_format (str): pandoc output format, including extensions
+            extra_args (Sequence[str], optional): extra pandoc arguments. Defaults to ().
+
+        Returns:
+            str: the text
+        """
+        native = None
+        is_commonmark = output_format == commonmark.output_format and tuple(extra_args) == commonmark.extra_args
+        if self.native_writer and is_commonmark:
+            try:
+                native = commonmark.write_commonmark_x(doc)
+            except commonmark.Unsupported:
+                pass
+        if native is not None:
+            self.native_renders += 1
+            checked = self.calibrate > 0 or (self.check_every > 0 and self.native_renders % self.check_every == 0)
+            if not checked:
+                self.native_writes += 1
+                return native
+            text = self.pandoc_write(doc, output_format, extra_args)
+            self.calibrate -= 1
+            self.native_writer = native == text
+            return text
+        if not self.cache:
+            return self.pandoc_write(doc, output_format, extra_args)
+        # Serialized once, for both the key and pandoc
+        doc_json = json.dumps(doc.to_json(), ensure_ascii=False)
+        key = ConversionCache.key("write", doc_json, output_format, list(extra_args), self.version)
+        if (text := self.cache.get(key)) is None:
+            text = self.pandoc_write(doc, output_format, extra_args, doc_json)
+            self.cache.put(key, text)
+        return text
+
+    def pandoc_write(self, doc: Doc, output_format: str, extra_args: Sequence[str] = (), doc_json: str = "") -> str:
+        args = ["--from=json", f"--to={output_format}", *extra_args, "--standalone"]
+        text = self.run_pandoc(args, doc_json or json.dumps(doc.to_json(), ensure_ascii=False))
+        return "\n".join(text.splitlines())  # Without \r\n and the last newline, like pf.convert_text
+
+    @property
+    def api_version(self):
+        if not hasattr(self, "_api_version"):
+            self._api_version = list(pf.convert_text("", standalone=True).api_version)
+            self.calls += 1
+        return self._api_version
+
+    @property
+    def version(self) -> str:
+        if not hasattr(self, "_version"):
+            self._version = pf.run_pandoc(args=["--version"]).splitlines()[0]  # E.g. "pandoc 2.19.2"
+            self.calls += 1
+        return self._version
+
+
+default_driver = PandocDriver()
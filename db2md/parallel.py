@@ -0,0 +1,190 @@
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from itertools import islice
+from typing import Any, Callable, Deque, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from .batch import Batch, Job, JobSuccess
+from .main import page_id, prefetch_pandoc
+from .pandoc_driver import PandocDriver
+from .profiling import JobTimes
+from .registry import MemoryRegistry, page_registry
+from .writer import ArchiveWriter, OutputFile
+
+
+class JobOutcome(NamedTuple):
+    # What a job in a worker process ended with, to be replayed on the job of the main batch
+    id: Any  # None if the job function didn't set one
+    log: List
+    success: JobSuccess
+    result: Any
+    error: Optional[BaseException]
+    times: Optional[JobTimes]  # Stage times, if the job function recorded any
+
+
+class ChunkOutcome(NamedTuple):
+    outcomes: List[JobOutcome]
+    pages: Dict[str, Tuple]  # The all_pages entries for the IDs in the chunk, after processing it
+    cache_stats: Dict[str, int]  # Conversion cache hits and misses in the chunk
+    write_errors: List[Tuple[str, str]]  # Files the background writer failed to write, with the error
+    files: List[OutputFile]  # Files for the main process to write, when writing to an archive
+
+
+# Each worker process has its own batch, that only lives to give jobs their settings and context
+worker_batch: Optional[Batch] = None
+
+
+def init_worker(batch_kwargs: Dict, pandoc_kwargs: Dict):
+    global worker_batch
+    if writer := batch_kwargs.get("writer", None):
+        batch_kwargs = {**batch_kwargs, "writer": writer.for_worker()}
+    worker_batch = Batch("Worker", pandoc=PandocDriver(**pandoc_kwargs), **batch_kwargs)
+
+
+def process_chunk(chunk: List[Dict], pages: Dict[str, Tuple], job_fn: Callable, resumed: bool = False) -> ChunkOutcome:
+    """Runs the job function on a chunk of documents in a worker process, in order.
+
+    Args:
+        chunk (List[Dict]): document data
+        pages (Dict[str, Tuple]): the all_pages entries from earlier chunks for the IDs in this chunk
+        job_fn (Callable): job function, e.g. job_doc_to_markdown
+        resumed (bool, optional): if the page registry of the batch is resumed. Defaults to False.
+
+    Returns:
+        ChunkOutcome: how each job ended and the all_pages entries after the chunk
+    """
+    assert worker_batch is not None, "Worker process not initialized"
+    worker_batch.context["all_pages"] = MemoryRegistry(pages, resume=resumed)
+    outcomes = []
+    pandoc = worker_batch.context["pandoc"]
+    context = worker_batch.context
+    if pandoc.cache:
+        pandoc.cache.stats.clear()
+    filters = {key: context.get(key, None) for key in ("manifest", "namespace")}
+    for data in prefetch_pandoc(chunk, pandoc, filter=context.get("filter", ""), **filters):
+        job = Job(None, batch=worker_batch)
+        error = None
+        try:
+            job_fn(job, data)
+        except Exception as e:
+            error = e
+        outcomes.append(JobOutcome(job.id, job.log, job.success, job.result, error, getattr(job, "times", None)))
+    write_errors, files = [], []
+    if writer := context.get("writer", None):
+        writer.flush()  # Files of the chunk are written before the next chunk with the same IDs can start
+        write_errors, writer.errors = writer.errors, []
+        if isinstance(writer, ArchiveWriter):
+            files = writer.take()
+    cache_stats = dict(pandoc.cache.stats) if pandoc.cache else {}
+    return ChunkOutcome(outcomes, dict(worker_batch.context["all_pages"].items()), cache_stats, write_errors, files)
+
+
+def chunk_page_ids(chunk: List[Dict]) -> List[str]:
+    ids = []
+    for data in chunk:
+        try:
+            if id := page_id(data.get("title", "")):
+                ids.append(id)
+        except Exception:
+            pass  # The job will fail on it in the same way
+    return ids
+
+
+class ParallelProcess:
+    """Runs a batch with the jobs spread over worker processes. Documents are sent in chunks, and the outcomes are
+    replayed on the jobs of the batch in the original order, so the summary is the same as when run in one process.
+
+    The all_pages rules for duplicate IDs depend on the order of documents, so a chunk with an ID that is also in
+    a chunk still being processed waits for that chunk and starts from the all_pages entry it ended with. That way
+    the same documents are failed or overwritten, and files written in the same order, however workers are scheduled.
+    """
+
+    def __init__(self, batch: Batch, workers: int, pandoc: PandocDriver, **batch_kwargs):
+        self.batch = batch
+        self.workers = workers
+        self.chunk_size = max(pandoc.chunk_size, 1)
+        self.pandoc = pandoc
+        self.pandoc_kwargs = {
+            "chunk_size": pandoc.chunk_size,
+            "native_writer": pandoc.native_writer,
+            "calibrate": pandoc.calibrate,
+            "check_every": pandoc.check_every,
+            "cache": pandoc.cache,
+            "timeout": pandoc.timeout,
+            "max_memory_mb": pandoc.max_memory_mb,
+        }
+        self.batch_kwargs = batch_kwargs  # Same settings and context as the batch, to create the worker batches
+        self.outcomes: Deque[JobOutcome] = deque()
+        # For each ID in a chunk not yet completed, the latest such chunk. Completed chunks are merged into all_pages
+        # and dropped, so this only grows with the chunks in flight, not with the pages of the run.
+        self.last_chunk: Dict[str, Future] = {}
+
+    def process(self, generator: Iterable, job_fn: Callable):
+        """Processes documents like Batch.process does but in worker processes.
+
+        Args:
+            generator (Iterable): document data, e.g. from doc_generator
+            job_fn (Callable): job function, has to be a module level function so it can be sent to workers
+        """
+        self.batch.process(self.run(generator, job_fn), self.replay_job)
+
+    def run(self, generator: Iterable, job_fn: Callable):
+        """Sends the documents to the workers and yields them back in order once processed. To be given to
+        Batch.process together with replay_job.
+
+        Args:
+            generator (Iterable): document data, e.g. from doc_generator
+            job_fn (Callable): job function, has to be a module level function so it can be sent to workers
+
+        Yields:
+            dict: document data, unchanged
+        """
+        all_pages = page_registry(self.batch.context)
+        with ProcessPoolExecutor(
+            self.workers, initializer=init_worker, initargs=(self.batch_kwargs, self.pandoc_kwargs)
+        ) as pool:
+            pending: Deque[Tuple[List[Dict], List[str], Future]] = deque()
+            it = iter(generator)
+            while chunk := list(islice(it, self.chunk_size)):
+                ids = chunk_page_ids(chunk)
+                pages = {}
+                for id in set(ids):
+                    if (future := self.last_chunk.get(id)) and id in (chunk_pages := future.result().pages):
+                        pages[id] = chunk_pages[id]
+                    elif id in all_pages:
+                        pages[id] = all_pages[id]  # From before this run, or a completed chunk
+                future = pool.submit(process_chunk, chunk, pages, job_fn, all_pages.resumed)
+                self.last_chunk.update((id, future) for id in ids)
+                pending.append((chunk, ids, future))
+                while len(pending) > self.workers * 2:
+                    yield from self.complete_chunk(*pending.popleft())
+            while pending:
+                yield from self.complete_chunk(*pending.popleft())
+
+    def complete_chunk(self, chunk: List[Dict], ids: List[str], future: Future):
+        result: ChunkOutcome = future.result()
+        page_registry(self.batch.context).update(result.pages)
+        for id in ids:
+            if self.last_chunk.get(id) is future:
+                del self.last_chunk[id]  # Later chunks get its pages from all_pages
+        if self.pandoc.cache:
+            self.pandoc.cache.stats.update(result.cache_stats)
+        if writer := self.batch.context.get("writer", None):
+            writer.errors.extend(result.write_errors)
+            for f in result.files:
+                writer.write(f)
+            result.files.clear()  # Handed to the writer, not to be kept with the future
+        for data, outcome in zip(chunk, result.outcomes):
+            self.outcomes.append(outcome)
+            yield data
+        result.outcomes.clear()  # The future is kept for its pages, but results could be large in dry runs
+
+    def replay_job(self, job: Job, data):
+        outcome = self.outcomes.popleft()
+        if outcome.id is not None:
+            job.id = outcome.id
+        job.log.extend(outcome.log)
+        if outcome.times is not None:
+            job.times = outcome.times
+        if outcome.error is not None:
+            raise outcome.error
+        return job.complete(outcome.success, outcome.result)
@@ -0,0 +1,143 @@
+import cProfile
+import json
+import math
+import os
+import time
+from collections.abc import Mapping
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional
+
+from .batch import Job
+
+# Stages of job_doc_to_markdown, in the order they run
+stages = ("regex_fixes", "pandoc_read", "filters", "pandoc_write", "write_file")
+
+
+class JobTimes:
+    """Wall time per stage of a job, kept on the job as `job.times`."""
+
+    def __init__(self, title: str = ""):
+        self.title = title
+        self.seconds: Dict[str, float] = {}
+
+    @property
+    def total(self) -> float:
+        return sum(self.seconds.values())
+
+    def add(self, stage: str, seconds: float):
+        self.seconds[stage] = self.seconds.get(stage, 0.0) + seconds
+
+
+def job_times(job: Job) -> JobTimes:
+    if getattr(job, "times", None) is None:
+        job.times = JobTimes()
+    return job.times
+
+
+@contextmanager
+def timed(job: Job, stage: str):
+    """Adds the wall time of the block to a stage of the job.
+
+    Args:
+        job (Job): the job
+        stage (str): stage name, e.g. "filters"
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        job_times(job).add(stage, time.perf_counter() - start)
+
+
+def timed_iter(iterable: Iterable, seconds: Dict[str, float], stage: str) -> Iterator:
+    """Passes through the items of an iterable, adding the time spent getting them to seconds[stage], e.g. to time
+    reading the documents from a dump, which for SQL dumps is mostly spent before the first document.
+    """
+    it = iter(iterable)
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(it)
+        except StopIteration:
+            return
+        finally:
+            seconds[stage] = seconds.get(stage, 0.0) + time.perf_counter() - start
+        yield item
+
+
+def percentile(values: List[float], p: float) -> float:
+    # Nearest rank of sorted values
+    return values[max(math.ceil(p / 100 * len(values)) - 1, 0)] if values else 0.0
+
+
+def stage_summary(jobs: Iterable[Job], slowest: int = 10, batch_seconds: Optional[Dict[str, float]] = None) -> str:
+    """Summarizes the stage times of jobs, with p50/p95/max per stage and the slowest documents.
+
+    Args:
+        jobs (Iterable[Job]): processed jobs, those without times are ignored
+        slowest (int, optional): number of slowest documents to list. Defaults to 10.
+        batch_seconds (Dict[str, float], optional): times of stages not done per job, e.g. reading the dump
+
+    Returns:
+        str: the summary, or empty if no job had times
+    """
+    times = [t for job in jobs if (t := getattr(job, "times", None)) is not None and t.seconds]
+    if not times:
+        return ""
+    lines = [f"{'Stage':14} {'Docs':>7} {'Total s':>9} {'p50 ms':>9} {'p95 ms':>9} {'Max ms':>9}"]
+    for stage, seconds in (batch_seconds or {}).items():
+        lines.append(f"{stage:14} {'':>7} {seconds:9.2f}")
+    for stage in stages:
+        values = sorted(t.seconds[stage] for t in times if stage in t.seconds)
+        if values:
+            ms = [percentile(values, p) * 1000 for p in (50, 95, 100)]
+            lines.append(f"{stage:14} {len(values):7} {sum(values):9.2f} {ms[0]:9.1f} {ms[1]:9.1f} {ms[2]:9.1f}")
+    if slowest > 0:
+        lines.append(f"Slowest {min(slowest, len(times))} documents:")
+        for t in sorted(times, key=lambda t: t.total, reverse=True)[:slowest]:
+            stage = max(t.seconds, key=t.seconds.get)
+            lines.append(f"  {t.total * 1000:9.1f} ms  {t.title} (mostly {stage})")
+    return "\n".join(lines)
+
+
+class JobProfiler(NamedTuple):
+    """Profiles jobs with cProfile, and saves the profile and document data of jobs slower than the threshold, so a
+    slow page can be looked at, and converted again, on its own. Profiling slows down all jobs, so it's opt-in.
+    """
+
+    folder: str
+    threshold: float  # Seconds
+
+    def track(self, job_fn: Callable) -> "ProfiledJob":
+        """Wraps a job function so it's run with the profiler. Can be sent to worker processes if job_fn can.
+
+        Args:
+            job_fn (Callable): job function, e.g. job_doc_to_markdown
+
+        Returns:
+            ProfiledJob: job function to give to Batch.process
+        """
+        return ProfiledJob(self, job_fn)
+
+    def save(self, job: Job, data, profile: cProfile.Profile, seconds: float):
+        os.makedirs(self.folder, exist_ok=True)
+        name = str(job.id or "job").replace(os.sep, "_")
+        path = os.path.join(self.folder, name)
+        profile.dump_stats(path + ".prof")
+        with open(path + ".json", "w") as f:
+            json.dump(dict(data) if isinstance(data, Mapping) else data, f, ensure_ascii=False, indent=2, default=str)
+        job.info(f"Took {seconds:.2f} s, profile saved to {path}.prof and document to {path}.json")
+
+
+class ProfiledJob(NamedTuple):
+    profiler: JobProfiler
+    job_fn: Callable
+
+    def __call__(self, job: Job, data):
+        profile = cProfile.Profile()
+        start = time.perf_counter()
+        try:
+            return profile.runcall(self.job_fn, job, data)
+        finally:
+            if (seconds := time.perf_counter() - start) > self.profiler.threshold:
+                self.profiler.save(job, data, profile, seconds)
@@ -0,0 +1,16 @@
+-- Reads every CodeBlock of the input document as a separate document, in the format given by its "format"
+-- attribute. Each result is returned as a Div with id "db2md-<index>", and any metadata it had is stored under
+-- the same key in the output metadata. Every document gets its own reader state (e.g. for header identifiers),
+-- so the result is the same as converting them one by one.
+function Pandoc(doc)
+  local blocks = {}
+  for i, block in ipairs(doc.blocks) do
+    local id = "db2md-" .. (i - 1)
+    local read = pandoc.read(block.text, block.attributes["format"])
+    blocks[i] = pandoc.Div(read.blocks, pandoc.Attr(id))
+    if next(read.meta) ~= nil then
+      doc.meta[id] = read.meta
+    end
+  end
+  return pandoc.Pandoc(blocks, doc.meta)
+end
@@ -0,0 +1,234 @@
+import json
+import os
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from collections.abc import Mapping
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Set, Tuple, Union
+
+
+class PageEntry(NamedTuple):
+    title: str
+    is_redirect: int
+
+
+class PageRegistry(Mapping, ABC):
+    """The pages written in a run by page ID, read like the all_pages dict of (title, is_redirect) that it replaces,
+    and claimed by claim_page with the rules for two documents with the same ID: a redirect is replaced by a later
+    document, but any other page is not.
+
+    A registry can be kept in a file, so that it outlives the run, e.g. to resume an interrupted run or look up the
+    pages afterwards. A new run starts empty, unless resumed, and then a page claimed again with the same title and
+    kind is taken to be the same document read again.
+    """
+
+    resumed = False
+
+    def resumes(self, old: Optional[PageEntry], title: str, is_redirect: int) -> bool:
+        # If the entry that holds an ID is of the same page, read again in a resumed run
+        return old is not None and self.resumed and old == (title, int(bool(is_redirect)))
+
+    @abstractmethod
+    def claim(self, id: str, title: str, is_redirect: int) -> Optional[PageEntry]:
+        """Claims the ID for a page, unless it's held by a page that isn't a redirect, in one step so that concurrent
+        writers agree on who got it.
+
+        Args:
+            id (str): page ID
+            title (str): page title
+            is_redirect (int): if the page is a redirect
+
+        Returns:
+            Optional[PageEntry]: the entry that held the ID, which is replaced if it's a redirect, or None if the ID
+                was free or held by the same page in a resumed run
+        """
+
+    @abstractmethod
+    def update(self, pages: Union[Mapping, Iterable[Tuple[str, Tuple]]]):
+        """Sets entries as they are, e.g. those that worker processes ended with.
+
+        Args:
+            pages (Union[Mapping, Iterable[Tuple[str, Tuple]]]): (title, is_redirect) by page ID
+        """
+
+    def save(self):
+        pass  # Kept as written by default
+
+    def close(self):
+        pass
+
+
+class MemoryRegistry(PageRegistry):
+    """A registry in memory, with the title per ID and the redirects as a set, instead of a tuple per page. Threads
+    can claim pages concurrently. Given a path, it's loaded from there if resumed, and written there by save().
+    """
+
+    def __init__(self, pages: Optional[Mapping] = None, path: str = "", resume: bool = False):
+        self.path = path
+        self.resumed = resume
+        self.titles: Dict[str, str] = {}
+        self.redirects: Set[str] = set()
+        self.lock = threading.Lock()
+        if path and resume and os.path.exists(path):
+            with open(path) as f:
+                self.update((id, tuple(entry)) for id, entry in json.load(f)["pages"].items())
+        if pages:
+            self.update(pages)
+
+    def __getitem__(self, id: str) -> PageEntry:
+        return PageEntry(self.titles[id], int(id in self.redirects))
+
+    def __contains__(self, id) -> bool:
+        return id in self.titles
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.titles)
+
+    def __len__(self) -> int:
+        return len(self.titles)
+
+    def set(self, id: str, title: str, is_redirect: int):
+        self.titles[id] = title
+        if is_redirect:
+            self.redirects.add(id)
+        else:
+            self.redirects.discard(id)
+
+    def claim(self, id: str, title: str, is_redirect: int) -> Optional[PageEntry]:
+        with self.lock:
+            if self.resumes(old := self.get(id, None), title, is_redirect):
+                return None  # The same page, read again
+            if old is not None and not old.is_redirect:
+                return old
+            self.set(id, title, is_redirect)
+            return old
+
+    def update(self, pages: Union[Mapping, Iterable[Tuple[str, Tuple]]]):
+        with self.lock:
+            for id, (title, is_redirect) in pages.items() if isinstance(pages, Mapping) else pages:
+                self.set(id, title, is_redirect)
+
+    def save(self):
+        if not self.path:
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with open(self.path + ".tmp", "w") as f:
+            json.dump({"pages": {id: list(entry) for id, entry in self.items()}}, f, sort_keys=True)
+        os.replace(self.path + ".tmp", self.path)
+
+    def __getstate__(self):
+        # The lock can't be sent to worker processes, they get their own
+        return {k: v for k, v in self.__dict__.items() if k != "lock"}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state, lock=threading.Lock())
+
+
+class SqliteRegistry(PageRegistry):
+    """A registry in an SQLite file, written as pages are claimed, so that it stays within a fixed amount of memory
+    however many pages there are, and can be shared by processes, e.g. workers or runs on other shards.
+    """
+
+    def __init__(self, path: str, resume: bool = False):
+        self.path = os.path.abspath(path)
+        self.resumed = resume
+        self._con: Optional[sqlite3.Connection] = None
+        self.lock = threading.RLock()  # Threads share the connection
+        if not resume:
+            self.con.execute("DELETE FROM pages")
+
+    def __getstate__(self):
+        # Worker processes open their own connection, to the same run
+        return {"path": self.path, "resumed": self.resumed}
+
+    def __setstate__(self, state):
+        self.__init__(state["path"], resume=True)
+        self.resumed = state["resumed"]
+
+    @property
+    def con(self) -> sqlite3.Connection:
+        if self._con is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._con = sqlite3.connect(self.path, timeout=60, isolation_level=None, check_same_thread=False)
+            self._con.execute("PRAGMA journal_mode=WAL")
+            self._con.execute("PRAGMA synchronous=NORMAL")
+            self._con.execute(
+                "CREATE TABLE IF NOT EXISTS pages (id TEXT PRIMARY KEY, title TEXT, is_redirect INTEGER) WITHOUT ROWID"
+            )
+        return self._con
+
+    def query(self, sql: str, *args) -> List[Tuple]:
+        with self.lock:
+            return self.con.execute(sql, args).fetchall()
+
+    def __getitem__(self, id: str) -> PageEntry:
+        if not (rows := self.query("SELECT title, is_redirect FROM pages WHERE id = ?", id)):
+            raise KeyError(id)
+        return PageEntry(*rows[0])
+
+    def __contains__(self, id) -> bool:
+        return bool(self.query("SELECT 1 FROM pages WHERE id = ?", id))
+
+    def __iter__(self) -> Iterator[str]:
+        return (id for id, in self.query("SELECT id FROM pages ORDER BY id"))
+
+    def __len__(self) -> int:
+        return self.query("SELECT COUNT(*) FROM pages")[0][0]
+
+    def claim(self, id: str, title: str, is_redirect: int) -> Optional[PageEntry]:
+        # An immediate transaction, so that no other process claims the ID between reading and writing it
+        with self.lock:
+            self.con.execute("BEGIN IMMEDIATE")
+            try:
+                if self.resumes(old := self.get(id, None), title, is_redirect):
+                    return None  # The same page, read again
+                if old is not None and not old.is_redirect:
+                    return old
+                self.con.execute("INSERT OR REPLACE INTO pages VALUES (?, ?, ?)", (id, title, int(bool(is_redirect))))
+                return old
+            finally:
+                self.con.execute("COMMIT")
+
+    def update(self, pages: Union[Mapping, Iterable[Tuple[str, Tuple]]]):
+        items = pages.items() if isinstance(pages, Mapping) else pages
+        rows = [(id, title, int(bool(is_redirect))) for id, (title, is_redirect) in items]
+        with self.lock:
+            self.con.execute("BEGIN IMMEDIATE")
+            try:
+                self.con.executemany("INSERT OR REPLACE INTO pages VALUES (?, ?, ?)", rows)
+            finally:
+                self.con.execute("COMMIT")
+
+    def close(self):
+        if self._con is not None:
+            self._con.close()
+            self._con = None
+
+
+def open_registry(path: str = "", resume: bool = False) -> PageRegistry:
+    """Opens the registry kept in a file, in SQLite if it ends with .sqlite and otherwise in memory and saved as JSON.
+
+    Args:
+        path (str, optional): file to keep the registry in. Defaults to none, in memory for the run only.
+        resume (bool, optional): to continue the run the file was written by. Defaults to False.
+
+    Returns:
+        PageRegistry: the registry
+    """
+    if path.endswith(".sqlite"):
+        return SqliteRegistry(path, resume=resume)
+    return MemoryRegistry(path=path, resume=resume)
+
+
+def page_registry(context: Dict) -> PageRegistry:
+    """The registry of a batch context, that a plain all_pages dict given as context is turned into.
+
+    Args:
+        context (Dict): job or batch context
+
+    Returns:
+        PageRegistry: the registry, as "all_pages" in the context
+    """
+    if not isinstance(pages := context.get("all_pages", None), PageRegistry):
+        pages = context["all_pages"] = MemoryRegistry(pages)
+    return pages
@@ -0,0 +1,152 @@
+import json
+import os
+import shutil
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from .batch import Batch, Job, JobSuccess
+from .limits import exceeded_results, limit_summary
+from .main import claim_page, page_path
+from .manifest import Manifest
+from .registry import PageRegistry
+from .sql_dump import file_hash
+from .titles import AliasFolder
+
+# Kept in the out_folder of each shard, hidden as it's not a page
+shard_name = ".db2md-shard.json"
+
+
+def parse_shard(spec: str) -> Tuple[int, int]:
+    """Reads a shard given like 2/4, the second of four.
+
+    Args:
+        spec (str): i/n, with i from 1 to n
+
+    Returns:
+        Tuple[int, int]: i and n
+    """
+    i, _, n = spec.partition("/")
+    assert i.isdigit() and n.isdigit() and 1 <= int(i) <= int(n), f"A shard is given as i/n, from 1/n to n/n: {spec}"
+    return int(i), int(n)
+
+
+def save_shard(
+    out_folder: str,
+    source: str,
+    shard: Tuple[int, int],
+    batch: Batch,
+    all_pages: PageRegistry,
+    aliases: Optional[AliasFolder],
+):
+    """Saves what merge needs of a shard in its out_folder: the pages it wrote, the redirects it folded, which are
+    added as aliases when merged as their pages can be in other shards, and its summary.
+
+    Args:
+        out_folder (str): output folder of the shard
+        source (str): the source file, whose name tells shards of different sources apart, and whose hash that the
+            shards of a source were converted from the same dump
+        shard (Tuple[int, int]): i and n of the shard
+        batch (Batch): the processed batch
+        all_pages (PageRegistry): the page registry of the batch
+        aliases (Optional[AliasFolder]): the redirects folded, with fold_redirects
+    """
+    counts: Dict[str, int] = {}
+    for job in batch.jobs:
+        counts[job.success.name] = counts.get(job.success.name, 0) + 1
+    state = {
+        "source": os.path.basename(source),
+        "dump": file_hash(source),
+        "shard": list(shard),
+        "pages": {id: list(entry) for id, entry in all_pages.items()},
+        "aliases": {id: sorted(titles) for id, titles in aliases.aliases.items()} if aliases else {},
+        "counts": counts,
+        "exceeded": exceeded_results(batch.jobs),
+    }
+    path = os.path.join(out_folder, shard_name)
+    with open(path + ".tmp", "w") as f:
+        json.dump(state, f, sort_keys=True)
+    os.replace(path + ".tmp", path)
+
+
+class Shards:
+    """The shards of a source, converted into separate out_folders, e.g. on several machines, to merge into one. A
+    page ID is only in one shard of a source, but shards of different sources, e.g. of several wikis, can have the
+    same IDs, so they are claimed again in shard order, with the rules of claim_page.
+    """
+
+    def __init__(self, folders: List[str]):
+        self.states: List[Tuple[str, Dict]] = []
+        for folder in folders:
+            assert os.path.exists(path := os.path.join(folder, shard_name)), f"{folder} is not the output of a shard"
+            with open(path) as f:
+                self.states.append((os.path.abspath(folder), json.load(f)))
+        # In shard order, so that the result doesn't depend on the order the folders are given in
+        self.states.sort(key=lambda state: (state[1]["source"], state[1]["shard"]))
+        shards = [(state["source"], *state["shard"]) for _, state in self.states]
+        assert len(set(shards)) == len(shards), "A shard is given more than once"
+        dumps = {(state["source"], state.get("dump", "")) for _, state in self.states}
+        assert len(dumps) == len({source for source, _ in dumps}), (
+            "The shards of a source were not all converted from the same dump"
+        )
+        assert len({(source, n) for source, _, n in shards}) == len({source for source, *_ in shards}), (
+            "The shards of a source are not all of the same number of shards"
+        )
+
+    def pages(self) -> Iterator[Dict]:
+        """Yields the pages of every shard, as data for job_merge_page.
+
+        Yields:
+            Dict: the title, ID, if it's a redirect, the shard folder and hash in the shard's manifest of each page
+        """
+        for folder, state in self.states:
+            hashes = Manifest(folder, {}).pages
+            for id, (title, is_redirect) in state["pages"].items():
+                yield {"title": title, "id": id, "is_redirect": is_redirect, "folder": folder, "hash": hashes.get(id)}
+
+    def aliases(self) -> AliasFolder:
+        # The redirects folded by all shards
+        aliases = AliasFolder()
+        for _, state in self.states:
+            for id, titles in state["aliases"].items():
+                aliases.aliases.setdefault(id, set()).update(titles)
+        return aliases
+
+    def summary_str(self) -> str:
+        # What the shards converted, summed up, and the documents that went over the limits in any of them
+        counts: Dict[str, int] = {}
+        for _, state in self.states:
+            for name, count in state["counts"].items():
+                counts[name] = counts.get(name, 0) + count
+        lines = []
+        for source in sorted({state["source"] for _, state in self.states}):
+            shards = [state["shard"] for _, state in self.states if state["source"] == source]
+            missing = sorted(set(range(1, shards[0][1] + 1)) - {i for i, _ in shards})
+            line = f"{source}: shards {', '.join(f'{i}/{n}' for i, n in shards)}"
+            lines.append(line + (f", missing {', '.join(map(str, missing))}" if missing else ""))
+        lines.append(f"Converted in the shards: {counts}")
+        if exceeded := limit_summary([], [r for _, state in self.states for r in state["exceeded"]]):
+            lines.append(exceeded)
+        return "\n".join(lines)
+
+
+def job_merge_page(job: Job, data: Dict):
+    """Copies the page of a shard to the out_folder of the batch, if it claims its ID in the page registry.
+
+    Args:
+        job (Job): the job
+        data (Dict): page from Shards.pages
+    """
+    title, id = data["title"], data["id"]
+    job.id = id
+    if (skipped := claim_page(job, title, id, data["is_redirect"])) is not None:
+        return skipped
+    source_path, file_path = page_path(title, data["folder"]), page_path(title, job.context["out_folder"])
+    if not os.path.exists(source_path):
+        return job.warn(f"Not written by its shard {data['folder']}").complete(JobSuccess.SKIP)
+    if job.is_dry_run:
+        return job.complete(result={"path": file_path})
+    # Copied with the modification time, which is the creation time of the page
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    shutil.copy2(source_path, file_path)
+    if os.path.exists(source_path + ".debug.json"):
+        shutil.copy2(source_path + ".debug.json", file_path + ".debug.json")
+    return job.complete(result={"path": file_path, "hash": data["hash"]} if data["hash"] else {"path": file_path})
@@ -0,0 +1,610 @@
+import datetime
+import hashlib
+import io
+import json
+import os
+import re
+import sqlite3
+from codecs import decode, encode
+from typing import Callable, Container, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+from .compression import open_dump
+from .document import Document
+
+# Tables that the queries for each type of dump read, in the order types are detected. Statements for any other
+# table in a dump, e.g. the big searchindex or log tables of a Mediawiki dump, are skipped without being parsed.
+source_tables: Dict[str, Set[str]] = {
+    "mediawiki": {"page", "revision", "text", "user"},
+    "wordpress": {"wp_posts", "wp_users"},
+    "joomla": {"jos_content", "jos_users"},
+}
+# Tables that are loaded and read under another name, e.g. those of Joomla 1.0 and Mambo, which it was forked from,
+# that were prefixed mos_ instead of jos_
+table_aliases: Dict[str, str] = {"mos_content": "jos_content", "mos_users": "jos_users"}
+needed_tables = set().union(*source_tables.values(), table_aliases)
+
+# Rows that are documents, by the values of their columns, checked in the query. Others, e.g. the revisions,
+# autosaves, attachments and menu items in wp_posts, are never read. Their latest revision is the row they are a
+# revision of, which WordPress and Joomla update on every save.
+document_rows: Dict[str, Dict[str, Tuple]] = {
+    "wp_posts": {"post_type": ("post", "page"), "post_status": ("publish",)},
+    "jos_content": {"state": (1, -1)},  # Published and archived, which are still on the site
+}
+
+# Columns the queries join on, indexed in the loaded tables as the KEY definitions of the dump are dropped
+join_indexes: Dict[str, Tuple[str, ...]] = {
+    "page": ("page_latest",),
+    "revision": ("rev_id", "rev_user", "rev_text_id"),
+    "user": ("user_id",),
+    "text": ("old_id",),
+    "wp_posts": ("post_author",),
+    "wp_users": ("ID",),
+    "jos_content": ("created_by",),
+    "jos_users": ("id",),
+}
+
+# Columns that the predicates of a DocFilter are checked on in the query, and the format dates are stored in
+selection_columns: Dict[str, Dict[str, str]] = {
+    "mediawiki": {
+        "namespace": "page_namespace",
+        "author": "user_name",
+        "created": "rev_timestamp",  # Of the latest revision, the only one read
+        "updated": "rev_timestamp",
+        "text": "old_text",
+        "date_format": "%Y%m%d%H%M%S",
+    },
+    "wordpress": {
+        "namespace": "",
+        "author": "display_name",
+        "created": "post_date_gmt",
+        "updated": "post_modified_gmt",
+        "text": "post_content",
+        "date_format": "%Y-%m-%d %H:%M:%S",
+    },
+    "joomla": {
+        "namespace": "",
+        "author": "name",
+        "created": "created",
+        "updated": "COALESCE(NULLIF(modified, '0000-00-00 00:00:00'), created)",  # Zero if never modified
+        "text": "introtext || `fulltext`",
+        "date_format": "%Y-%m-%d %H:%M:%S",
+    },
+}
+
+date_predicates = (("created_since", ">="), ("created_before", "<"), ("updated_since", ">="), ("updated_before", "<"))
+
+# Bumped when the way dumps are loaded changes, so that staging databases of older versions are rebuilt
+staging_version = 2
+
+statement_table_pattern = re.compile(
+    r"\s*(?P<verb>CREATE TABLE(?: IF NOT EXISTS)?|INSERT(?: IGNORE)? INTO|REPLACE INTO)\s+`?(?P<table>\w+)`?", re.I
+)
+escape_pattern = re.compile(r"\\.")
+
+# For reading INSERT statements without SQLite
+insert_pattern = re.compile(
+    r"\s*(?:INSERT(?: IGNORE)? INTO|REPLACE INTO)\s+`?(?P<table>\w+)`?\s*(?:\((?P<columns>[^)]*)\))?\s*VALUES\s*\(",
+    re.I,
+)
+column_pattern = re.compile(r"^\s*`(?P<name>\w+)`", re.M)
+# A value and what follows it: a comma before the next value, or the end of the row and either the next row or the end
+value_pattern = re.compile(
+    r"\s*(?:'(?P<string>(?:[^'\\]+|\\.|'')*)'|(?P<literal>[^,)'\s]*))\s*(?P<end>,|\)\s*(?:,\s*\(|;?\s*\Z))", re.S
+)
+unescape_pattern = re.compile(r"\\(.)|''", re.S)
+# https://dev.mysql.com/doc/refman/8.0/en/string-literals.html, any other escaped character is itself
+mysql_escapes = {"0": "\0", "b": "\b", "n": "\n", "r": "\r", "t": "\t", "Z": "\x1a", "%": "\\%", "_": "\\_"}
+common_escapes = [("\\n", "\n"), ("\\'", "'"), ('\\"', '"'), ("\\r", "\r"), ("\\t", "\t")]
+
+# Columns the native reader keeps of each table, the rest are dropped as rows are read
+native_columns: Dict[str, Tuple[str, ...]] = {
+    "page": ("page_namespace", "page_title", "page_latest"),
+    "revision": ("rev_id", "rev_timestamp", "rev_user", "rev_text_id"),
+    "user": ("user_id", "user_name"),
+    "text": ("old_id", "old_text"),
+    "wp_posts": ("post_author", "post_title", "post_date_gmt", "post_modified_gmt", "post_content"),
+    "wp_users": ("ID", "display_name"),
+    "jos_content": ("created_by", "title", "created", "modified", "introtext", "fulltext"),
+    "jos_users": ("id", "name"),
+}
+# Long text columns, kept escaped and UTF-8 encoded in the documents, until the text is read. That's half the size
+# of a str with any character outside Latin-1.
+packed_columns = {"old_text", "post_content", "introtext", "fulltext"}
+
+
+def make_sqlite_safe(script: str) -> str:
+    """A quick and dirty way to convert from e.g. MySQL to SQLite.
+    artly based on https://gist.github.com/grfiv/b79ace3656113bcfbd9b7c7da8e9ae8d ,
+    and https://stackoverflow.com/questions/41026122/creating-sql-thats-compatible-with-both-sqlite-and-mysql-with-auto-increment
+    Args:
+        script (str): [description]
+
+    Returns:
+        str: [description]
+    """
+    script = re.sub(r"(int\(\d+\)) unsigned", "\\1", script, flags=re.MULTILINE)
+    script = re.sub(r"ENGINE=.*;$", ";", script, flags=re.MULTILINE)
+    script = re.sub(r" ?AUTO_INCREMENT ?", "", script, flags=re.MULTILINE)
+    script = re.sub(r"^CREATE DATABASE.*;$", "", script, flags=re.MULTILINE)
+    script = re.sub(r"^USE .*;$", "", script, flags=re.MULTILINE)
+    script = re.sub(r",?\s*(FULLTEXT|PRIMARY|UNIQUE)?\s*KEY .*$", "", script, flags=re.MULTILINE)
+    script = re.sub(r"^(UN)?LOCK.*$", "", script, flags=re.MULTILINE)
+    script = re.sub(r"ON UPDATE.*(,)?$", "\\1", script, flags=re.MULTILINE)
+    script = re.sub(r"enum\(.*,$", "blob,", script, flags=re.MULTILINE)
+    script = re.sub(r"\\'", "''", script, flags=re.MULTILINE)  # Sqlite escapes ' as '', not \'
+    return script
+
+
+def clean_escaping(s):
+    return decode(encode(s, "latin-1", "backslashreplace"), "unicode-escape")
+
+
+def sql_statements(lines: Iterable[str]) -> Iterator[str]:
+    """Splits a SQL dump into statements, without reading it all into memory. A statement ends with a ; at the end
+    of a line that is not inside a string, and comment lines between statements are dropped.
+
+    Args:
+        lines (Iterable[str]): lines of the dump, e.g. a text file
+
+    Yields:
+        str: each statement, with its trailing ;
+    """
+    lines_in_statement = []
+    in_string = False
+    for line in lines:
+        if not lines_in_statement and (line.startswith("--") or line.startswith("#") or not line.strip()):
+            continue
+        lines_in_statement.append(line)
+        # Each unescaped quote opens or closes a string, and '' inside one both closes and opens it again
+        if escape_pattern.sub("", line).count("'") % 2:
+            in_string = not in_string
+        if not in_string and line.rstrip().endswith(";"):
+            yield "".join(lines_in_statement)
+            lines_in_statement = []
+    if lines_in_statement:
+        yield "".join(lines_in_statement)
+
+
+def statement_table(statement: str) -> Optional[str]:
+    # The table a CREATE TABLE or INSERT statement is for, None for other statements
+    return match.group("table") if (match := statement_table_pattern.match(statement)) else None
+
+
+def rename_table(statement: str, table: str) -> str:
+    # The statement for another table, e.g. to load mos_content as jos_content
+    match = statement_table_pattern.match(statement)
+    return statement[: match.start("table")] + table + statement[match.end("table") :]  # type: ignore
+
+
+def mysql_date(value) -> Optional[str]:
+    # A DATETIME as text, or None if zero, which MySQL uses for unset dates, e.g. of articles never modified
+    return None if value is None or str(value).startswith("0000-00-00") else str(value)
+
+
+def document_rows_sql(table: str, where: str, params: List) -> Tuple[str, List]:
+    # Adds the conditions for the rows of a table that are documents to a WHERE clause from selection_sql
+    conditions, params = [], list(params)
+    for column, values in document_rows[table].items():
+        conditions.append(f"{table}.{column} IN ({', '.join('?' * len(values))})")
+        params.extend(values)
+    return (where + " AND " if where else " WHERE ") + " AND ".join(conditions), params
+
+
+def load_sql_dump(con: sqlite3.Connection, lines: Iterable[str], tables: Set[str] = needed_tables) -> Set[str]:
+    """Loads the tables that will be queried from a MySQL dump into SQLite, one statement at a time. Statements for
+    other tables, and statements that don't create or fill a table, are skipped unparsed.
+
+    Args:
+        con (sqlite3.Connection): database to load into
+        lines (Iterable[str]): lines of the dump
+        tables (Set[str], optional): tables to load. Defaults to those of all source types.
+
+    Returns:
+        Set[str]: the tables that were created
+    """
+    created = set()
+    for statement in sql_statements(lines):
+        if (table := statement_table(statement)) not in tables:
+            continue
+        if table in table_aliases:
+            statement, table = rename_table(statement, table_aliases[table]), table_aliases[table]
+        if statement.lstrip()[:6].upper() == "CREATE":
+            con.execute(make_sqlite_safe(statement))
+            created.add(table)
+        else:
+            # Only the quote escaping applies to data, the other rewrites are for table definitions
+            con.execute(statement.replace("\\'", "''"))
+    con.commit()
+    return created
+
+
+def index_join_keys(con: sqlite3.Connection, tables: Set[str]):
+    # Indexes the join columns that the loaded tables have
+    for table in tables:
+        columns = {row[1] for row in con.execute(f"PRAGMA table_info(`{table}`)")}
+        for column in join_indexes.get(table, ()):
+            if column in columns:
+                con.execute(f"CREATE INDEX IF NOT EXISTS `{table}_{column}` ON `{table}` (`{column}`)")
+    con.commit()
+
+
+def file_hash(path: str) -> str:
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as f:
+        while chunk := f.read(1024 * 1024):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def staging_path(db_file: str) -> str:
+    # The staging database is kept next to the dump, e.g. dump.sql.bz2.sqlite
+    return db_file + ".sqlite"
+
+
+def staged_dump(path: str, dump_hash: str) -> Optional[Tuple[sqlite3.Connection, Set[str]]]:
+    # Opens a staging database if it was loaded from a dump with this hash
+    if not os.path.exists(path):
+        return None
+    con = sqlite3.connect(path)
+    try:
+        meta = dict(con.execute("SELECT key, value FROM db2md_staging"))
+        if meta.get("dump_hash") == dump_hash:
+            return con, set(json.loads(meta["tables"]))
+    except sqlite3.DatabaseError:
+        pass  # Not a staging database, or from an interrupted run
+    con.close()
+    return None
+
+
+def stage_sql_dump(db_file: str, path: Optional[str] = None) -> Tuple[sqlite3.Connection, Set[str]]:
+    """Loads a SQL dump into an SQLite file next to it, with the join keys indexed, or reuses the file if it was
+    loaded from the same dump before. Later runs on the dump, e.g. with other filters, then only hash the dump
+    instead of loading it again.
+
+    Args:
+        db_file (str): path of the dump, compressed or not
+        path (str, optional): path of the staging database. Defaults to the dump path plus .sqlite.
+
+    Returns:
+        Tuple[sqlite3.Connection, Set[str]]: connection to the staging database, and the tables in it
+    """
+    path = path or staging_path(db_file)
+    dump_hash = f"{staging_version}:{file_hash(db_file)}"
+    if staged := staged_dump(path, dump_hash):
+        return staged
+    # Loaded into a temporary file that is renamed when complete, so an interrupted load is never reused
+    tmp_path = path + ".tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    con = sqlite3.connect(tmp_path)
+    con.execute("PRAGMA journal_mode=OFF")
+    con.execute("PRAGMA synchronous=OFF")
+    with open_dump(db_file) as f, io.TextIOWrapper(f, encoding="utf-8", errors="ignore") as text:
+        tables = load_sql_dump(con, text)
+    index_join_keys(con, tables)
+    con.execute("CREATE TABLE db2md_staging (key TEXT PRIMARY KEY, value TEXT)")
+    con.executemany(
+        "INSERT INTO db2md_staging VALUES (?, ?)", [("dump_hash", dump_hash), ("tables", json.dumps(sorted(tables)))]
+    )
+    con.commit()
+    con.close()
+    os.replace(tmp_path, path)
+    return sqlite3.connect(path), tables
+
+
+def source_type(tables: Set[str]) -> Optional[str]:
+    """Detects the type of a SQL dump from the tables it created, which has to include all that the queries for the
+    type read.
+
+    Args:
+        tables (Set[str]): names of the created tables
+
+    Returns:
+        Optional[str]: "mediawiki", "wordpress", "joomla", or None if not known
+    """
+    return next((name for name, needed in source_tables.items() if needed <= tables), None)
+
+
+def selected_namespace(selection) -> int:
+    # Only main pages are read, not e.g. talk, user and file pages, unless another namespace is selected
+    # https://gerrit.wikimedia.org/g/mediawiki/core/+/HEAD/includes/Defines.php
+    return selection.namespace if selection is not None and selection.namespace is not None else 0
+
+
+def selection_sql(selection, kind: str) -> Tuple[str, List]:
+    """Makes a WHERE clause of the predicates of a DocFilter that SQLite can check on a source type. Documents it
+    lets through are still checked in full after they are read.
+
+    Args:
+        selection (DocFilter): the selection, or None
+        kind (str): source type, e.g. "mediawiki"
+
+    Returns:
+        Tuple[str, List]: the clause, empty if there's nothing to check, and its parameters
+    """
+    if selection is None or kind not in selection_columns:
+        return "", []
+    columns = selection_columns[kind]
+    conditions, params = [], []
+    if selection.namespace is not None and columns["namespace"]:
+        conditions.append(f"{columns['namespace']} = ?")
+        params.append(selection.namespace)
+    if selection.author:
+        conditions.append(f"{columns['author']} = ?")
+        params.append(selection.author)
+    for name, op in date_predicates:
+        if (dt := getattr(selection, name)) is not None:
+            # Dates are stored as text in UTC, in a format that sorts in time order
+            column = columns[name.split("_")[0]]
+            conditions.append(f"CAST({column} AS TEXT) {op} ?")
+            params.append(dt.astimezone(datetime.timezone.utc).strftime(columns["date_format"]))
+    if selection.max_size is not None:
+        # The text is still escaped, and an escape is two characters for one, so this can't skip a page that fits
+        conditions.append(f"LENGTH({columns['text']}) <= ?")
+        params.append(selection.max_size * 2)
+    return (" WHERE " + " AND ".join(conditions) if conditions else ""), params
+
+
+def sql_generator(con: sqlite3.Connection, tables: Set[str], selection=None):
+    """Reads the documents from a loaded SQL dump.
+
+    Args:
+        con (sqlite3.Connection): database the dump was loaded into
+        tables (Set[str]): the tables that were created
+        selection (DocFilter, optional): only give the selected documents, checked in the query where possible
+
+    Yields:
+        Document: each page or post
+    """
+    con.row_factory = sqlite3.Row
+    cur = con.cursor()
+    where, params = selection_sql(selection, kind := source_type(tables) or "")
+    namespace = selected_namespace(selection)
+    if kind == "mediawiki":
+        # https://www.mediawiki.org/wiki/Manual:Database_layout
+        for row in cur.execute(
+            """
+            SELECT page_title,page_namespace,rev_timestamp,user_name,old_text FROM
+                page
+                    INNER JOIN revision ON page.page_latest = revision.rev_id
+                        INNER JOIN user ON revision.rev_user = user.user_id
+                            INNER JOIN text ON revision.rev_text_id = text.old_id
+            """
+            + where,
+            params,
+        ):
+
+            if row["page_namespace"] != namespace:
+                continue
+            title = clean_escaping(row["page_title"].replace("_", " "))
+            if selection and not selection.matches_title(title, namespace):
+                continue  # Before the text is unescaped
+            # Strings are escaped in text fields in SQL, check
+            # https://stackoverflow.com/questions/1885181/how-to-un-escape-a-backslash-escaped-string
+            data = Document(
+                title,
+                "text/x-wiki",
+                row["old_text"],
+                clean_escaping,
+                created_at=str(row["rev_timestamp"]),
+                author=row["user_name"],  # Also get email
+            )
+            if not selection or selection.matches(data, namespace):
+                yield data
+
+    elif kind == "wordpress":
+        # https://codex.wordpress.org/Database_Description#Table:_wp_posts
+        where, params = document_rows_sql("wp_posts", where, params)
+        for row in cur.execute(
+            """
+            SELECT post_title,post_date_gmt,post_modified_gmt,display_name,post_content FROM
+                wp_posts
+                    INNER JOIN wp_users ON wp_posts.post_author = wp_users.ID
+            """
+            + where,
+            params,
+        ):
+            title = clean_escaping(row["post_title"])
+            if selection and not selection.matches_title(title):
+                continue
+            data = Document(
+                title,
+                "text/html",
+                row["post_content"],
+                clean_escaping,
+                created_at=mysql_date(row["post_date_gmt"]),
+                updated_at=mysql_date(row["post_modified_gmt"]),
+                author=row["display_name"],  # Also get email
+            )
+            if not selection or selection.matches(data):
+                yield data
+
+    elif kind == "joomla":
+        # https://docs.joomla.org/Tables/content, an article is its intro text followed by the rest
+        where, params = document_rows_sql("jos_content", where, params)
+        for row in cur.execute(
+            """
+            SELECT title,created,modified,name,introtext || `fulltext` AS text FROM
+                jos_content
+                    LEFT JOIN jos_users ON jos_content.created_by = jos_users.id
+            """
+            + where,
+            params,
+        ):
+            # Left joined, as articles are kept when their author is deleted
+            title = clean_escaping(row["title"])
+            if selection and not selection.matches_title(title):
+                continue
+            data = Document(
+                title,
+                "text/html",
+                row["text"],
+                clean_escaping,
+                created_at=mysql_date(row["created"]),
+                updated_at=mysql_date(row["modified"]),
+                author=row["name"],
+            )
+            if not selection or selection.matches(data):
+                yield data
+
+
+def mysql_unescape(s: str) -> str:
+    # Decodes the escapes of a MySQL string literal
+    if "\\" not in s:
+        return s.replace("''", "'") if "''" in s else s
+    if "\\\\" not in s and "''" not in s:
+        # Every backslash escapes the next character, so escapes can't overlap and are replaced the fastest one by
+        # one, if they are all common ones
+        decoded = s
+        for escape, char in common_escapes:
+            decoded = decoded.replace(escape, char)
+        if "\\" not in decoded:
+            return decoded
+    return unescape_pattern.sub(lambda m: "'" if m.group(1) is None else mysql_escapes.get(m.group(1), m.group(1)), s)
+
+
+def mysql_literal(s: str):
+    # A value that isn't a string, e.g. 12, -1.5 or NULL
+    if s.upper() == "NULL":
+        return None
+    try:
+        return int(s)
+    except ValueError:
+        try:
+            return float(s)
+        except ValueError:
+            return s
+
+
+def insert_rows(statement: str) -> Tuple[str, Optional[List[str]], Callable[..., Iterator[tuple]]]:
+    """Reads the rows of an INSERT statement, e.g. "INSERT INTO `page` VALUES (1,0,'Title'),(2,0,'Other');", as
+    written by mysqldump.
+
+    Args:
+        statement (str): the statement
+
+    Returns:
+        Tuple[str, Optional[List[str]], Callable[..., Iterator[tuple]]]: the table, the columns if listed in the
+            statement, and a function giving the rows, with strings unescaped apart from those in the columns at the
+            indexes given to it, and numbers and NULL as Python values
+    """
+    match = insert_pattern.match(statement)
+    assert match, f"Not an INSERT statement: {statement[:100]}"
+    columns = [c.strip().strip("`") for c in match.group("columns").split(",")] if match.group("columns") else None
+
+    def rows(escaped: Container[int] = ()):
+        pos, row = match.end(), []
+        while value := value_pattern.match(statement, pos):
+            if (string := value.group("string")) is None:
+                row.append(mysql_literal(value.group("literal")))
+            else:
+                row.append(string if len(row) in escaped else mysql_unescape(string))
+            pos = value.end()
+            if (end := value.group("end")) != ",":
+                yield tuple(row)
+                row = []
+                if not end.endswith("("):
+                    return
+        raise ValueError(f"Can't read the values of {match.group('table')} at: {statement[pos:pos + 100]}")
+
+    return match.group("table"), columns, rows
+
+
+def native_sql_generator(lines: Iterable[str], selection=None):
+    """Reads the documents from a MySQL dump without SQLite, reading the rows of the INSERT statements directly and
+    joining the tables with dicts keyed on the join columns. Only the columns that go into the documents are kept,
+    and strings are unescaped once as they are read. Gives the same documents as loading the dump and sql_generator.
+
+    Args:
+        lines (Iterable[str]): lines of the dump
+        selection (DocFilter, optional): only give the selected documents. Pages are checked on their titles as they
+            are read, so that the revisions and texts of others aren't kept.
+
+    Yields:
+        Document: each page or post
+    """
+    columns: Dict[str, List[str]] = {}
+    rows: Dict[str, List[tuple]] = {table: [] for table in native_columns}
+    # Keys of the rows to keep of a Mediawiki table, known from the tables before it in the dump. Only the latest
+    # revision of each page, and its text, is needed, which is a small part of a dump with the full history.
+    wanted: Dict[str, Set[int]] = {}
+    for statement in sql_statements(lines):
+        table = statement_table(statement)
+        if (table := table_aliases.get(table, table)) not in native_columns:  # type: ignore
+            continue
+        if statement.lstrip()[:6].upper() == "CREATE":
+            columns[table] = column_pattern.findall(statement)
+            continue
+        _, listed, values = insert_rows(statement)
+        names = listed or columns.get(table, [])
+        needed = native_columns[table] + tuple(document_rows.get(table, ()))
+        assert all(c in names for c in needed), f"Table {table} lacks some of {needed}"
+        keep = [names.index(c) for c in native_columns[table]]
+        # Rows that aren't documents are dropped before their text is unescaped
+        checks = [(names.index(c), allowed) for c, allowed in document_rows.get(table, {}).items()]
+        if table in ("page", "revision"):
+            # mysqldump writes one table at a time, so rows that others were filtered on don't come after them
+            assert "text" not in wanted and (table == "revision" or "revision" not in wanted), f"{table} out of order"
+        if table == "revision" and "revision" not in wanted and rows["page"]:
+            wanted["revision"] = {latest for ns, _, latest in rows["page"] if ns == selected_namespace(selection)}
+        elif table == "text" and "text" not in wanted and rows["revision"] and "revision" in wanted:
+            wanted["text"] = {text_id for *_, text_id in rows["revision"]}
+        key, keys = keep[0], wanted.get(table, None)
+        packed = {i for i in keep if names[i] in packed_columns}
+        for row in values(packed):
+            if (keys is None or row[key] in keys) and all(row[i] in allowed for i, allowed in checks):
+                kept = tuple(row[i].encode("utf-8") if i in packed else row[i] for i in keep)
+                if table == "page" and selection and not selection.matches_title(kept[1].replace("_", " "), kept[0]):
+                    continue
+                rows[table].append(kept)
+
+    if (kind := source_type(set(columns))) == "mediawiki":
+        revisions = {rev_id: rest for rev_id, *rest in rows.pop("revision")}
+        users = dict(rows.pop("user"))
+        texts = dict(rows.pop("text"))
+        for namespace, title, latest in rows.pop("page"):
+            if namespace != selected_namespace(selection):
+                continue
+            # Inner joins, so pages without a revision, user or text are left out
+            if (rev := revisions.get(latest, None)) is None or rev[1] not in users or rev[2] not in texts:
+                continue
+            data = Document(
+                title.replace("_", " "),
+                "text/x-wiki",
+                texts[rev[2]],
+                mysql_unescape,
+                created_at=str(rev[0]),
+                author=users[rev[1]],
+            )
+            if not selection or selection.matches(data, namespace):
+                yield data
+    elif kind == "wordpress":
+        users = dict(rows.pop("wp_users"))
+        for author, title, created_at, updated_at, content in rows.pop("wp_posts"):
+            if author in users and (not selection or selection.matches_title(title)):
+                data = Document(
+                    title,
+                    "text/html",
+                    content,
+                    mysql_unescape,
+                    created_at=mysql_date(created_at),
+                    updated_at=mysql_date(updated_at),
+                    author=users[author],
+                )
+                if not selection or selection.matches(data):
+                    yield data
+    elif kind == "joomla":
+        users = dict(rows.pop("jos_users"))
+        for author, title, created_at, updated_at, intro, rest in rows.pop("jos_content"):
+            if not selection or selection.matches_title(title):
+                data = Document(
+                    title,
+                    "text/html",
+                    intro + rest,
+                    mysql_unescape,
+                    created_at=mysql_date(created_at),
+                    updated_at=mysql_date(updated_at),
+                    author=users.get(author, None),  # Left joined, as in sql_generator
+                )
+                if not selection or selection.matches(data):
+                    yield data
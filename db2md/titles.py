@@ -0,0 +1,154 @@
+import os
+from typing import Callable, Dict, Iterable, List, Mapping, NamedTuple, Optional, Set, Tuple
+
+import yaml
+
+from .batch import Job, JobSuccess
+from .document import Document
+from .main import all_ns_pattern, page_id, page_path, page_slug, page_text, wiki_redirect_pattern
+from .writer import OutputFile, set_mtime, write_file
+
+
+class TitleEntry(NamedTuple):
+    title: str
+    slug: str  # File name, without .md
+    namespace: str  # Empty if none, pages in a namespace are not converted
+    is_redirect: bool
+
+
+class TitleIndex:
+    """All titles in the source by page ID, built in one pass before converting, so that links can be checked
+    against the pages that actually exist. Only the titles are kept, not the texts.
+
+    Like all_pages, a redirect is replaced by a later page with the same ID, but not the other way around.
+    """
+
+    def __init__(self, generator: Iterable = ()):
+        self.pages: Dict[str, TitleEntry] = {}
+        for data in generator:
+            self.add(data)
+
+    def add(self, data: Dict):
+        if not (title := data.get("title", "")) or not (id := page_id(title)):
+            return
+        if (old := self.pages.get(id, None)) and not old.is_redirect:
+            return
+        if isinstance(data, Document):
+            # Without decoding the whole text
+            is_redirect = data.text_type == "text/x-wiki" and bool(wiki_redirect_pattern.match(data.head(16)))
+        else:
+            is_redirect = bool(wiki_redirect_pattern.match(data.get("text/x-wiki", "")))
+        match = all_ns_pattern.match(title)
+        self.pages[id] = TitleEntry(title, page_slug(title), match.group("ns") or "", is_redirect)
+
+    def get(self, title: str) -> Optional[TitleEntry]:
+        return self.pages.get(page_id(title), None)
+
+    def exists(self, target: str) -> bool:
+        """Checks if a link target is a page that will be converted.
+
+        Args:
+            target (str): link URL without namespace, e.g. "Some_page#Section"
+
+        Returns:
+            bool: True if the page is in the source and not in a namespace, or the link is within the same page
+        """
+        if not (title := target.split("#", 1)[0].replace("_", " ").strip()):
+            return True
+        return (entry := self.get(title)) is not None and not entry.namespace
+
+    def __len__(self) -> int:
+        return len(self.pages)
+
+
+class AliasFolder:
+    """Collects the redirects that job_doc_to_markdown folded instead of writing, with fold_redirects in the context,
+    and adds their titles as `aliases` to the frontmatter of the pages they redirect to, once all pages are written.
+    A redirect to another redirect is added to the page at the end of the chain. Pages that were skipped as unchanged
+    keep their file from an earlier run, so their aliases are replaced too, and the files of redirects written by an
+    earlier run without folding are removed.
+    """
+
+    def __init__(self):
+        self.aliases: Dict[str, Set[str]] = {}  # Titles of redirects by the page ID they redirect to
+        self.unchanged: Set[str] = set()  # IDs of pages skipped as unchanged, with aliases from an earlier run
+
+    def track(self, job_fn: Callable) -> Callable:
+        """Wraps a job function so that the redirects it folds are collected.
+
+        Args:
+            job_fn (Callable): job function, e.g. job_doc_to_markdown
+
+        Returns:
+            Callable: job function to give to Batch.process
+        """
+
+        def tracked_job_fn(job: Job, data):
+            try:
+                return job_fn(job, data)
+            finally:
+                self.add(job)
+
+        return tracked_job_fn
+
+    def add(self, job: Job):
+        if isinstance(job.result, dict) and "alias_for" in job.result:
+            self.aliases.setdefault(job.result["alias_for"], set()).add(job.result["title"])
+        elif isinstance(job.result, dict) and "path" in job.result and job.success is JobSuccess.SKIP:
+            self.unchanged.add(job.id)
+
+    def fold(self, all_pages: Mapping[str, Tuple], out_folder: str) -> List[str]:
+        """Adds the aliases to the frontmatter of the files of the pages they redirect to, following redirects to
+        other redirects, replacing those from an earlier run, which are removed from unchanged pages that no redirects
+        are folded into any more. The modification time of the files is kept.
+
+        Args:
+            all_pages (Mapping[str, Tuple]): the page registry of the batch, with the title of each page ID
+            out_folder (str): output folder of the batch
+
+        Returns:
+            List[str]: titles of redirects to pages that were not written, which are left out
+        """
+        # A folded redirect is never in all_pages, unless a page with the same ID was written instead
+        redirects = {id: target for target, titles in self.aliases.items() for id in map(page_id, titles)}
+        folded: Dict[str, Set[str]] = {}
+        for id, titles in self.aliases.items():
+            chain = {id}
+            while id not in all_pages and (id := redirects.get(id, id)) not in chain:
+                chain.add(id)
+            folded.setdefault(id, set()).update(titles)
+        missing = []
+        for id, titles in folded.items():
+            if id not in all_pages or not os.path.exists(path := page_path(all_pages[id][0], out_folder)):
+                missing.extend(titles)
+                continue
+            set_aliases(path, titles)
+        for title in (title for titles in self.aliases.values() for title in titles):
+            if page_id(title) not in all_pages and os.path.exists(path := page_path(title, out_folder)):
+                os.remove(path)  # Written by an earlier run without fold_redirects
+        for id in self.unchanged - folded.keys():
+            if id in all_pages and os.path.exists(path := page_path(all_pages[id][0], out_folder)):
+                set_aliases(path, set())
+        return sorted(missing)
+
+
+def set_aliases(path: str, titles: Set[str]):
+    """Replaces the aliases in the frontmatter of a page file, keeping its modification time.
+
+    Args:
+        path (str): the page file
+        titles (Set[str]): titles of the redirects to the page, if none the aliases are removed
+    """
+    with open(path) as f:
+        text = f.read()
+    # The frontmatter is always first, as written by page_text
+    end = text.index("\n---\n", 3)
+    metadata = yaml.safe_load(text[4:end]) or {}
+    if not titles and "aliases" not in metadata:
+        return
+    metadata.pop("aliases", None)
+    if titles:
+        metadata["aliases"] = sorted(titles)
+    output_file = OutputFile(path, page_text(metadata, text[end + 5 :]), os.stat(path).st_mtime)
+    write_file(output_file)
+    set_mtime(output_file)
@@ -0,0 +1,232 @@
+import io
+import os
+import tarfile
+import tempfile
+import threading
+import time
+import zipfile
+from queue import Queue
+from typing import IO, Dict, List, NamedTuple, Optional, Set, Tuple, Union
+
+# Suffixes of out_folder that make it an archive instead of a folder, and the tarfile mode to write them with
+archive_suffixes = {".zip": "zip", ".tar": "w", ".tar.gz": "w:gz", ".tgz": "w:gz"}
+
+
+class OutputFile(NamedTuple):
+    path: str
+    content: str
+    mtime: Optional[float] = None  # E.g. the creation time of the page, as a timestamp
+    replaceable: bool = False  # If a later page with the same ID may replace it, i.e. it's a redirect
+
+
+def write_file(f: OutputFile, dirs: Optional[Set[str]] = None):
+    """Writes a file to a temporary name next to it and then renames it, so that a reader (or an interrupted run)
+    never sees a half written file.
+
+    Args:
+        f (OutputFile): file to write
+        dirs (Set[str], optional): directories known to exist, to not check them again. Updated with new ones.
+    """
+    folder, name = os.path.split(f.path)
+    if dirs is None or folder not in dirs:
+        os.makedirs(folder, exist_ok=True)
+        if dirs is not None:
+            dirs.add(folder)
+    tmp_path = os.path.join(folder, f".{name}.tmp")
+    with open(tmp_path, "w") as out:
+        out.write(f.content)
+    os.replace(tmp_path, f.path)
+
+
+def set_mtime(f: OutputFile):
+    # Says it would set just access, modified time but also sets birthtime on MacOS!
+    if f.mtime is not None:
+        os.utime(f.path, (time.time(), f.mtime))
+
+
+class BackgroundWriter:
+    """Writes output files in a thread, so that conversion doesn't wait for disk (or network) I/O. Files are written
+    in the order they are given, in batches, and the modification times of a batch are set after all its files are
+    written.
+
+    Errors don't stop the writer, they are kept in `errors` to be reported at the end, and the jobs of the files
+    failed with fail_unwritten.
+    """
+
+    def __init__(self, batch_size: int = 64, max_pending: int = 256):
+        self.batch_size = batch_size
+        self.max_pending = max_pending  # Files waiting to be written, before write() blocks
+        self.errors: List[Tuple[str, str]] = []
+        self.written = 0
+        self._queue: Optional[Queue] = None
+        self._thread: Optional[threading.Thread] = None
+        self._dirs: Set[str] = set()
+
+    def for_worker(self) -> "BackgroundWriter":
+        # Worker processes start their own thread
+        return BackgroundWriter(self.batch_size, self.max_pending)
+
+    def write(self, f: OutputFile):
+        if self._thread is None:
+            self._queue = Queue(self.max_pending)
+            self._thread = threading.Thread(target=self._run, name="db2md-writer", daemon=True)
+            self._thread.start()
+        assert self._queue is not None
+        self._queue.put(f)
+
+    def flush(self):
+        # Waits until everything given so far is written
+        if self._queue is not None:
+            self._queue.join()
+
+    def close(self):
+        if self._thread is not None and self._queue is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread, self._queue = None, None
+
+    def _run(self):
+        assert self._queue is not None
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.batch_size and not self._queue.empty():
+                batch.append(self._queue.get())
+            try:
+                self.write_batch(batch)
+            finally:
+                # Also if the batch failed in a way not caught for each file, so that flush and close don't hang
+                for _ in batch:
+                    self._queue.task_done()
+            if None in batch:
+                return
+
+    def write_batch(self, batch: List[Optional[OutputFile]]):
+        written = []
+        for f in batch:
+            if f is None:
+                continue
+            try:
+                write_file(f, self._dirs)
+                written.append(f)
+            except Exception as e:  # E.g. UnicodeEncodeError, the thread has to go on
+                self.errors.append((f.path, str(e)))
+                self._dirs.discard(os.path.dirname(f.path))  # E.g. removed while running
+        self.written += len(written)
+        for f in written:
+            try:
+                set_mtime(f)
+            except Exception as e:
+                self.errors.append((f.path, str(e)))
+
+
+def archive_mode(path: str) -> Optional[str]:
+    # The mode to write an archive at this path with, or None if it's not an archive
+    for suffix, mode in archive_suffixes.items():
+        if path.lower().endswith(suffix):
+            return mode
+    return None
+
+
+class ArchiveWriter:
+    """Writes output files into a zip or tar archive instead of a folder, as they are converted. Paths of the files
+    are taken relative to the archive path, which is used as out_folder.
+
+    A file can't be replaced once in an archive, so redirect pages, which a later page with the same ID may replace,
+    are held back until the end, in a temporary file next to the archive so that they aren't kept in memory. Files
+    are matched on lowercased names, like page IDs, so the archive ends up with
+    the last page for each ID. The archive is written to a temporary name and renamed when closed.
+
+    In worker processes files are only collected, to be sent to the main process which writes the archive.
+    """
+
+    def __init__(self, path: str, is_worker: bool = False):
+        self.path = path
+        self.mode = archive_mode(path)
+        assert self.mode, f"Not a zip or tar archive: {path}"
+        self.is_worker = is_worker
+        self.errors: List[Tuple[str, str]] = []
+        self.written = 0
+        self.collected: List[OutputFile] = []  # In a worker, files to send to the main process
+        self._held: Dict[str, Tuple[str, Optional[float], int, int]] = {}  # Path, mtime, offset and size in _spool
+        self._spool: Optional[IO[bytes]] = None
+        self._names: Set[str] = set()
+        self._archive: Optional[Union[zipfile.ZipFile, tarfile.TarFile]] = None
+        self.closed = False
+
+    def for_worker(self) -> "ArchiveWriter":
+        return ArchiveWriter(self.path, is_worker=True)
+
+    def write(self, f: OutputFile):
+        if self.is_worker:
+            self.collected.append(f)
+            return
+        name = os.path.relpath(f.path, self.path).replace(os.sep, "/")
+        key = name.lower()
+        if key in self._names:
+            self.errors.append((f.path, "Already in the archive"))
+        elif f.replaceable:
+            self.hold(key, f)
+        else:
+            self._held.pop(key, None)
+            self.add(name, f)
+
+    def hold(self, key: str, f: OutputFile):
+        if self._spool is None:
+            self._spool = tempfile.TemporaryFile(dir=os.path.dirname(os.path.abspath(self.path)))
+        data = f.content.encode("utf-8")
+        offset = self._spool.seek(0, os.SEEK_END)
+        self._spool.write(data)
+        self._held[key] = (f.path, f.mtime, offset, len(data))
+
+    def take(self) -> List[OutputFile]:
+        collected, self.collected = self.collected, []
+        return collected
+
+    def flush(self):
+        pass  # Files are added as they come, apart from those held back
+
+    @property
+    def archive(self) -> Union[zipfile.ZipFile, tarfile.TarFile]:
+        if self._archive is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            if self.mode == "zip":
+                self._archive = zipfile.ZipFile(self.path + ".tmp", "w", compression=zipfile.ZIP_DEFLATED)
+            else:
+                self._archive = tarfile.open(self.path + ".tmp", self.mode)
+        return self._archive
+
+    def add(self, name: str, f: OutputFile):
+        mtime = f.mtime if f.mtime is not None else time.time()
+        data = f.content.encode("utf-8")
+        try:
+            if isinstance(self.archive, zipfile.ZipFile):
+                # Zip can't have times before 1980
+                info = zipfile.ZipInfo(name, date_time=time.localtime(max(mtime, 315532800 + 86400))[:6])
+                info.compress_type = zipfile.ZIP_DEFLATED
+                info.external_attr = 0o644 << 16
+                self.archive.writestr(info, data)
+            else:
+                info = tarfile.TarInfo(name)
+                info.size, info.mtime, info.mode = len(data), int(mtime), 0o644
+                self.archive.addfile(info, io.BytesIO(data))
+            self._names.add(name.lower())
+            self.written += 1
+        except (OSError, ValueError) as e:
+            self.errors.append((f.path, str(e)))
+
+    def close(self):
+        if self.is_worker or self.closed:
+            return
+        self.closed = True
+        for path, mtime, offset, size in self._held.values():
+            assert self._spool is not None
+            self._spool.seek(offset)
+            f = OutputFile(path, self._spool.read(size).decode("utf-8"), mtime)
+            self.add(os.path.relpath(path, self.path).replace(os.sep, "/"), f)
+        self._held = {}
+        if self._spool is not None:
+            self._spool.close()
+            self._spool = None
+        self.archive.close()
+        os.replace(self.path + ".tmp", self.path)
+        self._archive = None
@@ -1,6 +1,52 @@
 from db2md.batch import Batch, Job, JobSuccess, LogLevel
-from db2md.main import doc_generator, job_doc_to_markdown
+from db2md.main import (
+    ConversionBatch,
+    DocFilter,
+    FilterDispatcher,
+    FixTable,
+    action_clean_link,
+    action_extract_namespace,
+    convert_document,
+    doc_generator,
+    fail_unwritten,
+    job_doc_to_markdown,
+    job_doc_to_plain_markdown,
+    markdown_fixes,
+    match_trigger,
+    mediawiki_fixes,
+    pandoc_source,
+    prefetch_pandoc,
+    redirect_doc,
+    simple_truncate,
+    source_text,
+    utc_datetime,
+)
+from db2md.pandoc_driver import PandocDriver
+from db2md import commonmark
+from db2md.parallel import ParallelProcess
+from db2md.manifest import Manifest
+from db2md.cache import ConversionCache
+from db2md.compression import MultistreamReader, open_dump
+from db2md.limits import JobLimits, LimitExceeded, limit_summary
+from db2md.history import FastImportWriter, job_history_to_fast_import
+from db2md.profiling import JobProfiler, percentile, stages
+from db2md.registry import MemoryRegistry, SqliteRegistry, open_registry
+from db2md.shards import Shards, job_merge_page, save_shard
+from db2md.sql_dump import mysql_unescape
+from db2md.titles import AliasFolder, TitleIndex
+from db2md.writer import ArchiveWriter, BackgroundWriter, OutputFile, write_file
+from benchmarks import corpus, pipeline
 from pathlib import Path
+import io
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+import pickle
+import re
+import sqlite3
+import tarfile
+import time
+import zipfile
+import panflute as pf
 import pytest
 
 
@@ -74,6 +120,12 @@ def test_wrong_namespace(docs, tmp_path):
     assert job.result is None
     assert job.success is JobSuccess.SKIP  # Should skip as it's a Mall: namespace
 
+    # Unless the namespace is selected
+    test_batch.context["namespace"] = 10
+    job = Job(1, is_dry_run=True, batch=test_batch)
+    job_doc_to_markdown(job, docs[2])
+    assert job.success is not JobSuccess.SKIP and job.result["path"].endswith("MallTest.md")
+
 
 def test_empty_title(docs, tmp_path):
     test_batch = Batch("Test", dry_run=False, out_folder=tmp_path, all_pages={}, log_level=LogLevel.DEBUG)
@@ -88,6 +140,689 @@ def test_empty_title(docs, tmp_path):
     assert job.success is JobSuccess.INCOMPLETE  # As we excited in exception, it is incomplete
 
 
+def test_streaming_export_namespace(tmp_path):
+    # Newer exports use another schema version, which should be detected from the root element
+    xml_file = tmp_path / "export.xml"
+    xml_file.write_text(
+        '<mediawiki xmlns="http://www.mediawiki.org/xml/export-0.10/" version="0.10">'
+        + "".join(
+            f"<page><title>Page {i}</title><revision><timestamp>2020-01-0{i}T00:00:00Z</timestamp>"
+            f'<contributor><username>Ymir</username></contributor><text xml:space="preserve">Text {i}</text>'
+            "</revision></page>"
+            for i in range(1, 4)
+        )
+        + "</mediawiki>"
+    )
+    docs = list(doc_generator(str(xml_file)))
+    assert [d["title"] for d in docs] == ["Page 1", "Page 2", "Page 3"]
+    assert docs[2]["created_at"] == "2020-01-03T00:00:00Z"
+    assert docs[2]["author"] == "Ymir"
+    assert docs[2]["text/x-wiki"] == "Text 3"
+
+
+def test_compressed_dumps(tmp_path):
+    # Compressed dumps should give the same documents as uncompressed, also when decompressed in parallel
+    expected = {}
+    for name in ("dump.xml", "dump.xml.gz", "dump.xml.xz", "dump-multistream.xml.bz2", "dump.sql", "dump.sql.bz2"):
+        format = "mw-sql" if ".sql" in name else "mw-xml"
+        corpus.write_dump(format, 120, str(tmp_path / name))
+        expected.setdefault(format, list(doc_generator(str(tmp_path / name))))
+        assert list(doc_generator(str(tmp_path / name))) == expected[format]
+    with open_dump(str(tmp_path / "dump-multistream.xml.bz2")) as f:
+        assert isinstance(f.raw, MultistreamReader)
+        assert len(f.raw.blocks) == 3  # Header, 100 pages, and 20 pages with the footer
+
+
+def test_sql_table_pruning(tmp_path):
+    # Tables no query reads should be skipped unparsed, and a Mediawiki dump needs both page and revision
+    corpus.write_dump("mw-sql", 20, str(tmp_path / "dump.sql"))
+    expected = list(doc_generator(str(tmp_path / "dump.sql")))
+    script = (tmp_path / "dump.sql").read_text()
+    extra = (
+        "-- Table structure for table `searchindex`, which isn't SQLite's\n"
+        "CREATE TABLE `searchindex` (`si_page` int(10) unsigned, FULLTEXT KEY `si` (`si_page`)) ENGINE=MyISAM;\n"
+        "INSERT INTO `searchindex` VALUES (1,'it''s;\nnot; parsed\\');');\n"
+    )
+    (tmp_path / "extra.sql").write_text(extra + script)
+    assert list(doc_generator(str(tmp_path / "extra.sql"))) == expected
+    (tmp_path / "no_page.sql").write_text(script.replace("`page`", "`page_old`"))
+    assert list(doc_generator(str(tmp_path / "no_page.sql"))) == []
+
+
+def test_sql_staging(tmp_path):
+    # A staging database should give the same documents, and be reused until the dump changes
+    dump = tmp_path / "dump.sql.bz2"
+    corpus.write_dump("mw-sql", 20, str(dump))
+    expected = list(doc_generator(str(dump)))
+    assert list(doc_generator(str(dump), staging=True)) == expected
+    staging = tmp_path / "dump.sql.bz2.sqlite"
+    con = sqlite3.connect(staging)
+    indexes = {row[0] for row in con.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+    assert {"page_page_latest", "revision_rev_id", "revision_rev_user", "revision_rev_text_id"} <= indexes
+    con.close()
+    mtime = staging.stat().st_mtime_ns
+    assert list(doc_generator(str(dump), staging=True)) == expected
+    assert staging.stat().st_mtime_ns == mtime
+    corpus.write_dump("mw-sql", 10, str(dump))
+    assert len(list(doc_generator(str(dump), staging=True))) == 10
+    assert staging.stat().st_mtime_ns != mtime
+
+
+def test_native_sql_reader(tmp_path):
+    # Reading the INSERT statements directly should give the same documents as SQLite, also with old revisions
+    for format in ("mw-sql", "wp-sql"):
+        corpus.write_dump(format, 20, str(tmp_path / f"{format}.sql"))
+    script = (tmp_path / "mw-sql.sql").read_text()
+    first_text = script.index("INSERT INTO `text`")
+    script = (
+        script[:first_text]
+        + "INSERT INTO `revision` VALUES (1001,1,1001,1,'20000101000000');\n"
+        + script[first_text:]
+        + "INSERT INTO `text` (`old_id`, `old_text`) VALUES (1001,'Old \\'text\\'\\n');\n"
+    )
+    (tmp_path / "mw-sql.sql").write_text(script)
+    for format in ("mw-sql", "wp-sql"):
+        docs = list(doc_generator(str(tmp_path / f"{format}.sql"), native=True))
+        assert len(docs) == 20
+        assert docs == list(doc_generator(str(tmp_path / f"{format}.sql")))
+    assert mysql_unescape(r"it''s \'a\' \\n\n\%\Z") == "it's 'a' \\n\n\\%\x1a"
+
+
+def test_doc_filter_pushdown(tmp_path):
+    # Every reader should select the documents that match when checked after reading, and only those
+    selection = DocFilter(title_regex="^[A-M]", author="Kalle", created_since=utc_datetime("2012-01-01"), max_size=3000)
+    readers = [("mw-xml", False)] + [(format, native) for format in ("mw-sql", "wp-sql", "jl-sql") for native in (0, 1)]
+    for format, native in readers:
+        path = str(tmp_path / f"{format}{corpus.formats[format]}")
+        corpus.write_dump(format, 60, path)
+        everything = list(doc_generator(path, native=native))
+        expected = [d for d in everything if selection.matches(d)]
+        assert 0 < len(expected) < len(everything)
+        assert all(d["author"] == "Kalle" and d["title"][0] <= "M" for d in expected)
+        assert list(doc_generator(path, native=native, selection=selection)) == expected
+    assert list(doc_generator(path, selection=DocFilter(namespace=1))) == []  # Joomla has no namespaces
+
+    # A selected namespace should be read instead of the main pages
+    path = tmp_path / "mw-sql.sql"
+    path.write_text(path.read_text().replace("INSERT INTO `page` VALUES (1,0,", "INSERT INTO `page` VALUES (1,10,"))
+    for native in (0, 1):
+        main_pages = list(doc_generator(str(path), native=native))
+        docs = list(doc_generator(str(path), native=native, selection=DocFilter(namespace=10)))
+        assert len(main_pages) == 59 and [d["title"] for d in docs] == ["Velit 0"]
+
+
+def test_cms_readers(tmp_path):
+    # Only published posts and articles should be read, the same with both readers and either Joomla table prefix
+    for format in ("wp-sql", "jl-sql"):
+        corpus.write_dump(format, 50, str(tmp_path / f"{format}.sql"))
+    script = (tmp_path / "jl-sql.sql").read_text()
+    (tmp_path / "mos.sql").write_text(script.replace("`jos_", "`mos_"))
+    wordpress = list(doc_generator(str(tmp_path / "wp-sql.sql")))
+    joomla = list(doc_generator(str(tmp_path / "jl-sql.sql")))
+    assert len(wordpress) == 50 and [(d["title"], d["text/html"]) for d in joomla] == [
+        (d["title"], d["text/html"]) for d in wordpress
+    ]
+    assert sum("author" not in d for d in joomla) == 10 and sum("updated_at" not in d for d in joomla) == 16
+    for path in ("wp-sql.sql", "jl-sql.sql", "mos.sql"):
+        docs = list(doc_generator(str(tmp_path / path), native=True))
+        assert docs == list(doc_generator(str(tmp_path / path))) == (wordpress if path[0] == "w" else joomla)
+    # Articles never modified count as updated when created
+    selection = DocFilter(updated_since=utc_datetime("2015-01-01"))
+    expected = [d for d in joomla if selection.matches(d)]
+    assert any("updated_at" not in d for d in expected)
+    assert list(doc_generator(str(tmp_path / "jl-sql.sql"), selection=selection)) == expected
+
+
+def test_fast_import_history(tmp_path, monkeypatch):
+    # Every revision should be a commit, in time order across pages, but each distinct text converted only once
+    def revision(id, timestamp, user, text):
+        return (
+            f"<revision><id>{id}</id><timestamp>{timestamp}</timestamp><contributor><username>{user}</username>"
+            f'</contributor><text xml:space="preserve">{text}</text></revision>'
+        )
+
+    xml_file = tmp_path / "history.xml"
+    xml_file.write_text(
+        '<mediawiki xmlns="http://www.mediawiki.org/xml/export-0.10/" version="0.10">'
+        "<page><title>Alpha</title>"
+        + revision(1, "2010-01-01T00:00:00Z", "Ymir", "First")
+        + revision(4, "2010-01-04T00:00:00Z", "Kalle", "First")
+        + revision(3, "2010-01-03T00:00:00Z", "Anna", "Second")
+        + "</page><page><title>Beta</title>"
+        + revision(2, "2010-01-02T00:00:00Z", "Ymir", "Text")
+        + "</page></mediawiki>"
+    )
+    docs = list(doc_generator(str(xml_file), revisions=True))
+    assert [r["id"] for r in docs[0]["revisions"]] == ["1", "3", "4"]  # Oldest first
+    assert docs[0]["text/x-wiki"] == "First"
+
+    out = io.BytesIO()
+    history = FastImportWriter(out)
+    b = Batch("Test", all_pages={}, out_folder="-", history=history)
+    b.process(docs, job_history_to_fast_import)
+    history.close()
+    assert [j.result["converted"] for j in b.jobs] == [2, 1]
+    stream = out.getvalue().decode("utf-8")
+    assert stream.count("\nblob\n") + stream.startswith("blob\n") == 3
+    commits = [line.split(" <> ")[0] for line in stream.splitlines() if line.startswith("author ")]
+    assert commits == ["author Ymir", "author Ymir", "author Anna", "author Kalle"]
+    assert "M 100644 :1 Alpha.md" in stream and stream.count("M 100644 :1 Alpha.md") == 2
+
+    # A revision that fails should fail the whole page, without leaving part of its history in the stream
+    def failing_convert_document(job, data, id, title, text, *args):
+        if text == "Broken":
+            raise ValueError("Conversion failed")
+        return convert_document(job, data, id, title, text, *args)
+
+    monkeypatch.setattr("db2md.history.convert_document", failing_convert_document)
+    docs[0]["revisions"][1]["text/x-wiki"] = "Broken"
+    out = io.BytesIO()
+    history = FastImportWriter(out)
+    b = Batch("Test", all_pages={}, out_folder="-", history=history)
+    b.process(docs, job_history_to_fast_import)
+    history.close()
+    assert b.jobs[1].result["converted"] == 1 and b.jobs[0].success != JobSuccess.SUCCESS
+    stream = out.getvalue().decode("utf-8")
+    assert "Alpha.md" not in stream and stream.count("\nblob\n") + stream.startswith("blob\n") == 1
+
+
+def test_pandoc_batch_read(docs):
+    # Reading many documents in one pandoc call should give same result as reading them one by one
+    sources = [pandoc_source(*source_text(d)[:2]) for d in docs[:3]] + [("<h1>Heading</h1><p>Text\twith tab", "html")]
+    pandoc = PandocDriver()
+    batch_docs = pandoc.read_many(sources)
+    assert len(batch_docs) == len(sources)
+    for source, doc in zip(sources, batch_docs):
+        assert doc.to_json() == PandocDriver().read(*source).to_json()
+
+
+def test_pandoc_read_failure(tmp_path, docs, monkeypatch):
+    # A document pandoc can't read should only fail its own job, not the chunk it was read ahead in
+    pandoc = PandocDriver()
+    run_pandoc = pandoc.run_pandoc
+
+    def failing_run_pandoc(args, text, docs=1):
+        if "Unreadable" in text:
+            raise IOError("Pandoc failed: unreadable")
+        return run_pandoc(args, text, docs)
+
+    monkeypatch.setattr(pandoc, "run_pandoc", failing_run_pandoc)
+    pages = docs[:2] + [{"title": "Bad", "text/x-wiki": "Unreadable", "created_at": "", "author": ""}]
+    b = Batch("Test", all_pages={}, pandoc=pandoc, out_folder=str(tmp_path))
+    b.process(prefetch_pandoc(pages + docs[3:], pandoc), job_doc_to_markdown)
+    assert len(b.jobs) == 4 and b.jobs[2].log[-1][1] == "OSError('Pandoc failed: unreadable')"
+    assert b.jobs[2].success is JobSuccess.INCOMPLETE and JobSuccess.INCOMPLETE not in [j.success for j in b.jobs[:2]]
+
+
+def test_native_commonmark_writer(monkeypatch):
+    # The native writer should give the same text as pandoc, and leave what it doesn't support to pandoc
+    pandoc = PandocDriver(calibrate=0)
+    text = (
+        "== Heading ==\n''Italics'', '''bold''' and [[Link|a link]] to [https://example.com example] or [[Link]]\n"
+        "* One\n** One-point-one\n# First\n# Second\n\n1. Not a list, * [] `code` | x_y_z\n"
+        '{| class="wikitable"\n! A !! B\n|-\n| 1 || 2\n|}\n'
+    )
+    doc = pandoc.read(text, "mediawiki")
+    native = pandoc.write(doc, commonmark.output_format, commonmark.extra_args)
+    assert pandoc.native_writes == 1
+    assert native == pandoc.pandoc_write(doc, commonmark.output_format, commonmark.extra_args)
+
+    # Cases where Pandoc's output is easy to get wrong: continued definitions, a space kept before what could start
+    # a list, column widths counting spaces that are dropped, and email autolinks
+    def table(*cells):
+        rows = [pf.TableRow(*[pf.TableCell(pf.Plain(*c)) for c in r]) for r in cells]
+        colspec = [("AlignDefault", "ColWidthDefault")] * 2
+        return pf.Table(pf.TableBody(*rows[1:]), head=pf.TableHead(rows[0]), caption=pf.Caption(), colspec=colspec)
+
+    space = pf.Space
+    for block in [
+        pandoc.read(";Term\n:text<br>more\n:other\n", "mediawiki").content[0],
+        pf.Para(pf.Str("Text"), space(), space(), pf.Str("-"), space(), pf.Str("more")),
+        pf.Para(space(), pf.Str("1."), space(), pf.Str("more"), space(), pf.Str("+")),
+        pf.Para(pf.Emph(pf.Str("Text"), pf.LineBreak(), space(), pf.Str("+"), pf.SoftBreak(), pf.Str("more"))),
+        table([[pf.Str("A")], [pf.Str("B")]], [[pf.Str("abcdef"), space()], [pf.Str("b")]]),
+        table([[pf.Str("A")], [pf.Str("B")]], [[pf.Str("x"), space(), space(), pf.Str("-"), space(), pf.Str("y")], []]),
+        pf.Para(pf.Link(pf.Str("kalle.b@example.com"), url="mailto:kalle.b@example.com")),
+        pf.Para(pf.Link(pf.Str("Kalle"), url="mailto:kalle@example.com")),
+    ]:
+        doc = pf.Doc(block)
+        expected = pandoc.pandoc_write(doc, commonmark.output_format, commonmark.extra_args)
+        assert commonmark.write_commonmark_x(doc) == expected, expected
+    doc = pf.Doc(pf.Para(pf.Link(pf.Str("åsa@example.com"), url="mailto:åsa@example.com")))
+    with pytest.raises(commonmark.Unsupported):
+        commonmark.write_commonmark_x(doc)
+
+    doc = pandoc.read("Text with a footnote<ref>Note</ref>", "mediawiki")
+    with pytest.raises(commonmark.Unsupported):
+        commonmark.write_commonmark_x(doc)
+    assert "[^1]" in pandoc.write(doc, commonmark.output_format, commonmark.extra_args)
+    assert pandoc.native_writes == 1
+
+    # After the calibration every check_every-th document is still checked, and a difference turns it off
+    pandoc = PandocDriver(calibrate=0, check_every=2)
+    monkeypatch.setattr(commonmark, "write_commonmark_x", lambda doc: "Wrong")
+    doc = pandoc.read("Text", "mediawiki")
+    assert pandoc.write(doc, commonmark.output_format, commonmark.extra_args) == "Wrong" and pandoc.native_writer
+    assert pandoc.write(doc, commonmark.output_format, commonmark.extra_args) == "Text" and not pandoc.native_writer
+    assert pandoc.write(doc, commonmark.output_format, commonmark.extra_args) == "Text" and pandoc.native_writes == 1
+
+
+def test_parallel_process(tmp_path):
+    # Duplicate IDs across chunks should get the same outcome as when processed in order in one process
+    def page(title, text):
+        return {"title": title, "text/x-wiki": text, "created_at": "", "author": ""}
+
+    pages = [page("Redirect", "#REDIRECT [[Other]]"), page("Page", "Text"), page("redirect", "Real text")]
+    pages += [page("page", "Duplicate"), page("REDIRECT", "#REDIRECT [[Third]]"), page("Last", "Text")]
+    jobs = {}
+    for workers in (1, 2):
+        out_folder = tmp_path / str(workers)
+        pandoc = PandocDriver(chunk_size=2)
+        b = Batch("Test", all_pages={}, pandoc=pandoc, out_folder=out_folder)
+        if workers > 1:
+            parallel = ParallelProcess(b, workers, pandoc, out_folder=out_folder)
+            parallel.process(pages, job_doc_to_markdown)
+            assert parallel.last_chunk == {}  # Completed chunks are only kept in all_pages
+        else:
+            b.process(pages, job_doc_to_markdown)
+        jobs[workers] = [(j.id, j.success) for j in b.jobs]
+        assert (out_folder / "redirect.md").read_text().endswith("Real text")
+    assert jobs[1] == jobs[2]
+    assert [success for _, success in jobs[2]] == [
+        JobSuccess.SUCCESS,
+        JobSuccess.SUCCESS,
+        JobSuccess.WARN,  # Overwrote the redirect
+        JobSuccess.FAIL,
+        JobSuccess.FAIL,
+        JobSuccess.SUCCESS,
+    ]
+
+
+def test_manifest(tmp_path):
+    # A second run should only convert pages that changed, and find those that were removed
+    pages = [{"title": f"Page {i}", "text/x-wiki": f"Text {i}", "created_at": "", "author": ""} for i in range(3)]
+
+    def run(pages):
+        pandoc = PandocDriver(calibrate=0)
+        manifest = Manifest(str(tmp_path), {"pandoc": pandoc.version})
+        b = Batch("Test", all_pages={}, pandoc=pandoc, out_folder=str(tmp_path), manifest=manifest)
+        b.process(prefetch_pandoc(pages, pandoc, manifest=manifest), manifest.track(job_doc_to_markdown))
+        removed = manifest.finish()
+        manifest.save()
+        return [j.success for j in b.jobs], removed, pandoc.calls
+
+    assert run(pages) == ([JobSuccess.SUCCESS] * 3, [], 3)  # Version, API version and one call to read all
+    assert run(pages) == ([JobSuccess.SKIP] * 3, [], 1)
+    pages[1]["text/x-wiki"] = "Changed"
+    assert run(pages[:2]) == ([JobSuccess.SKIP, JobSuccess.SUCCESS], ["page 2"], 2)
+    assert (tmp_path / "Page 1.md").read_text().endswith("Changed")
+
+
+def test_lazy_documents(tmp_path):
+    # Texts should stay escaped until read, also when a second run finds the pages unchanged
+    corpus.write_dump("mw-sql", 10, str(tmp_path / "dump.sql"))
+    docs = list(doc_generator(str(tmp_path / "dump.sql"), native=True))
+    assert all(isinstance(d._text, bytes) for d in docs)
+    assert "text/x-wiki" in docs[0] and "updated_at" not in docs[0] and isinstance(docs[0]._text, bytes)
+    assert pickle.loads(pickle.dumps(docs[0])) == docs[0] == dict(docs[0])
+
+    def run():
+        pandoc = PandocDriver(calibrate=0)
+        manifest = Manifest(str(tmp_path / "out"), {"pandoc": pandoc.version})
+        b = Batch("Test", all_pages={}, pandoc=pandoc, out_folder=str(tmp_path / "out"), manifest=manifest)
+        b.process(prefetch_pandoc(docs, pandoc, manifest=manifest), manifest.track(job_doc_to_markdown))
+        manifest.finish()
+        manifest.save()
+        return [j.success for j in b.jobs]
+
+    assert set(run()) != {JobSuccess.SKIP}
+    docs = list(doc_generator(str(tmp_path / "dump.sql"), native=True))
+    assert set(run()) == {JobSuccess.SKIP}
+    assert all(isinstance(d._text, bytes) for d in docs)
+
+
+@pytest.mark.parametrize("name", ["pages.json", "pages.sqlite"])
+def test_page_registry(tmp_path, name):
+    # Both kinds of registry should apply the rules for the same ID, also with concurrent writers, and persist
+    pages = open_registry(str(tmp_path / name))
+    assert isinstance(pages, SqliteRegistry if name.endswith(".sqlite") else MemoryRegistry)
+    assert pages.claim("a", "A", 1) is None and pages.claim("a", "a", 0) == ("A", 1)
+    assert pages.claim("a", "A", 0) == ("a", 0) and dict(pages) == {"a": ("a", 0)}
+    with ThreadPoolExecutor(4) as pool:
+        claims = list(pool.map(lambda title: pages.claim("b", title, 0), ["B"] * 20))
+    assert claims.count(None) == 1 and pages["b"] == ("B", 0)
+    pages.save()
+    pages = open_registry(str(tmp_path / name), resume=True)
+    assert dict(pages) == {"a": ("a", 0), "b": ("B", 0)}
+    assert pages.claim("b", "B", 0) is None and pages.claim("b", "b", 0) == ("B", 0)
+    assert pickle.loads(pickle.dumps(pages)).get("a") == ("a", 0)
+    assert len(open_registry(str(tmp_path / name))) == 0  # A new run
+
+    b = Batch("Test", all_pages={}, dry_run=True, out_folder=str(tmp_path))
+    b.process([{"title": "C", "text/x-wiki": "Text"}] * 2, job_doc_to_markdown)
+    assert isinstance(b.context["all_pages"], MemoryRegistry) and b.jobs[1].success == JobSuccess.FAIL
+
+    # A resumed run should skip the pages that the interrupted run already converted, as unchanged
+    for resume in (False, True):
+        manifest = Manifest(str(tmp_path / "out"), {})
+        pages = open_registry(str(tmp_path / name), resume=resume)
+        b = Batch("Test", all_pages=pages, out_folder=str(tmp_path / "out"), manifest=manifest)
+        b.process([{"title": "C", "text/x-wiki": "Text"}], manifest.track(job_doc_to_markdown))
+        pages.save()
+        manifest.finish()
+        manifest.save()
+    assert b.jobs[0].success == JobSuccess.SKIP
+
+
+def test_document_limits(tmp_path, docs, monkeypatch):
+    # Conversions and pandoc processes over the limits should be stopped, and failed or converted as plain text
+    pandoc = PandocDriver()
+    monkeypatch.setattr(pandoc, "read", lambda *args: time.sleep(10))
+    b = ConversionBatch("Test", all_pages={}, pandoc=pandoc, out_folder=str(tmp_path))
+    b.process(docs[:1], JobLimits(0.1).track(job_doc_to_markdown))
+    assert b.jobs[0].success == JobSuccess.FAIL and b.jobs[0].result["exceeded"] == "Took over 0.1 s"
+    assert "Normal: Took over 0.1 s (failed)" in b.summary_str()
+
+    b.process(docs[1:2], JobLimits(0.1, job_doc_to_plain_markdown).track(job_doc_to_markdown))
+    assert b.jobs[1].success == JobSuccess.WARN and "(converted as plain text)" in limit_summary(b.jobs)
+    page = Path(b.jobs[1].result["path"]).read_text()
+    assert "unconverted: Took over 0.1 s\n---\n```mediawiki\n" in page and docs[1]["text/x-wiki"] in page
+
+    # The plain text fallback should claim the page if the job didn't, and follow the rules for the same ID
+    b = ConversionBatch("Test", all_pages={}, out_folder=str(tmp_path / "other"))
+    b.process([docs[0], docs[0]], lambda job, data: job_doc_to_plain_markdown(job, data, "Took too long"))
+    assert [j.success for j in b.jobs] == [JobSuccess.WARN, JobSuccess.FAIL] and "normal" in b.context["all_pages"]
+
+    pandoc = PandocDriver(timeout=0.001)
+    pandoc.prefetch([pandoc_source(*source_text(d)[:2]) for d in docs[:2]])
+    calls = pandoc.calls
+    with pytest.raises(LimitExceeded, match="Pandoc took over"):
+        pandoc.read(*pandoc_source(*source_text(docs[0])[:2]))
+    assert pandoc.calls == calls  # Not tried again
+
+
+def test_conversion_cache(tmp_path, docs):
+    # A second run with the same cache should not need pandoc to read or write, and give the same result
+    results = []
+    for run in range(2):
+        cache = ConversionCache(str(tmp_path / "cache.sqlite"))
+        pandoc = PandocDriver(cache=cache, native_writer=False)
+        calls = pandoc.calls
+        b = ConversionBatch("Test", dry_run=True, all_pages={}, pandoc=pandoc, out_folder=str(tmp_path))
+        b.process(prefetch_pandoc(docs[:2], pandoc), job_doc_to_markdown)
+        results.append([j.result["text"] for j in b.jobs])
+        # Pandoc versions, then a read of both docs and a write each only in the first run
+        assert pandoc.calls - calls == (5 if run == 0 else 1)
+        assert cache.summary_str() in b.summary_str()
+    assert results[0] == results[1]
+    assert cache.stats == {"hits": 4}
+
+    # Least recently used entries are evicted to stay within the budget
+    cache = ConversionCache(str(tmp_path / "small.sqlite"), max_bytes=100)
+    for i in range(20):
+        cache.put(str(i), f"Text {i} " * 10)
+    assert cache.get("19") is not None and cache.get("0") is None
+    assert cache.con.execute("SELECT SUM(size) FROM entries").fetchone()[0] <= 100
+
+
+def test_stage_timing(tmp_path, docs):
+    # Jobs should get their time per stage, summarized by the batch, and slow jobs be profiled if asked for
+    pandoc = PandocDriver()
+    b = ConversionBatch("Test", all_pages={}, pandoc=pandoc, out_folder=str(tmp_path), slowest=1)
+    profiler = JobProfiler(str(tmp_path / "profiles"), threshold=0)
+    b.process(prefetch_pandoc(b.read(docs[:2]), pandoc), profiler.track(job_doc_to_markdown))
+    assert [j.times.title for j in b.jobs] == ["Normal", "'Tricky: Ϡ"]
+    assert all(set(j.times.seconds) == set(stages) for j in b.jobs)
+    summary = b.summary_str()
+    assert "read_dump" in summary and "Slowest 1 documents" in summary
+    assert (tmp_path / "profiles" / "normal.prof").exists() and (tmp_path / "profiles" / "normal.json").exists()
+    assert [percentile([1, 2, 3, 4], p) for p in (50, 95, 100)] == [2, 4, 4]
+
+
+def test_title_index(tmp_path):
+    # Links to pages that aren't in the source, or only in a namespace, should be logged
+    def page(title, text):
+        return {"title": title, "text/x-wiki": text, "created_at": "", "author": ""}
+
+    pages = [page("Start", "[[Other_page]], [[Other page#Part|part]], [[#Top]], [[Missing]] and [[Mall:Test]]")]
+    pages += [page("Other page", "#REDIRECT [[Start]]"), page("other page", "Text"), page("Mall:Test", "Text")]
+    titles = TitleIndex(pages)
+    assert len(titles) == 3
+    assert titles.get("OTHER PAGE") == ("other page", "other page", "", False)  # Replaced the redirect
+    assert titles.get("Mall:Test").namespace == "Mall"
+    b = Batch("Test", all_pages={}, out_folder=str(tmp_path), titles=titles, log_level=LogLevel.INFO, dry_run=True)
+    b.process(pages[:1], job_doc_to_markdown)
+    assert [msg for _, msg in b.jobs[0].log if msg.startswith("Link")] == ["Link to a page not in the source: Missing"]
+
+
+def test_redirects(tmp_path):
+    # Redirects that are only a link should be read as Pandoc would but without it, and can be folded into aliases
+    def page(title, text):
+        return {"title": title, "text/x-wiki": text, "created_at": "", "author": ""}
+
+    pages = [page("Start", "Text"), page("Other page", "#REDIRECT [[start#Part| the  start]]")]
+    pages += [page("Third", "#redirect [[Start]]\n"), page("Fourth", "#REDIRECT [[Start]] [[Category:X]]")]
+    pages += [page("Fifth", "#REDIRECT [[Third]]")]
+    pandoc = PandocDriver(calibrate=0)
+    for data in pages[1:3]:
+        text = pandoc_source(*source_text(data)[:2])[0]
+        assert redirect_doc(text, pandoc.api_version).to_json() == pandoc.pandoc_read(text, "mediawiki").to_json()
+    assert redirect_doc(pandoc_source(*source_text(pages[3])[:2])[0], pandoc.api_version) is None
+    calls = pandoc.calls
+    b = Batch("Test", all_pages={}, pandoc=pandoc, out_folder=str(tmp_path), dry_run=True)
+    b.process(pages[1:3], job_doc_to_markdown)
+    assert pandoc.calls == calls and "Alias for [ the start]" in b.jobs[0].result["text"]
+
+    # Folding should remove the redirects written by an earlier run without it, and follow a redirect to a redirect.
+    # A later run should remove the aliases from a page left unchanged, when the redirects to it are gone.
+    out = str(tmp_path / "out")
+    for fold, run_pages in ((False, pages), (True, pages), (True, [pages[0], pages[3]])):
+        folder, manifest = AliasFolder(), Manifest(out, {})
+        b = Batch("Test", all_pages={}, pandoc=pandoc, out_folder=out, fold_redirects=fold, manifest=manifest)
+        b.process(prefetch_pandoc(run_pages, pandoc), manifest.track(folder.track(job_doc_to_markdown)))
+        assert folder.fold(b.context["all_pages"], out) == []
+        manifest.finish()
+        manifest.save()
+        if fold and run_pages is pages:
+            assert sorted(p.name for p in (tmp_path / "out").glob("*.md")) == ["Fourth.md", "Start.md"]
+            assert "aliases:\n- Fifth\n- Other page\n- Third\n" in (tmp_path / "out" / "Start.md").read_text()
+            assert sorted(manifest.pages) == ["fourth", "start"]
+    assert b.jobs[0].success is JobSuccess.SKIP and "aliases" not in (tmp_path / "out" / "Start.md").read_text()
+
+
+def test_shards(tmp_path):
+    # Shards merged should give the same pages as converting in one batch, with the rules for the same ID across them
+    def page(title, text):
+        return {"title": title, "text/x-wiki": text, "created_at": "2011-03-13T18:42:38Z", "author": ""}
+
+    pages = [page("Start", "Text"), page("Other page", "#REDIRECT [[Start]]"), page("Second", "More")]
+    pages += [page("Third", "Even more"), page("Fourth", "#REDIRECT [[Second]]")]
+    pandoc = PandocDriver(calibrate=0)
+
+    def convert(docs, folder, source, shard):
+        # The source file is only hashed, to tell the dumps that shards were converted from apart
+        (source_path := tmp_path / source).write_text("\n".join(d["title"] for d in docs))
+        aliases = AliasFolder()
+        b = Batch("Test", all_pages={}, pandoc=pandoc, out_folder=str(tmp_path / folder), fold_redirects=True)
+        b.process([d for d in docs if DocFilter(shard=shard).matches(d)], aliases.track(job_doc_to_markdown))
+        save_shard(str(tmp_path / folder), str(source_path), shard, b, b.context["all_pages"], aliases)
+        return aliases, b
+
+    aliases, b = convert(pages, "all", "wiki.xml", (1, 1))
+    aliases.fold(b.context["all_pages"], str(tmp_path / "all"))
+    for i in (1, 2):
+        convert(pages, f"shard{i}", "wiki.xml", (i, 2))
+    assert len(list((tmp_path / "shard1").glob("*.md"))) == 1 and len(list((tmp_path / "shard2").glob("*.md"))) == 2
+
+    def merge(*folders):
+        shards = Shards([str(tmp_path / folder) for folder in folders])
+        b = Batch("Merge", all_pages={}, out_folder=str(tmp_path / "merged"))
+        b.process(shards.pages(), job_merge_page)
+        assert shards.aliases().fold(b.context["all_pages"], str(tmp_path / "merged")) == []
+        return shards, b
+
+    shards, b = merge("shard2", "shard1")
+    assert shards.summary_str().startswith("wiki.xml: shards 1/2, 2/2\nConverted in the shards: {'SUCCESS': 5}")
+    for path in (tmp_path / "all").glob("*.md"):
+        assert (tmp_path / "merged" / path.name).read_text() == path.read_text()
+        assert (tmp_path / "merged" / path.name).stat().st_mtime == path.stat().st_mtime == 1300041758
+    assert "aliases:\n- Other page\n" in (tmp_path / "merged" / "Start.md").read_text()
+
+    # A page of another source with the same ID as a page isn't overwritten, but fails like in one batch
+    convert([page("START", "Other text")], "other", "other.xml", (1, 1))
+    shards, b = merge("shard1", "shard2", "other")
+    assert [(j.data["title"], j.success) for j in b.jobs if j.success is not JobSuccess.SUCCESS] == [
+        ("Start", JobSuccess.FAIL)
+    ]
+    assert "other.xml: shards 1/1" in shards.summary_str()
+
+    # Shards of a source converted from different dumps, e.g. one that was updated in between, shouldn't be merged
+    convert(pages[:4], "shard2", "wiki.xml", (2, 2))
+    with pytest.raises(AssertionError, match="not all converted from the same dump"):
+        merge("shard1", "shard2")
+
+
+def test_background_writer(tmp_path, docs, monkeypatch):
+    # Files written in the background should be the same as when written by the job, with the same times
+    for folder in ("sync", "background"):
+        writer = BackgroundWriter(batch_size=2) if folder == "background" else None
+        b = Batch("Test", all_pages={}, out_folder=str(tmp_path / folder), writer=writer)
+        b.process(docs[:2], job_doc_to_markdown)
+        if writer:
+            writer.close()
+            assert writer.written == 2 and not writer.errors
+    for name in ("Normal.md", "'Tricky Ϡ.md"):
+        assert (tmp_path / "sync" / name).read_text() == (tmp_path / "background" / name).read_text()
+    mtimes = [(tmp_path / folder / "Normal.md").stat().st_mtime for folder in ("sync", "background")]
+    assert mtimes[0] == mtimes[1] == 1300041758  # Created at 2011-03-13T18:42:38Z
+    assert sorted(p.name for p in (tmp_path / "background").iterdir()) == ["'Tricky Ϡ.md", "Normal.md"]
+
+    writer = BackgroundWriter()
+    (tmp_path / "file").write_text("Not a folder")
+    writer.write(OutputFile(str(tmp_path / "file" / "page.md"), "Text"))
+    writer.close()
+    assert [path for path, _ in writer.errors] == [str(tmp_path / "file" / "page.md")]
+
+    # Other errors, e.g. text that can't be encoded in the locale's encoding, shouldn't stop or hang the writer
+    def failing_write_file(f, dirs=None):
+        if f.content == "Unencodable":
+            raise UnicodeEncodeError("ascii", f.content, 0, 1, "ordinal not in range(128)")
+        write_file(f, dirs)
+
+    monkeypatch.setattr("db2md.writer.write_file", failing_write_file)
+    writer = BackgroundWriter(batch_size=1, max_pending=1)
+    for name, text in [("bad.md", "Unencodable"), ("good.md", "Text"), ("other.md", "Text")]:
+        writer.write(OutputFile(str(tmp_path / "encoding" / name), text))
+    writer.close()
+    assert [path for path, _ in writer.errors] == [str(tmp_path / "encoding" / "bad.md")] and writer.written == 2
+    monkeypatch.undo()
+
+    # The jobs of pages that couldn't be written should fail, and not be kept in the manifest
+    writer = BackgroundWriter()
+    manifest = Manifest(str(tmp_path / "file"), {})
+    b = Batch("Test", all_pages={}, out_folder=str(tmp_path / "file"), writer=writer, manifest=manifest)
+    b.process(docs[:2], manifest.track(job_doc_to_markdown))
+    writer.close()
+    assert JobSuccess.FAIL not in [j.success for j in b.jobs] and len(manifest.updated) == 2
+    for job in fail_unwritten(b.jobs, writer.errors):
+        manifest.remove(job.id)
+    assert [j.success for j in b.jobs] == [JobSuccess.FAIL] * 2 and manifest.updated == {}
+
+
+@pytest.mark.parametrize("name", ["out.zip", "out.tar.gz"])
+def test_archive_output(tmp_path, name):
+    # Redirects should be replaced in the archive by later pages with the same ID, like they overwrite files
+    def page(title, text, created_at=""):
+        return {"title": title, "text/x-wiki": text, "created_at": created_at, "author": ""}
+
+    pages = [page("Redirect", "#REDIRECT [[Other]]"), page("Page", "Text", "2011-03-13T18:42:38Z")]
+    pages += [page("redirect", "Real text"), page("page", "Duplicate"), page("Last", "#REDIRECT [[Page]]")]
+    path = str(tmp_path / name)
+    writer = ArchiveWriter(path)
+    b = Batch("Test", all_pages={}, out_folder=path, writer=writer)
+    b.process(pages, job_doc_to_markdown)
+    writer.close()
+    assert [j.success for j in b.jobs][3] is JobSuccess.FAIL
+    if name.endswith(".zip"):
+        with zipfile.ZipFile(path) as z:
+            files = {i.filename: (z.read(i).decode("utf-8"), i.date_time) for i in z.infolist()}
+        assert files["Page.md"][1] == time.localtime(1300041758)[:6]  # Zip has local times
+    else:
+        with tarfile.open(path) as t:
+            files = {i.name: (t.extractfile(i).read().decode("utf-8"), i.mtime) for i in t.getmembers()}
+        assert files["Page.md"][1] == 1300041758
+    assert sorted(files) == ["Last.md", "Page.md", "redirect.md"]
+    assert files["redirect.md"][0].endswith("Real text")
+
+
+@pytest.mark.parametrize("parser", ["internal", "missing", "changed"])
+def test_fix_table(monkeypatch, parser):
+    # Should give the same text and log as applying each fix in turn, also when skipping to the first trigger char,
+    # and without triggers if the regex parser internals are missing or not as expected
+    if parser == "missing":
+        monkeypatch.setattr("db2md.main.sre_parse", None)
+    elif parser == "changed":
+        monkeypatch.setattr("db2md.main.sre_parse", SimpleNamespace(parse=re.compile))
+    text = "Text\twith tab, \\*escaped\\* <span>tag</span>\n\n\n\n`code`\n`code`\n[link][] ''x'' == __NOTOC__  \n"
+    for log_level in LogLevel:
+        batch = Batch("Test", log_level=log_level)
+        for fixes in (mediawiki_fixes, markdown_fixes):
+            expected_job, job = Job(0, batch=batch), Job(0, batch=batch)
+            expected = text
+            for k, v in fixes.items():
+                if v.repl is not None:
+                    expected, count = v.pattern.subn(v.repl, expected)
+                    if count > 0 and v.log_level is not None:
+                        expected_job.log_any(f"Replaced {k} {count} times", v.log_level)
+                elif v.log_level is not None:
+                    if matches := ", ".join(simple_truncate(m[0]) for m in v.pattern.finditer(expected)):
+                        expected_job.log_any(f"{v.comment}, at {matches}", v.log_level)
+            assert FixTable(fixes).apply(text, job) == expected
+            assert job.log == expected_job.log
+    if parser != "internal":
+        assert all(match_trigger(v.pattern) is None for v in markdown_fixes.values())
+        return
+    assert match_trigger(markdown_fixes["unusual_whitespace"].pattern).offset == 1
+    assert match_trigger(mediawiki_fixes["normalize_image_links"].pattern) is None  # Ignores case
+
+
+def test_filter_dispatcher(docs):
+    # Should change the document like running each action in its own walk, but only call actions for their types
+    pandoc = PandocDriver()
+    for data in docs[:2]:
+        text, input_format = pandoc_source(*source_text(data)[:2])
+        expected, doc = pandoc.read(text, input_format), pandoc.read(text, input_format)
+        actions = [action_clean_link, action_extract_namespace]
+        pf.run_filters(actions, doc=expected, job=Job(0), context={"raw_metadata": {}, "is_redirect": 0})
+        called = []
+        filters = FilterDispatcher().add(lambda elem, *args: called.append(elem), pf.Link, pf.Image)
+        for action in actions:
+            filters.add(action, pf.Link, pf.Image, pf.LineBreak)
+        filters.run(doc, Job(0), {"raw_metadata": {}, "is_redirect": 0})
+        assert doc.to_json() == expected.to_json()
+        assert called and all(isinstance(elem, (pf.Link, pf.Image)) for elem in called)
+
+
+def test_benchmark_corpus(tmp_path):
+    # The synthetic dumps should read the same pages in every format, and the pipeline benchmark time all stages
+    titles = {}
+    for format, ext in corpus.formats.items():
+        path = str(tmp_path / f"{format}{ext}")
+        corpus.write_dump(format, 50, path)
+        docs = list(doc_generator(path))
+        titles[format] = [d["title"] for d in docs]
+        if format.startswith("mw"):
+            assert any(d["text/x-wiki"].startswith("#REDIRECT") for d in docs)
+            assert any("[[Category:" in d["text/x-wiki"] or "[[Kategori:" in d["text/x-wiki"] for d in docs)
+    assert len(titles["mw-xml"]) == 50
+    assert titles["mw-xml"] == titles["mw-sql"] == titles["wp-sql"] == titles["jl-sql"]
+
+    result = pipeline.run_case("mw-xml", 50, str(tmp_path / "mw-xml.xml"), chunk_size=25)
+    assert result["docs"] == 50 and result["failed"] == 0
+    assert list(result["stages"]) == list(pipeline.stages)
+    assert all(stage["seconds"] > 0 for stage in result["stages"].values())
+
+
 # test filtering
 
 # test redirect